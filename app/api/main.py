@@ -1,12 +1,12 @@
 import os
 import sys
-import base64
 import requests
 from flask import Flask, request, jsonify
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from ingest import RawPublisher  
 from core.kafka import KafkaJSON
+from core.blobstore import sniff_mime
 
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -144,13 +144,17 @@ def processar_escolha_valor(chat_id, source_id, valor_texto):
     user_states.pop(source_id, None)
 
 
-def processar_arquivo(file_id: str, chat_id: int, source_id: int, attachment_type: str) -> None:
+def processar_arquivo(file_id: str, chat_id: int, source_id: int, attachment_type: str, mime_type: str = None) -> None:
     blob = tg_get_file_bytes(file_id)
-    b64 = base64.b64encode(blob).decode("ascii")
-    publisher.publish(
+    # o Telegram informa mime_type só em documentos (e vem do cliente); sem ele,
+    # ou com o genérico octet-stream, o tipo sai dos primeiros bytes do arquivo
+    if not mime_type or mime_type == "application/octet-stream":
+        mime_type = sniff_mime(blob)
+    publisher.publish_bytes(
         source_id=source_id,
+        data=blob,
         attachment_type=attachment_type,
-        attachment_data=b64,
+        mime=mime_type,
     )
     tg_send_message(chat_id, "Estou lendo a sua imagem, aguarde só um momento.")
 
@@ -216,7 +220,7 @@ def telegram_webhook():
             tg_send_message(chat_id, "Recebi um novo arquivo! Mas antes de continuar com ele, preciso terminar essa parte da conversa. Pode me confirmar as informações primeiro?")
             return jsonify(success=True)
         file_id = msg["document"]["file_id"]
-        processar_arquivo(file_id, chat_id, source_id, "document")
+        processar_arquivo(file_id, chat_id, source_id, "document", msg["document"].get("mime_type"))
         return jsonify(success=True)
 
     return jsonify(success=True)
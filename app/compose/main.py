@@ -5,8 +5,9 @@ from typing import Any, Dict, Optional
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from core.llm import LLMWrapper
-from core.kafka import KafkaJSON
+from core.llm import CircuitBreaker, EndpointPool, LLMTrace, LLMWrapper
+from core.llmrouter import LLMRouter
+from core.kafka import KafkaJSON, send_json
 
 
 KAFKA_BOOTSTRAP = os.getenv("KAFKA_BROKER_URL", "localhost:29092")
@@ -17,6 +18,7 @@ LLM_PROVIDER = os.getenv("LLM_PROVIDER", "ollama")
 LLM_MODEL = os.getenv("LLM_MODEL", "qwen2.5:7b-instruct")
 LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.3"))
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "https://ollama.pedro-porto.com")
+HANDLER_CONCURRENCY = int(os.getenv("HANDLER_CONCURRENCY", "1"))
 
 
 import re
@@ -25,12 +27,18 @@ _SYSTEM_RE   = re.compile(r"SYSTEM\s*=\s*\(.*?\)", re.DOTALL)
 _NO_RE       = re.compile(r"NO_OFFER_TPL\s*=\s*\"\"\".*?\"\"\"", re.DOTALL)
 _YES_RE      = re.compile(r"YES_OFFER_TPL\s*=\s*\"\"\".*?\"\"\"", re.DOTALL)
 
+# trechos que indicam que o modelo começou a repetir o prompt
+_LEAK_MARKERS = ("\nSYSTEM", "SYSTEM", "Dados do cliente:", "Oferta detectada:")
+
+NO_OFFER_MAX_CHARS = 450
+YES_OFFER_MAX_CHARS = 550
+
 def sanitize_llm_message(text: str) -> str:
     cleaned = _SYSTEM_RE.sub("", text)
     cleaned = _NO_RE.sub("", cleaned)
     cleaned = _YES_RE.sub("", cleaned)
 
-    for marker in ("\nSYSTEM", "SYSTEM", "Dados do cliente:", "Oferta detectada:"):
+    for marker in _LEAK_MARKERS:
         if marker in cleaned:
             cleaned = cleaned.split(marker, 1)[0]
 
@@ -41,6 +49,24 @@ def sanitize_llm_message(text: str) -> str:
     return cleaned
 
 
+def stop_at(max_chars: int):
+    """Predicado de parada do streaming: orçamento de caracteres ou vazamento do prompt."""
+    def stop(text: str) -> bool:
+        return len(text) >= max_chars or any(m in text for m in _LEAK_MARKERS)
+    return stop
+
+
+def trim_to_budget(text: str, max_chars: int) -> str:
+    """Corta no limite, preferindo o fim da última frase completa."""
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    end = max(cut.rfind("."), cut.rfind("!"), cut.rfind("?"))
+    if end >= max_chars // 2:
+        return cut[:end + 1]
+    return cut.rsplit(" ", 1)[0]
+
+
 def ts_ms() -> int:
     return int(time.time() * 1000)
 
@@ -122,6 +148,7 @@ def compose_with_llm(llm: LLMWrapper, payload: Dict[str, Any]) -> str:
             new_financing_amount=fmt_brl(eo.get("new_financing_amount")),
             potential_savings=fmt_brl(eo.get("potential_savings")),
         )
+        max_chars = YES_OFFER_MAX_CHARS
     else:
         prompt = NO_OFFER_TPL.format(
             company=company or "-",
@@ -129,10 +156,19 @@ def compose_with_llm(llm: LLMWrapper, payload: Dict[str, Any]) -> str:
             installment_count=tot if tot is not None else "-",
             installment_amount=fmt_brl(amt),
         )
-
-    text = llm.generate(prompt=prompt, system_prompt=SYSTEM).strip()
+        max_chars = NO_OFFER_MAX_CHARS
+
+    # streaming: para de gerar ao bater o orçamento ou ao detectar o prompt vazando;
+    # com o breaker aberto, a mensagem determinística sai na hora
+    text = llm.generate_until(
+        prompt=prompt,
+        system_prompt=SYSTEM,
+        stop=stop_at(max_chars),
+        label="compose.message",
+        fallback=lambda: fallback_message(payload),
+    )
     text = sanitize_llm_message(text)
-    return text
+    return trim_to_budget(text, max_chars)
 
 
 def fallback_message(payload: Dict[str, Any]) -> str:
@@ -185,26 +221,29 @@ def on_msg(topic: str, msg: Dict[str, Any], *, k: KafkaJSON, llm: LLMWrapper):
 
     out = build_output(source_id, text)
 
-    if hasattr(k, "send"):
-        k.send(OUTPUT_TOPIC, out)
-    elif hasattr(k, "publish"):
-        k.publish(OUTPUT_TOPIC, out)
-    else:
-        raise AttributeError("KafkaJSON não possui 'send' nem 'publish'.")
+    send_json(k, OUTPUT_TOPIC, out)
 
     print("[COMPOSED]", out)
 
 
 def main():
-    llm = LLMWrapper(
+    base_llm = LLMWrapper(
         provider=LLM_PROVIDER,
         model=LLM_MODEL,
         temperature=LLM_TEMPERATURE,
         ollama_base_url=OLLAMA_BASE_URL,
+        pool_size=max(10, HANDLER_CONCURRENCY),  # uma conexão keep-alive por thread
+        breaker=CircuitBreaker.from_env(OLLAMA_BASE_URL),
+        endpoints=EndpointPool.from_env(OLLAMA_BASE_URL),  # aceita várias URLs separadas por vírgula
+        trace=LLMTrace.from_env(),
     )
+    # modelo por tarefa (LLM_MODELS), keep_alive e warm-up antes de consumir
+    router = LLMRouter.from_env(base_llm)
+    llm = router.for_task("compose")
+    router.start(["compose"])
     k = KafkaJSON(KAFKA_BOOTSTRAP, os.getenv("GROUP_ID", "btg-composer"))
     k.subscribe(INPUT_TOPIC)
-    k.loop(lambda t, d: on_msg(t, d, k=k, llm=llm))
+    k.loop(lambda t, d: on_msg(t, d, k=k, llm=llm), concurrency=HANDLER_CONCURRENCY)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,195 @@
+import hashlib
+import mmap
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+from urllib.parse import urlparse
+
+
+BlobRef = Dict[str, Any]
+
+# assinaturas dos formatos que chegam pelo bot (os que o Textract aceita + alguns comuns)
+_MAGIC = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"%PDF-", "application/pdf"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+
+def sniff_mime(data: bytes, default: str = "application/octet-stream") -> str:
+    """Tipo do conteúdo pelos primeiros bytes; default se não reconhecer."""
+    head = bytes(data[:16])
+    for magic, mime in _MAGIC:
+        if head.startswith(magic):
+            return mime
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return default
+
+
+class LocalBlobStore:
+    """
+    Blob store endereçado por conteúdo (sha256) em disco.
+    - put() grava uma vez (idempotente) e devolve uma referência pequena
+    - open() mapeia o arquivo com mmap e entrega um memoryview, sem cópia
+    - cleanup() apaga blobs mais velhos que a retenção (nada apaga sozinho:
+      rode periodicamente, ver BLOB_RETENTION_S no __main__ abaixo)
+    Layout: <root>/<aa>/<bb>/<sha256>
+    """
+
+    scheme = "file"
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def put(self, data: bytes, mime: str = "application/octet-stream") -> BlobRef:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except Exception:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                raise
+        else:
+            # reenvio do mesmo conteúdo: renova a idade para o cleanup() não apagar
+            # um blob que acabou de ser referenciado de novo
+            os.utime(path)
+        return {"sha256": digest, "size": len(data), "mime": mime, "uri": f"file://{path}"}
+
+    @contextmanager
+    def open(self, ref: BlobRef) -> Iterator[memoryview]:
+        path = self._path(ref["sha256"])
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size != int(ref.get("size", size)):
+                raise ValueError(f"Blob {ref['sha256']} com tamanho inesperado ({size} != {ref['size']}).")
+            if size == 0:
+                yield memoryview(b"")
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(mm)
+            try:
+                yield view
+            finally:
+                view.release()
+                mm.close()
+
+    def read(self, ref: BlobRef) -> bytes:
+        with self.open(ref) as view:
+            return bytes(view)
+
+    def exists(self, ref: BlobRef) -> bool:
+        return os.path.exists(self._path(ref["sha256"]))
+
+    def cleanup(self, max_age_s: float) -> int:
+        """
+        Apaga blobs (e temporários órfãos) sem escrita há mais de max_age_s.
+        A retenção precisa cobrir o atraso máximo do consumidor de btg.raw:
+        mensagem que ainda aponta para um blob apagado falha no textract.
+        Retorna quantos arquivos foram removidos.
+        """
+        cutoff = time.time() - max_age_s
+        removed = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    if os.stat(path).st_mtime < cutoff:
+                        os.unlink(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass  # outro processo limpou/substituiu antes
+        return removed
+
+
+class S3BlobStore:
+    """
+    Mesma interface do LocalBlobStore sobre um bucket S3-compatível
+    (AWS, MinIO, etc. — endpoint_url troca o servidor).
+    """
+
+    scheme = "s3"
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None, client=None):
+        if client is None:
+            import boto3  # precisa de pip install boto3
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self._s3 = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def _key(self, digest: str) -> str:
+        return f"{self.prefix}/{digest}" if self.prefix else digest
+
+    def put(self, data: bytes, mime: str = "application/octet-stream") -> BlobRef:
+        digest = hashlib.sha256(data).hexdigest()
+        key = self._key(digest)
+        if not self._exists_key(key):
+            self._s3.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType=mime)
+        return {"sha256": digest, "size": len(data), "mime": mime, "uri": f"s3://{self.bucket}/{key}"}
+
+    @contextmanager
+    def open(self, ref: BlobRef) -> Iterator[memoryview]:
+        yield memoryview(self.read(ref))
+
+    def read(self, ref: BlobRef) -> bytes:
+        resp = self._s3.get_object(Bucket=self.bucket, Key=self._key(ref["sha256"]))
+        return resp["Body"].read()
+
+    def exists(self, ref: BlobRef) -> bool:
+        return self._exists_key(self._key(ref["sha256"]))
+
+    def _exists_key(self, key: str) -> bool:
+        try:
+            self._s3.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except Exception:
+            return False
+
+
+def blob_store_from_url(url: Optional[str] = None):
+    """
+    Cria o blob store a partir de BLOB_STORE_URL:
+      file:///caminho/local   → LocalBlobStore
+      s3://bucket/prefixo     → S3BlobStore (BLOB_S3_ENDPOINT opcional)
+    Retorna None se não configurado (produtores voltam para base64 inline).
+    """
+    url = url if url is not None else os.getenv("BLOB_STORE_URL", "")
+    if not url:
+        return None
+    parsed = urlparse(url)
+    if parsed.scheme == "file":
+        return LocalBlobStore(parsed.path)
+    if parsed.scheme == "s3":
+        return S3BlobStore(
+            bucket=parsed.netloc,
+            prefix=parsed.path,
+            endpoint_url=os.getenv("BLOB_S3_ENDPOINT") or None,
+        )
+    raise ValueError(f"BLOB_STORE_URL com esquema não suportado: {url}")
+
+
+if __name__ == "__main__":
+    # GC do blob store local, para rodar via cron:
+    #   BLOB_STORE_URL=file:///blobs BLOB_RETENTION_S=604800 python app/core/blobstore.py
+    store = blob_store_from_url()
+    retention_s = float(os.getenv("BLOB_RETENTION_S", str(7 * 24 * 3600)))
+    if not isinstance(store, LocalBlobStore):
+        raise SystemExit("cleanup só se aplica a BLOB_STORE_URL=file://... (no S3, use lifecycle rules do bucket).")
+    print(f"Blobs removidos: {store.cleanup(retention_s)}")
@@ -0,0 +1,87 @@
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # pip install orjson
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pip install msgpack
+    msgpack = None
+
+
+CONTENT_TYPE_HEADER = "content-type"
+SCHEMA_VERSION_HEADER = "schema-version"
+SCHEMA_VERSION = "1"
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+_ALIASES = {
+    "json": JSON,
+    "orjson": JSON,
+    "application/json": JSON,
+    "msgpack": MSGPACK,
+    "application/msgpack": MSGPACK,
+    "application/x-msgpack": MSGPACK,
+}
+
+
+class Codec:
+    """
+    Serialização das mensagens do pipeline, escolhida pelo header content-type.
+    - JSON usa orjson quando instalado (mesmo formato no fio, só mais rápido)
+    - msgpack é binário e bem menor para payloads com históricos grandes
+    - decode() trabalha direto nos bytes de msg.value(), sem passar por str
+    - mensagens sem header são tratadas como JSON (produtores antigos)
+    """
+
+    def __init__(self, name: str = "json"):
+        content_type = _ALIASES.get((name or "json").lower())
+        if content_type is None:
+            raise ValueError(f"Codec '{name}' não suportado.")
+        if content_type == MSGPACK and msgpack is None:
+            raise RuntimeError("Codec msgpack requer 'pip install msgpack'.")
+        self.content_type = content_type
+
+    def headers(self) -> list[tuple[str, bytes]]:
+        return [
+            (CONTENT_TYPE_HEADER, self.content_type.encode("ascii")),
+            (SCHEMA_VERSION_HEADER, SCHEMA_VERSION.encode("ascii")),
+        ]
+
+    def encode(self, data: Any) -> bytes:
+        if self.content_type == MSGPACK:
+            return msgpack.packb(data, use_bin_type=True)
+        return encode_json(data)
+
+    @staticmethod
+    def decode(value: bytes, headers: list[tuple[str, bytes]] | None = None) -> Any:
+        content_type = JSON
+        for k, v in headers or ():
+            if k.lower() == CONTENT_TYPE_HEADER and v:
+                content_type = _ALIASES.get(v.decode("ascii", errors="replace").lower(), JSON)
+                break
+        if content_type == MSGPACK:
+            if msgpack is None:
+                raise RuntimeError("Mensagem msgpack recebida, mas 'msgpack' não está instalado.")
+            return msgpack.unpackb(value, raw=False)
+        return decode_json(value)
+
+
+def encode_json(data: Any) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(data)
+        except TypeError:
+            # tipos que o orjson não serializa (ex.: chaves não-str): cai no json padrão
+            pass
+    return json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+
+def decode_json(value: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(value)
+    return json.loads(value)
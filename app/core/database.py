@@ -1,23 +1,220 @@
+import io
 import os
+import time
+import random
+import hashlib
 import logging
+import re
+import threading
+from collections import OrderedDict
 from contextlib import contextmanager
 from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
 import psycopg2
 from psycopg2 import pool
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_batch
+
+from core import metrics
 
 
 Params = Union[Tuple[Any, ...], List[Any], Dict[str, Any], None]
 
+QUERY_SECONDS = metrics.REGISTRY.histogram("db_query_seconds", "Tempo de execução das consultas por fingerprint (sem a espera pelo pool)")
+QUERY_ERRORS = metrics.REGISTRY.counter("db_query_errors_total", "Consultas que falharam por fingerprint")
+SLOW_QUERIES = metrics.REGISTRY.counter("db_slow_queries_total", "Consultas acima de DB_SLOW_QUERY_MS por fingerprint")
+QUERY_INFO = metrics.REGISTRY.gauge("db_query_info", "Fingerprint → SQL normalizado (valor sempre 1)")
+CHECKOUT_SECONDS = metrics.REGISTRY.histogram("db_pool_checkout_seconds", "Espera por uma conexão do pool")
+POOL_IN_USE = metrics.REGISTRY.gauge("db_pool_in_use", "Conexões do pool emprestadas no momento")
+POOL_MAX = metrics.REGISTRY.gauge("db_pool_max", "Tamanho máximo do pool")
+POOL_EXHAUSTED = metrics.REGISTRY.counter("db_pool_exhausted_total", "Pedidos de conexão recusados com o pool esgotado")
+
+_FP_VALUES = re.compile(r"'(?:[^']|'')*'|%\(\w+\)s|%s|\$\d+|\b\d+(?:\.\d+)?\b")
+_READ_ONLY = re.compile(r"^\s*(SELECT|WITH)\b", re.IGNORECASE)
+_WRITES = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE)\b", re.IGNORECASE)
+_FINGERPRINTS: Dict[str, Tuple[str, str]] = {}
+
+
+def fingerprint(sql: str) -> Tuple[str, str]:
+    """
+    (fingerprint, SQL normalizado): literais e placeholders viram ?, espaços
+    colapsados. Mesma consulta com valores diferentes → mesmo fingerprint.
+    """
+    fp = _FINGERPRINTS.get(sql)
+    if fp is None:
+        norm = " ".join(_FP_VALUES.sub("?", sql).split())
+        fp = (hashlib.sha1(norm.encode("utf-8")).hexdigest()[:12], norm)
+        if len(_FINGERPRINTS) >= 2048:  # SQL dinâmico não deve crescer sem limite
+            _FINGERPRINTS.clear()
+        _FINGERPRINTS[sql] = fp
+    return fp
+
+
+def redact(params: Params) -> Any:
+    """Parâmetros para log sem os valores: só tipo (e tamanho das strings)."""
+    def one(v: Any) -> str:
+        if isinstance(v, str):
+            return f"str[{len(v)}]"
+        return type(v).__name__
+    if isinstance(params, dict):
+        return {k: one(v) for k, v in params.items()}
+    if params is None:
+        return None
+    return [one(v) for v in params]
+
+
+class QueryStats:
+    """
+    Instrumentação do Database (core e provide):
+    - espera pelo pool (checkout) separada do tempo de execução
+    - histogramas por fingerprint da consulta (db_query_seconds{query=...})
+    - conexões em uso, tamanho do pool e pedidos recusados com o pool esgotado
+    - log das consultas acima de slow_ms, com parâmetros redigidos
+    - EXPLAIN (ANALYZE, BUFFERS) de uma fração (explain_sample) das consultas
+      lentas de leitura (só SELECT/WITH sem escrita: ANALYZE executa de novo)
+    """
+
+    def __init__(self, name: str = "postgres", slow_ms: float = 250.0, explain_sample: float = 0.0):
+        self.name = name
+        self.slow_ms = slow_ms
+        self.explain_sample = explain_sample
+        self._in_use = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, name: str = "postgres") -> "QueryStats":
+        """DB_SLOW_QUERY_MS (padrão 250) e DB_EXPLAIN_SAMPLE (0..1, padrão 0 = desligado)."""
+        return cls(
+            name=name,
+            slow_ms=float(os.getenv("DB_SLOW_QUERY_MS", "250")),
+            explain_sample=float(os.getenv("DB_EXPLAIN_SAMPLE", "0")),
+        )
+
+    def pool_size(self, maxconn: int) -> None:
+        POOL_MAX.set(maxconn, db=self.name)
+
+    @contextmanager
+    def checkout(self, conn_pool):
+        """Empresta uma conexão do pool medindo a espera; devolve ao sair."""
+        t0 = time.perf_counter()
+        try:
+            conn = conn_pool.getconn()
+        except pool.PoolError:
+            POOL_EXHAUSTED.inc(db=self.name)
+            raise
+        CHECKOUT_SECONDS.observe(time.perf_counter() - t0, db=self.name)
+        with self._lock:
+            self._in_use += 1
+            POOL_IN_USE.set(self._in_use, db=self.name)
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                self._in_use -= 1
+                POOL_IN_USE.set(self._in_use, db=self.name)
+            conn_pool.putconn(conn)
+
+    @contextmanager
+    def query(self, conn, sql: str, params: Params = None):
+        """Mede a execução de uma consulta; ao final registra, loga se lenta e amostra EXPLAIN."""
+        fp, norm = fingerprint(sql)
+        t0 = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            QUERY_ERRORS.inc(db=self.name, query=fp)
+            raise
+        finally:
+            elapsed = time.perf_counter() - t0
+            QUERY_SECONDS.observe(elapsed, db=self.name, query=fp)
+        if elapsed * 1000 < self.slow_ms:
+            return
+        SLOW_QUERIES.inc(db=self.name, query=fp)
+        QUERY_INFO.set(1, db=self.name, query=fp, sql=norm[:200])
+        print(f"[DB] consulta lenta {elapsed * 1000:.0f} ms q={fp}: {norm[:300]} params={redact(params)}")
+        if self.explain_sample > 0 and random.random() < self.explain_sample:
+            self._explain(conn, fp, sql, params)
+
+    def _explain(self, conn, fp: str, sql: str, params: Params) -> None:
+        if not _READ_ONLY.match(sql) or _WRITES.search(sql):
+            return
+        try:
+            # cursor separado: o resultado da consulta original já está no cliente
+            with conn.cursor() as cur:
+                cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, params)
+                plan = "\n".join(r[0] for r in cur.fetchall())
+            print(f"[DB] plano q={fp}:\n{plan}")
+        except Exception as e:
+            conn.rollback()
+            print(f"[DB] EXPLAIN falhou q={fp}: {e}")
+
+
+def _copy_field(value: Any) -> str:
+    """Valor no formato texto do COPY: None → \\N, escapes de \\, tab e quebras de linha."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def is_transient_error(exc: BaseException) -> bool:
+    """
+    Erros de conexão/pool que valem uma nova tentativa (queda do Postgres,
+    conexão derrubada, pool esgotado) — ao contrário de erros de SQL/dados.
+    """
+    return isinstance(exc, (psycopg2.OperationalError, psycopg2.InterfaceError, pool.PoolError))
+
+
+_PLACEHOLDER = re.compile(r"'(?:[^']|'')*'|%%|%s|%\((\w+)\)s")
+
+
+def to_positional(sql: str) -> Tuple[str, List[Optional[str]]]:
+    """
+    Converte placeholders do psycopg2 para os do PREPARE:
+    %s → $1..$n, %(nome)s → $k (o mesmo nome reaproveita o número), %% → %.
+    Literais entre aspas simples ficam como estão.
+    Retorna (sql, nomes), com None nas posições de %s.
+    """
+    names: List[Optional[str]] = []
+    index: Dict[str, int] = {}
+
+    def sub(m: "re.Match[str]") -> str:
+        tok = m.group(0)
+        if tok.startswith("'"):
+            return tok.replace("%%", "%")
+        if tok == "%%":
+            return "%"
+        if tok == "%s":
+            names.append(None)
+            return f"${len(names)}"
+        name = m.group(1)
+        if name not in index:
+            names.append(name)
+            index[name] = len(names)
+        return f"${index[name]}"
+
+    return _PLACEHOLDER.sub(sub, sql), names
+
 
 class Database:
     """
     Wrapper simples para PostgreSQL com pool de conexões e utilitários de consulta.
     - Usa ThreadedConnectionPool
-    - Métodos: execute, fetchone, fetchall, fetchval
+    - Métodos: execute, execute_returning, executemany, copy_rows, fetchone, fetchall, fetchval
     - transaction() para blocos atômicos
     - Opção de cursor em dict (RealDictCursor)
+    - Instrumentado por QueryStats (checkout, tempo por fingerprint, log de lentas, EXPLAIN amostrado)
+    - prepare=True nas consultas quentes: PREPARE nomeado feito sob demanda em
+      cada conexão do pool e reaproveitado (EXECUTE) nas chamadas seguintes,
+      sem parse/planejamento a cada mensagem; até statement_cache_size por
+      conexão (LRU, com DEALLOCATE). SQL que o Postgres não consegue preparar
+      (tipo de parâmetro ambíguo) cai para a execução normal.
     """
 
     def __init__(
@@ -30,6 +227,8 @@ class Database:
         minconn: int = 1,
         maxconn: int = 10,
         use_dict_cursor: bool = True,
+        statement_cache_size: int = 64,
+        stats: Optional[QueryStats] = None,
     ):
         self.host = host or os.getenv("PGHOST", "localhost")
         self.port = port or int(os.getenv("PGPORT", "5432"))
@@ -38,6 +237,13 @@ class Database:
         self.password = password or os.getenv("PGPASSWORD", "")
 
         self.use_dict_cursor = use_dict_cursor
+        self.statement_cache_size = statement_cache_size
+        self._statements: Dict[str, Tuple[str, str, List[Optional[str]]]] = {}
+        self._prepared: Dict[int, Tuple[Any, "OrderedDict[str, str]"]] = {}
+        self._unpreparable: set = set()
+        self._stmt_lock = threading.Lock()
+        self.stats = stats or QueryStats.from_env(self.database)
+        self.stats.pool_size(maxconn)
 
         self._pool: pool.ThreadedConnectionPool = psycopg2.pool.ThreadedConnectionPool(
             minconn=minconn,
@@ -55,47 +261,149 @@ class Database:
 
     @contextmanager
     def _get_conn_cursor(self):
-        conn = self._pool.getconn()
-        try:
+        with self.stats.checkout(self._pool) as conn:
             cur = conn.cursor(cursor_factory=self._cursor_factory())
             try:
                 yield conn, cur
             finally:
                 cur.close()
-        finally:
-            self._pool.putconn(conn)
 
-    def execute(self, sql: str, params: Params = None) -> int:
+    def _query(self, conn, cur, sql: str, params: Params, prepare: bool) -> None:
+        with self.stats.query(conn, sql, params):
+            self._run(conn, cur, sql, params, prepare)
+
+    def _statement(self, sql: str) -> Tuple[str, str, List[Optional[str]]]:
+        """(nome, sql com $n, nomes dos parâmetros), calculado uma vez por SQL."""
+        stmt = self._statements.get(sql)
+        if stmt is None:
+            positional, names = to_positional(sql)
+            name = "stmt_" + hashlib.sha1(sql.encode("utf-8")).hexdigest()[:16]
+            stmt = self._statements[sql] = (name, positional, names)
+        return stmt
+
+    def _conn_statements(self, conn) -> "OrderedDict[str, str]":
+        """Statements já preparados nesta conexão (cada conexão é uma sessão no Postgres)."""
+        with self._stmt_lock:
+            entry = self._prepared.get(id(conn))
+            if entry is None or entry[0] is not conn:
+                entry = self._prepared[id(conn)] = (conn, OrderedDict())
+            return entry[1]
+
+    def _run(self, conn, cur, sql: str, params: Params, prepare: bool, retry: bool = True) -> None:
+        if not prepare or sql in self._unpreparable:
+            cur.execute(sql, params)
+            return
+        name, positional, names = self._statement(sql)
+        if isinstance(params, dict):
+            args = [params[n] for n in names]
+        else:
+            args = list(params or ())
+        cache = self._conn_statements(conn)
+        if name in cache:
+            cache.move_to_end(name)
+        else:
+            try:
+                cur.execute(f"PREPARE {name} AS {positional}")
+            except psycopg2.Error as e:
+                if is_transient_error(e):
+                    raise
+                conn.rollback()
+                self._unpreparable.add(sql)
+                print(f"PREPARE falhou, usando execução normal: {e}")
+                cur.execute(sql, params)
+                return
+            cache[name] = sql
+            while len(cache) > self.statement_cache_size:
+                old, _ = cache.popitem(last=False)
+                cur.execute(f"DEALLOCATE {old}")
+        try:
+            if args:
+                cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(args))})", args)
+            else:
+                cur.execute(f"EXECUTE {name}")
+        except psycopg2.Error as e:
+            # 26000: o statement sumiu do servidor (DISCARD ALL, reconexão) → prepara de novo
+            if getattr(e, "pgcode", None) != "26000" or not retry:
+                raise
+            conn.rollback()
+            cache.pop(name, None)
+            self._run(conn, cur, sql, params, prepare, retry=False)
+
+    def execute(self, sql: str, params: Params = None, *, prepare: bool = False) -> int:
         """
         Executa DML (INSERT/UPDATE/DELETE) com commit automático.
         Retorna rowcount.
         """
         with self._get_conn_cursor() as (conn, cur):
-            cur.execute(sql, params)
+            self._query(conn, cur, sql, params, prepare)
             conn.commit()
             return cur.rowcount
 
-    def fetchone(self, sql: str, params: Params = None):
+    def execute_returning(self, sql: str, params: Params = None, *, prepare: bool = False):
+        """
+        Executa DML com RETURNING e commit automático, numa ida só ao banco.
+        Retorna a primeira linha devolvida (ou None).
+        """
+        with self._get_conn_cursor() as (conn, cur):
+            self._query(conn, cur, sql, params, prepare)
+            row = cur.fetchone()
+            conn.commit()
+            return row
+
+    def executemany(self, sql: str, params_seq: Iterable[Params], page_size: int = 100) -> None:
+        """
+        Executa o mesmo DML para vários parâmetros, em lotes de page_size
+        comandos por ida ao banco (execute_batch), com um único commit.
+        """
+        with self._get_conn_cursor() as (conn, cur):
+            with self.stats.query(conn, sql):
+                execute_batch(cur, sql, list(params_seq), page_size=page_size)
+            conn.commit()
+
+    def copy_rows(self, table: str, columns: List[str], rows: Iterable[Iterable[Any]]) -> int:
+        """
+        Carga em massa via COPY ... FROM STDIN (formato texto), com commit.
+        Para milhares de linhas é bem mais rápido que INSERTs. Retorna rowcount.
+        """
+        from psycopg2 import sql as pgsql
+
+        buf = io.StringIO()
+        for row in rows:
+            buf.write("\t".join(_copy_field(v) for v in row))
+            buf.write("\n")
+        buf.seek(0)
+        stmt = pgsql.SQL("COPY {} ({}) FROM STDIN").format(
+            pgsql.Identifier(*table.split(".")),
+            pgsql.SQL(", ").join(pgsql.Identifier(c) for c in columns),
+        )
+        with self._get_conn_cursor() as (conn, cur):
+            copy_sql = stmt.as_string(conn)
+            with self.stats.query(conn, copy_sql):
+                cur.copy_expert(copy_sql, buf)
+            conn.commit()
+            return cur.rowcount
+
+    def fetchone(self, sql: str, params: Params = None, *, prepare: bool = False):
         """
         Executa SELECT e retorna uma linha (ou None).
         """
-        with self._get_conn_cursor() as (_, cur):
-            cur.execute(sql, params)
+        with self._get_conn_cursor() as (conn, cur):
+            self._query(conn, cur, sql, params, prepare)
             return cur.fetchone()
 
-    def fetchall(self, sql: str, params: Params = None) -> List[Any]:
+    def fetchall(self, sql: str, params: Params = None, *, prepare: bool = False) -> List[Any]:
         """
         Executa SELECT e retorna todas as linhas (lista).
         """
-        with self._get_conn_cursor() as (_, cur):
-            cur.execute(sql, params)
+        with self._get_conn_cursor() as (conn, cur):
+            self._query(conn, cur, sql, params, prepare)
             return cur.fetchall()
 
-    def fetchval(self, sql: str, params: Params = None) -> Any:
+    def fetchval(self, sql: str, params: Params = None, *, prepare: bool = False) -> Any:
         """
         Executa SELECT e retorna o primeiro valor da primeira linha (ou None).
         """
-        row = self.fetchone(sql, params)
+        row = self.fetchone(sql, params, prepare=prepare)
         if row is None:
             return None
         if self.use_dict_cursor:
@@ -113,8 +421,7 @@ class Database:
             cur.execute("...")
         # commit automático; rollback em exceção
         """
-        conn = self._pool.getconn()
-        try:
+        with self.stats.checkout(self._pool) as conn:
             cur = conn.cursor(cursor_factory=self._cursor_factory())
             try:
                 yield cur
@@ -124,8 +431,6 @@ class Database:
                 raise
             finally:
                 cur.close()
-        finally:
-            self._pool.putconn(conn)
 
     def healthcheck(self) -> bool:
         try:
@@ -137,4 +442,6 @@ class Database:
     def close(self):
         if self._pool:
             self._pool.closeall()
+            with self._stmt_lock:
+                self._prepared.clear()
             print("Pool fechado")
@@ -1,5 +1,218 @@
-from confluent_kafka import Producer, Consumer
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, NamedTuple
+from confluent_kafka import Producer, Consumer, KafkaException, TopicPartition
 import json
+import os
+import queue
+import socket
+import threading
+import time
+
+from core import metrics
+from core.codec import Codec
+
+
+CONSUMED = metrics.REGISTRY.counter("kafka_messages_consumed_total", "Mensagens consumidas por tópico")
+PRODUCED = metrics.REGISTRY.counter("kafka_messages_produced_total", "Mensagens produzidas por tópico")
+FAILED = metrics.REGISTRY.counter("kafka_handler_errors_total", "Exceções nos handlers por tópico")
+HANDLER_SECONDS = metrics.REGISTRY.histogram("kafka_handler_seconds", "Latência do handler por tópico")
+PAYLOAD_BYTES = metrics.REGISTRY.histogram(
+    "kafka_payload_bytes", "Tamanho dos payloads por tópico e direção", buckets=metrics.SIZE_BUCKETS,
+)
+CONSUMER_LAG = metrics.REGISTRY.gauge(
+    "kafka_consumer_lag", "High watermark - offset commitado, por partição (statistics.cb)",
+)
+PENDING = metrics.REGISTRY.gauge("kafka_pending_messages", "Mensagens em voo no pool de handlers")
+PAUSED = metrics.REGISTRY.gauge("kafka_consumer_paused", "1 enquanto o consumer está pausado por backpressure")
+MESSAGES_PER_SECOND = metrics.REGISTRY.gauge(
+    "kafka_messages_per_second", "Vazão de consumo por tópico no último intervalo de estatísticas",
+)
+TRANSACTIONS = metrics.REGISTRY.counter("kafka_transactions_total", "Transações do modo exactly-once por resultado")
+TRANSACTION_SIZE = metrics.REGISTRY.histogram(
+    "kafka_transaction_messages", "Mensagens de entrada por transação",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+
+
+class KafkaMessage(NamedTuple):
+    """Mensagem já decodificada entregue pelos caminhos em lote."""
+    topic: str
+    partition: int
+    offset: int
+    key: str | None
+    data: Any
+    headers: dict[str, str] | None = None
+
+
+ORIGINAL_TOPIC_HEADER = "x-original-topic"
+RETRY_ATTEMPT_HEADER = "x-retry-attempt"
+RETRY_NOT_BEFORE_HEADER = "x-retry-not-before"
+ERROR_HEADER = "x-error"
+ERROR_TYPE_HEADER = "x-error-type"
+FAILED_AT_HEADER = "x-failed-at"
+
+# saídas (cliente, Future) dos send() feitos pelo handler que roda nesta thread
+_HANDLER = threading.local()
+
+
+class RetryPolicy:
+    """
+    Retentativas sem bloquear a partição principal:
+      falha → <tópico>.retry.<d1>s → <tópico>.retry.<d2>s → ... → <tópico>.dlq
+    Cada tentativa leva headers com o número da tentativa, o horário mínimo
+    para reprocessar (x-retry-not-before, epoch ms) e o erro.
+    Os tópicos de retry são drenados por KafkaJSON.loop_retry() /
+    start_retry_scheduler(), que devolvem a mensagem ao tópico original.
+    """
+
+    def __init__(self, delays_s: list[int] | tuple[int, ...] = (5, 60), dlq_suffix: str = "dlq"):
+        self.delays_s = [int(d) for d in delays_s]
+        self.dlq_suffix = dlq_suffix
+
+    @classmethod
+    def from_env(cls, var: str = "RETRY_DELAYS_S") -> "RetryPolicy | None":
+        """RETRY_DELAYS_S="5,60" → RetryPolicy((5, 60)); vazio → None (sem retry)."""
+        raw = os.getenv(var, "").strip()
+        if not raw:
+            return None
+        return cls([int(x) for x in raw.split(",") if x.strip()])
+
+    def retry_topic(self, topic: str, delay_s: int) -> str:
+        return f"{topic}.retry.{delay_s}s"
+
+    def retry_topics(self, topic: str) -> list[str]:
+        return [self.retry_topic(topic, d) for d in self.delays_s]
+
+    def dlq_topic(self, topic: str) -> str:
+        return f"{topic}.{self.dlq_suffix}"
+
+
+def instance_transactional_id(prefix: str | None) -> str | None:
+    """
+    transactional.id desta réplica: prefixo + hostname (no Docker, o id do
+    container), para que duas réplicas do mesmo estágio não se cerquem
+    (fencing) uma à outra. KAFKA_TRANSACTIONAL_ID_SUFFIX troca o hostname
+    por um sufixo fixo (ex.: índice do pod num StatefulSet).
+    """
+    if not prefix:
+        return None
+    suffix = os.getenv("KAFKA_TRANSACTIONAL_ID_SUFFIX") or socket.gethostname()
+    return f"{prefix}-{suffix}"
+
+
+def source_id_key(data: Any) -> str | None:
+    """Chave padrão de ordenação: o source_id do cliente, quando existir."""
+    if isinstance(data, dict) and data.get("source_id") is not None:
+        return str(data["source_id"])
+    return None
+
+
+class _OffsetTracker:
+    """
+    Controla, por (tópico, partição), os offsets em voo e devolve o próximo
+    offset commitável só quando todos os anteriores já terminaram.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: dict[tuple[str, int], deque] = {}
+        self._done: dict[tuple[str, int], set] = {}
+
+    def begin(self, topic: str, partition: int, offset: int) -> None:
+        with self._lock:
+            self._inflight.setdefault((topic, partition), deque()).append(offset)
+
+    def complete(self, topic: str, partition: int, offset: int) -> int | None:
+        """Marca offset como concluído; retorna o novo high-water mark contíguo (offset + 1) se avançou."""
+        tp = (topic, partition)
+        with self._lock:
+            pending = self._inflight.get(tp)
+            if not pending:
+                return None
+            done = self._done.setdefault(tp, set())
+            done.add(offset)
+            commit = None
+            while pending and pending[0] in done:
+                done.discard(pending[0])
+                commit = pending.popleft() + 1
+            return commit
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(len(d) for d in self._inflight.values())
+
+    def forget(self, partitions) -> None:
+        with self._lock:
+            for tp in partitions:
+                self._inflight.pop((tp.topic, tp.partition), None)
+                self._done.pop((tp.topic, tp.partition), None)
+
+    def abandon(self) -> dict[tuple[str, int], int]:
+        """Esquece tudo que ficou em voo; devolve o menor offset não concluído por partição."""
+        with self._lock:
+            first = {tp: pending[0] for tp, pending in self._inflight.items() if pending}
+            self._inflight.clear()
+            self._done.clear()
+            return first
+
+
+class _KeyedPool:
+    """
+    Pool de threads com uma fila por "lane": mensagens com a mesma chave
+    caem sempre na mesma lane, então a ordem por chave é preservada.
+    Conclusões voltam por uma fila para a thread do consumer.
+    dispatch(msg) recebe a KafkaMessage inteira.
+    """
+
+    def __init__(self, dispatch, concurrency: int):
+        self._dispatch = dispatch
+        self.size = concurrency
+        self._lanes = [queue.Queue() for _ in range(concurrency)]
+        self.completed: queue.Queue = queue.Queue()
+        self._rr = 0
+        self._threads = [
+            threading.Thread(target=self._run, args=(q,), name=f"KafkaJSON-lane-{i}", daemon=True)
+            for i, q in enumerate(self._lanes)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, key: str | None, msg: KafkaMessage) -> None:
+        if key is None:
+            idx = self._rr
+            self._rr = (self._rr + 1) % len(self._lanes)
+        else:
+            idx = hash(key) % len(self._lanes)
+        self._lanes[idx].put(msg)
+
+    def _run(self, q: queue.Queue) -> None:
+        while True:
+            msg = q.get()
+            try:
+                if msg is None:
+                    return
+                try:
+                    done = self._dispatch(msg) is not False
+                except Exception as e:
+                    print(f"Erro no handler ({msg.topic}[{msg.partition}]@{msg.offset}):", e)
+                    done = True
+                if done:
+                    self.completed.put(msg)
+            finally:
+                q.task_done()
+
+    def join(self) -> None:
+        """Espera todas as lanes esvaziarem."""
+        for q in self._lanes:
+            q.join()
+
+    def shutdown(self) -> None:
+        for q in self._lanes:
+            q.put(None)
+        for t in self._threads:
+            t.join()
+
 
 class KafkaJSON:
     """
@@ -8,57 +221,824 @@ class KafkaJSON:
         k.subscribe("meu-topico")
         k.send("meu-topico", {"hello": "world"})
         k.loop(lambda topic, data: print(topic, data))  # Ctrl+C para parar
+
+    Modo assíncrono (async_send=True ou KAFKA_ASYNC_SEND=1):
+        send() não espera o broker; devolve um Future resolvido no delivery report.
+        O librdkafka agrupa as mensagens (linger_ms / batch_size) e a fila local
+        é limitada por max_in_flight: quando cheia, send() bloqueia até liberar
+        espaço (backpressure) ou estourar send_timeout_s.
+        Chame flush() em pontos de commit e no shutdown (close() já faz isso).
+
+    Offsets só são marcados para commit depois que o callback retorna e os
+    send() que ele fez foram confirmados pelo broker (enable.auto.offset.store=false),
+    então um crash no meio do handler, ou uma saída que não foi entregue,
+    reprocessa a mensagem em vez de perdê-la.
+    Consumo em lote:
+        k.loop_batch(lambda msgs: ..., max_messages=100)  # msgs: list[KafkaMessage]
+    Consumo concorrente (ordem preservada por chave, ex.: source_id):
+        k.loop(on_msg, concurrency=4)
+        Só offsets contíguos já concluídos de cada partição são commitados.
+    Backpressure (max_pending / low_pending):
+        com mais de max_pending mensagens em voo, as partições atribuídas são
+        pausadas (o poll continua, então não há rebalance por handler lento) e
+        só voltam quando o trabalho cai abaixo de low_pending.
+    Chave das mensagens:
+        send() usa key_fn(data) quando key não é informada — por padrão o
+        source_id — então um cliente cai sempre na mesma partição.
+    Estado por partição:
+        dentro do callback, k.partition_state() devolve um dict da partição da
+        mensagem atual (cache quente de perfil, bancos, ...), descartado
+        quando a partição é revogada no rebalance.
+    Retry / DLQ (RetryPolicy):
+        k.loop(on_msg, retry=RetryPolicy((5, 60)))
+        Exceção no handler manda a mensagem para o próximo tópico de retry
+        (ou para a DLQ) e a partição segue andando. Sem retry, o erro é
+        logado e a mensagem é pulada.
+    Serialização (codec="json"|"msgpack" ou KAFKA_CODEC):
+        o formato vai no header content-type; mensagens sem header são lidas como JSON.
+    Métricas (core.metrics):
+        vazão, latência do handler, tamanho de payload e lag por partição
+        (via statistics.cb a cada stats_interval_ms). Expostas em /metrics
+        com METRICS_PORT ou impressas com METRICS_DUMP_INTERVAL_S.
+    Exactly-once (transactional_id=...):
+        loop() passa a consumir em lotes de até transaction_max_messages e,
+        para cada lote, os send() feitos pelos handlers e os offsets de entrada
+        são commitados na mesma transação (send_offsets_to_transaction).
+        Um crash no meio do lote aborta tudo: nada sai duplicado e nada se perde.
+        Consumidores leem só dados commitados (isolation.level=read_committed,
+        padrão do librdkafka). O transactional_id deve ser único por instância
+        (ver instance_transactional_id).
+        A transação também fecha ao passar de transaction_max_s (limitado a um
+        terço de transaction.timeout.ms): o que sobrou do lote volta para a fila
+        e entra na próxima, então handlers lentos (LLM) não estouram o timeout
+        do broker, que abortaria o lote e o reprocessaria para sempre.
     """
-    def __init__(self, broker: str = "localhost:9092", group_id: str = "python-client"):
-        self._producer = Producer({"bootstrap.servers": broker})
+    def __init__(
+        self,
+        broker: str = "localhost:9092",
+        group_id: str = "python-client",
+        *,
+        async_send: bool | None = None,
+        linger_ms: int = 5,
+        batch_size: int = 1_000_000,
+        max_in_flight: int = 100_000,
+        send_timeout_s: float = 30.0,
+        codec: str | None = None,
+        key_fn: Callable[[Any], str | None] = source_id_key,
+        stats_interval_ms: int | None = None,
+        transactional_id: str | None = None,
+        transaction_max_messages: int = 200,
+        transaction_max_s: float = 15.0,
+        transaction_timeout_ms: int = 60_000,
+    ):
+        if async_send is None:
+            async_send = os.getenv("KAFKA_ASYNC_SEND", "0") == "1"
+        self._init_state(
+            group_id,
+            codec=codec or os.getenv("KAFKA_CODEC", "json"),
+            key_fn=key_fn,
+            async_send=async_send,
+            send_timeout_s=send_timeout_s,
+            transactional_id=transactional_id,
+            transaction_max_messages=transaction_max_messages,
+            transaction_max_s=transaction_max_s,
+            transaction_timeout_ms=transaction_timeout_ms,
+        )
+        if stats_interval_ms is None:
+            stats_interval_ms = int(os.getenv("KAFKA_STATS_INTERVAL_MS", "15000"))
+        metrics.start_from_env()
+
+        producer_conf = {
+            "bootstrap.servers": broker,
+            "linger.ms": linger_ms,
+            "batch.size": batch_size,
+            "queue.buffering.max.messages": max_in_flight,
+        }
+        if self.transactional:
+            producer_conf["transactional.id"] = transactional_id
+            producer_conf["transaction.timeout.ms"] = transaction_timeout_ms
+            producer_conf["enable.idempotence"] = True
+        self._producer = Producer(producer_conf)
+        if self.transactional:
+            self._producer.init_transactions(send_timeout_s)
         self._consumer = Consumer({
             "bootstrap.servers": broker,
             "group.id": group_id,
-            "auto.offset.reset": "earliest"
+            "auto.offset.reset": "earliest",
+            "enable.auto.offset.store": False,
+            "enable.auto.commit": not self.transactional,
+            "isolation.level": "read_committed",
+            "statistics.interval.ms": stats_interval_ms,
+            "stats_cb": self._on_stats,
         })
 
-    def send(self, topic: str, data: dict, key: str | None = None) -> None:
-        payload = json.dumps(data, ensure_ascii=False).encode("utf-8")
-        self._producer.produce(topic, value=payload, key=key)
-        self._producer.flush()
+    def _init_state(
+        self,
+        group_id: str,
+        *,
+        codec: str,
+        key_fn: Callable[[Any], str | None],
+        async_send: bool,
+        send_timeout_s: float,
+        transactional_id: str | None = None,
+        transaction_max_messages: int = 200,
+        transaction_max_s: float = 15.0,
+        transaction_timeout_ms: int = 60_000,
+    ) -> None:
+        """Estado comum a qualquer transporte (KafkaJSON e InMemoryKafka); não cria clientes."""
+        self.group_id = group_id
+        self.transactional = transactional_id is not None
+        self.transaction_max_messages = transaction_max_messages
+        # folga para o lote em andamento terminar e o commit chegar antes do timeout do broker
+        self.transaction_max_s = min(transaction_max_s, transaction_timeout_ms / 1000 / 3)
+        # dentro de transação o flush acontece no commit; send() nunca espera o broker
+        self.async_send = async_send or self.transactional
+        self.send_timeout_s = send_timeout_s
+        self.codec = Codec(codec)
+        self.key_fn = key_fn
+        self._partition_state: dict[tuple[str, int], dict] = {}
+        self._local = threading.local()
+        self._retry: RetryPolicy | None = None
+        self._paused = False
+        self._max_pending = 0
+        self._low_pending = 0
+        self._rate_mark: tuple[float, dict] = (time.monotonic(), {})
+        self._pool: _KeyedPool | None = None
+        self._tracker = _OffsetTracker()
+        # lanes em backoff desistem (sem gravar offset) num rebalance ou no close
+        self._closing = threading.Event()
+        self._revoking = False
+        self._interrupt = threading.Event()
+
+    def send(
+        self,
+        topic: str,
+        data: dict,
+        key: str | None = None,
+        on_delivery=None,
+        headers: dict[str, str] | None = None,
+    ) -> Future:
+        """
+        Publica data serializado pelo codec; sem key, usa key_fn(data).
+        Retorna um Future com a mensagem entregue (ou a exceção do delivery report).
+        No modo síncrono o Future já volta resolvido.
+        on_delivery(err, msg) opcional é chamado junto com o delivery report.
+        headers extras são enviados junto com os do codec.
+        """
+        if key is None and self.key_fn is not None:
+            key = self.key_fn(data)
+        payload = self.codec.encode(data)
+        PRODUCED.inc(topic=topic)
+        PAYLOAD_BYTES.observe(len(payload), topic=topic, direction="out")
+        fut: Future = Future()
+
+        def _report(err, msg):
+            if on_delivery is not None:
+                try:
+                    on_delivery(err, msg)
+                except Exception as e:
+                    print("Erro no on_delivery:", e)
+            if err is not None:
+                fut.set_exception(KafkaException(err))
+            else:
+                fut.set_result(msg)
+
+        all_headers = self.codec.headers()
+        if headers:
+            all_headers += [(k, str(v).encode("utf-8")) for k, v in headers.items()]
+        self._produce(topic, payload, key, _report, all_headers)
+        if self.async_send:
+            self._producer.poll(0)
+        else:
+            self._producer.flush()
+        self._track_sent(fut)
+        return fut
+
+    def _track_sent(self, fut: Future) -> None:
+        """Dentro de um handler, guarda o Future para _confirm_sent() antes do offset avançar."""
+        sent = getattr(_HANDLER, "sent", None)
+        if sent is not None:
+            sent.append((self, fut))
+
+    def _confirm_sent(self, sent: list) -> bool:
+        """
+        Espera a entrega das saídas de um handler (flush só dos clientes com
+        Future pendente). False se alguma falhou ou não saiu em send_timeout_s.
+        No modo transacional as saídas vão no commit da transação, junto dos offsets.
+        """
+        if self.transactional:
+            return True
+        pending = {id(client): client for client, fut in sent if not fut.done()}
+        for client in pending.values():
+            client.flush(client.send_timeout_s)
+        for _, fut in sent:
+            try:
+                fut.result(timeout=0)
+            except Exception as e:
+                print(f"Saída do handler não entregue ({type(e).__name__}: {e}); mensagem volta para a fila")
+                return False
+        return True
+
+    def _produce(self, topic: str, payload: bytes, key, report, headers) -> None:
+        """produce() com backpressure: se a fila local estiver cheia, espera o broker drenar."""
+        deadline = time.monotonic() + self.send_timeout_s
+        while True:
+            try:
+                self._producer.produce(topic, value=payload, key=key, headers=headers, on_delivery=report)
+                return
+            except BufferError:
+                if time.monotonic() >= deadline:
+                    raise
+                self._producer.poll(0.1)
+
+    def flush(self, timeout: float | None = None) -> int:
+        """Espera as mensagens pendentes serem entregues. Retorna quantas ficaram na fila."""
+        if timeout is None:
+            return self._producer.flush()
+        return self._producer.flush(timeout)
 
     def subscribe(self, topics: str | list[str]) -> None:
         if isinstance(topics, str):
             topics = [topics]
-        self._consumer.subscribe(topics)
+        self._consumer.subscribe(topics, on_assign=self._on_assign, on_revoke=self._on_revoke)
+
+    def _on_assign(self, consumer, partitions) -> None:
+        print("Partições atribuídas:", [f"{tp.topic}[{tp.partition}]" for tp in partitions])
+        if self._paused:
+            # partições novas chegam ativas; mantém o estado de backpressure
+            try:
+                consumer.pause(partitions)
+            except KafkaException as e:
+                print("Erro ao pausar partições atribuídas:", e)
+
+    def _on_revoke(self, consumer, partitions) -> None:
+        """
+        Antes de perder partições, termina o trabalho em voo e grava os offsets.
+        Lanes presas reentregando para retry/DLQ fora do ar desistem em vez de
+        segurar o rebalance: o offset delas não é gravado e a mensagem volta
+        para quem ficar com a partição (ou, se ela continuar aqui, para esta fila).
+        """
+        if self._pool is not None:
+            self._revoking = True
+            self._interrupt.set()
+            try:
+                self._pool.join()
+            finally:
+                self._revoking = False
+                if not self._closing.is_set():
+                    self._interrupt.clear()
+            self._store_completed()
+            revoked = {(tp.topic, tp.partition) for tp in partitions}
+            for (topic, partition), offset in self._tracker.abandon().items():
+                if (topic, partition) not in revoked:
+                    try:
+                        consumer.seek(TopicPartition(topic, partition, offset))
+                    except KafkaException as e:
+                        print("Erro ao voltar offset abandonado:", e)
+        self._tracker.forget(partitions)
+        for tp in partitions:
+            self._partition_state.pop((tp.topic, tp.partition), None)
+
+    def current_message(self) -> KafkaMessage | None:
+        """Mensagem sendo processada pela thread atual (dentro do callback)."""
+        return getattr(self._local, "msg", None)
+
+    def partition_state(self, topic: str | None = None, partition: int | None = None) -> dict:
+        """
+        Dict de estado da partição informada ou, sem argumentos, da partição
+        da mensagem atual. Vive enquanto a partição estiver atribuída a este consumer.
+        """
+        if topic is None or partition is None:
+            msg = self.current_message()
+            if msg is None:
+                raise RuntimeError("partition_state() sem argumentos só funciona dentro do callback.")
+            topic, partition = msg.topic, msg.partition
+        return self._partition_state.setdefault((topic, partition), {})
+
+    def _dispatch(self, callback, msg: KafkaMessage, *, persistent: bool = False) -> bool:
+        """
+        Roda o handler. Retorna False quando o offset não pode avançar: as
+        saídas do handler não foram entregues, ou ele falhou e a cópia para
+        retry/DLQ não foi entregue.
+        persistent=True (lanes do pool) reprocessa com backoff até conseguir,
+        ou até um rebalance/close pedir a partição de volta.
+        """
+        self._local.msg = msg
+        t0 = time.perf_counter()
+        backoff = 1.0
+        try:
+            while not self._handle(callback, msg):
+                if not persistent or self._giving_up():
+                    return False
+                self._interrupt.wait(backoff)
+                backoff = min(30.0, backoff * 2)
+                if self._giving_up():
+                    print(f"Desistindo de {msg.topic}[{msg.partition}]@{msg.offset}: partição em rebalance ou consumer fechando")
+                    return False
+            return True
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - t0, topic=msg.topic)
+            self._local.msg = None
+
+    def _giving_up(self) -> bool:
+        return self._revoking or self._closing.is_set()
+
+    def _handle(self, callback, msg: KafkaMessage) -> bool:
+        """Uma tentativa do _dispatch: handler + confirmação das saídas (ou retry/DLQ)."""
+        _HANDLER.sent = sent = []
+        error = None
+        try:
+            callback(msg.topic, msg.data)
+        except Exception as e:
+            error = e
+        finally:
+            _HANDLER.sent = None
+        if error is None:
+            return self._confirm_sent(sent)
+        FAILED.inc(topic=msg.topic)
+        if self._retry is None:
+            print(f"Erro no handler ({msg.topic}[{msg.partition}]@{msg.offset}):", error)
+            return True
+        return self._route_failure(msg, error)
+
+    def _on_stats(self, stats_json: str) -> None:
+        """statistics.cb do librdkafka: lag por partição e vazão por tópico."""
+        try:
+            stats = json.loads(stats_json)
+        except ValueError:
+            return
+        for topic, t in (stats.get("topics") or {}).items():
+            for pid, p in (t.get("partitions") or {}).items():
+                if pid == "-1" or not p.get("fetch_state") or p.get("fetch_state") == "none":
+                    continue
+                hi, committed = p.get("hi_offset", -1), p.get("committed_offset", -1)
+                if hi >= 0 and committed >= 0:
+                    CONSUMER_LAG.set(max(0, hi - committed), topic=topic, partition=pid, group=self.group_id)
+
+        now = time.monotonic()
+        last_t, last_counts = self._rate_mark
+        counts = {dict(k).get("topic"): v for _, k, v in CONSUMED.samples()}
+        elapsed = now - last_t
+        if elapsed > 0:
+            for topic, v in counts.items():
+                MESSAGES_PER_SECOND.set((v - last_counts.get(topic, 0.0)) / elapsed, topic=topic)
+        self._rate_mark = (now, counts)
+
+    def _route_failure(self, msg: KafkaMessage, exc: Exception) -> bool:
+        """
+        Publica a mensagem que falhou no próximo tópico de retry ou na DLQ.
+        Retorna True só com a entrega confirmada (delivery report sem erro).
+        """
+        headers = msg.headers or {}
+        attempt = int(headers.get(RETRY_ATTEMPT_HEADER, "0") or 0)
+        original = headers.get(ORIGINAL_TOPIC_HEADER) or msg.topic
+        now_ms = int(time.time() * 1000)
+        out = {
+            ORIGINAL_TOPIC_HEADER: original,
+            ERROR_HEADER: str(exc)[:1000],
+            ERROR_TYPE_HEADER: type(exc).__name__,
+            FAILED_AT_HEADER: now_ms,
+        }
+        if attempt < len(self._retry.delays_s):
+            delay = self._retry.delays_s[attempt]
+            out[RETRY_ATTEMPT_HEADER] = attempt + 1
+            out[RETRY_NOT_BEFORE_HEADER] = now_ms + delay * 1000
+            target = self._retry.retry_topic(original, delay)
+        else:
+            out[RETRY_ATTEMPT_HEADER] = attempt
+            target = self._retry.dlq_topic(original)
+        print(f"Falha em {msg.topic}[{msg.partition}]@{msg.offset} ({type(exc).__name__}: {exc}) → {target}")
+        try:
+            fut = self.send(target, msg.data, key=msg.key, headers=out)
+            if not self.transactional:
+                # o offset de entrada só avança com a cópia confirmada pelo broker
+                # (no modo transacional a cópia vai na mesma transação dos offsets)
+                self.flush(self.send_timeout_s)
+                fut.result(timeout=0)
+        except Exception as e:
+            print(f"Não foi possível publicar em {target} ({type(e).__name__}: {e}); mensagem volta para a fila")
+            return False
+        return True
+
+    def _to_message(self, msg) -> KafkaMessage:
+        CONSUMED.inc(topic=msg.topic())
+        PAYLOAD_BYTES.observe(len(msg.value() or b""), topic=msg.topic(), direction="in")
+        return KafkaMessage(
+            msg.topic(), msg.partition(), msg.offset(), self._decode_key(msg), self._decode(msg),
+            self._decode_headers(msg),
+        )
+
+    @staticmethod
+    def _decode_headers(msg) -> dict[str, str]:
+        return {
+            k: (v.decode("utf-8", errors="replace") if isinstance(v, bytes) else str(v))
+            for k, v in (msg.headers() or ())
+            if v is not None
+        }
+
+    @staticmethod
+    def _decode(msg) -> Any:
+        try:
+            return Codec.decode(msg.value(), msg.headers())
+        except Exception:
+            print('decode error')
+            return msg.value().decode("utf-8", errors="replace")
+
+    @staticmethod
+    def _decode_key(msg) -> str | None:
+        key = msg.key()
+        if key is None:
+            return None
+        return key.decode("utf-8", errors="replace") if isinstance(key, bytes) else str(key)
 
     def poll_once(self, callback, timeout: float = 1.0) -> bool:
         """Faz um poll e chama callback(topic, data_json). Retorna True se processou algo."""
         msg = self._consumer.poll(timeout)
+        # serve delivery reports pendentes do modo assíncrono
+        self._producer.poll(0)
         if msg is None:
             return False
         if msg.error():
             print("Erro:", msg.error())
             return False
-        try:
-            data = json.loads(msg.value().decode("utf-8"))
-        except Exception:
-            print('json decode error')
-            data = msg.value().decode("utf-8")
-        callback(msg.topic(), data)
+        if self._dispatch(callback, self._to_message(msg)):
+            self._consumer.store_offsets(message=msg)
+        else:
+            # retry/DLQ fora do ar: reentrega a mesma mensagem depois de uma pausa
+            self._consumer.seek(TopicPartition(msg.topic(), msg.partition(), msg.offset()))
+            time.sleep(1.0)
         return True
 
-    def loop(self, callback, timeout: float = 1.0) -> None:
+    def consume_batch(self, max_messages: int = 100, timeout: float = 1.0) -> list[KafkaMessage]:
+        """
+        Busca até max_messages de uma vez (Consumer.consume) e devolve já decodificadas.
+        Não commita nada: use commit(msgs) depois de processar.
+        """
+        raw = self._consumer.consume(num_messages=max_messages, timeout=timeout)
+        self._producer.poll(0)
+        out: list[KafkaMessage] = []
+        for msg in raw:
+            if msg.error():
+                print("Erro:", msg.error())
+                continue
+            out.append(self._to_message(msg))
+        return out
+
+    @staticmethod
+    def _next_offsets(msgs: list[KafkaMessage]) -> list[TopicPartition]:
+        """Maior offset + 1 por (tópico, partição) — o formato que o commit espera."""
+        last: dict[tuple[str, int], int] = {}
+        for m in msgs:
+            tp = (m.topic, m.partition)
+            if m.offset > last.get(tp, -1):
+                last[tp] = m.offset
+        return [TopicPartition(t, p, o + 1) for (t, p), o in last.items()]
+
+    def commit(self, msgs: list[KafkaMessage]) -> None:
+        """
+        Commit síncrono dos offsets de um lote já processado.
+        Faz flush do producer antes, para não commitar entrada cujo resultado ainda não saiu.
+        """
+        if not msgs:
+            return
+        self.flush()
+        self._consumer.commit(offsets=self._next_offsets(msgs), asynchronous=False)
+
+    def _rewind(self, msgs: list[KafkaMessage]) -> None:
+        """Volta cada partição para o primeiro offset do lote (reentrega após falha)."""
+        first: dict[tuple[str, int], int] = {}
+        for m in msgs:
+            tp = (m.topic, m.partition)
+            if tp not in first or m.offset < first[tp]:
+                first[tp] = m.offset
+        for (t, p), o in first.items():
+            try:
+                self._consumer.seek(TopicPartition(t, p, o))
+            except Exception as e:
+                print("Erro ao voltar offset:", e)
+
+    def loop_batch(
+        self,
+        callback,
+        max_messages: int = 100,
+        timeout: float = 1.0,
+        *,
+        retry: RetryPolicy | None = None,
+    ) -> None:
+        """
+        Chama callback(list[KafkaMessage]) por lote e só commita depois que ele retorna.
+        Se o callback levantar exceção:
+        - com retry, cada mensagem do lote vai para o tópico de retry/DLQ e o lote é commitado;
+        - sem retry, o lote volta para a fila e é reentregue após um backoff
+          exponencial (1s, 2s, ... até 30s), zerado no primeiro lote bem-sucedido.
+        """
+        self._retry = retry
+        backoff = 0.0
         try:
             while True:
-                self.poll_once(callback, timeout)
+                msgs = self.consume_batch(max_messages, timeout)
+                if not msgs:
+                    continue
+                backoff = self._run_batch(callback, msgs, backoff)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def _run_batch(self, callback, msgs: list[KafkaMessage], backoff: float) -> float:
+        """Um lote do loop_batch; devolve o backoff para a próxima falha."""
+        _HANDLER.sent = sent = []
+        error = None
+        try:
+            with HANDLER_SECONDS.time(topic=msgs[0].topic):
+                callback(msgs)
+        except Exception as e:
+            error = e
+        finally:
+            _HANDLER.sent = None
+        if error is not None:
+            FAILED.inc(len(msgs), topic=msgs[0].topic)
+            print(f"Erro no lote de {len(msgs)} mensagens ({type(error).__name__}: {error})")
+            # sem retry, ou com a cópia para retry/DLQ não entregue, o lote volta para a fila
+            redeliver = self._retry is None or not all([self._route_failure(m, error) for m in msgs])
+        else:
+            redeliver = not self._confirm_sent(sent)
+        if redeliver:
+            backoff = min(30.0, backoff * 2 or 1.0)
+            print(f"Lote volta para a fila; reentrega em {backoff:.0f}s")
+            self._rewind(msgs)
+            time.sleep(backoff)
+            return backoff
+        self.commit(msgs)
+        return 0.0
+
+    def loop(
+        self,
+        callback,
+        timeout: float = 1.0,
+        *,
+        concurrency: int = 1,
+        key_fn: Callable[[Any], str | None] = source_id_key,
+        retry: RetryPolicy | None = None,
+        max_pending: int | None = None,
+        low_pending: int | None = None,
+    ) -> None:
+        """
+        Chama callback(topic, data) para cada mensagem até Ctrl+C.
+        Com concurrency > 1 os handlers rodam num pool de threads: a chave da
+        mensagem (ou key_fn(data)) escolhe a lane, preservando a ordem por chave.
+        Com retry, mensagens cujo handler levanta exceção vão para os tópicos de retry/DLQ.
+        max_pending limita o trabalho em voo (padrão 4 × concurrency) pausando o
+        consumer; informá-lo com concurrency=1 também tira o handler da thread do poll.
+        No modo transacional o consumo é em lotes (ver _loop_transactional) e
+        max_pending é limitado pelo próprio tamanho do lote.
+        """
+        self._retry = retry
+        try:
+            if self.transactional:
+                if concurrency > 1:
+                    self._pool = _KeyedPool(lambda m: self._dispatch(callback, m, persistent=True), concurrency)
+                while True:
+                    self._loop_transactional_once(callback, key_fn, timeout)
+            elif concurrency <= 1 and max_pending is None:
+                while True:
+                    self.poll_once(callback, timeout)
+            else:
+                concurrency = max(1, concurrency)
+                self._max_pending = max_pending or 4 * concurrency
+                self._low_pending = low_pending if low_pending is not None else self._max_pending // 2
+                self._pool = _KeyedPool(lambda m: self._dispatch(callback, m, persistent=True), concurrency)
+                while True:
+                    self._poll_concurrent(key_fn, timeout)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def _loop_transactional_once(self, callback, key_fn, timeout: float) -> None:
+        """
+        Um lote = uma transação: handlers (no pool, se houver) → offsets →
+        commit. Erro abortável descarta as saídas e volta os offsets do lote.
+        Passado transaction_max_s, para de despachar: commita o que já foi
+        processado e volta o restante do lote para a próxima transação.
+        """
+        msgs = self.consume_batch(self.transaction_max_messages, timeout)
+        if not msgs:
+            return
+        deadline = time.monotonic() + self.transaction_max_s
+        self._begin_transaction()
+        try:
+            # em fatias do tamanho do pool, checando o prazo entre elas
+            step = 1 if self._pool is None else self._pool.size
+            done = 0
+            while done < len(msgs) and (done == 0 or time.monotonic() < deadline):
+                chunk = msgs[done:done + step]
+                if self._pool is None:
+                    finished = sum(self._dispatch(callback, m, persistent=True) for m in chunk)
+                else:
+                    for m in chunk:
+                        self._pool.submit(m.key or key_fn(m.data), m)
+                    self._pool.join()
+                    finished = 0
+                    while not self._pool.completed.empty():
+                        self._pool.completed.get_nowait()
+                        finished += 1
+                if finished < len(chunk):
+                    # alguma lane desistiu (close): nada do lote pode ser commitado
+                    self._abort(msgs)
+                    return
+                done += len(chunk)
+            if done < len(msgs):
+                print(f"Transação passou de {self.transaction_max_s:.1f}s: commitando {done}/{len(msgs)} mensagens")
+                self._rewind(msgs[done:])
+                msgs = msgs[:done]
+            self._send_offsets_to_transaction(msgs)
+            self._commit_transaction()
+        except KafkaException as e:
+            err = e.args[0] if e.args else None
+            if err is not None and hasattr(err, "txn_requires_abort") and not err.txn_requires_abort():
+                raise
+            print(f"Abortando transação de {len(msgs)} mensagens:", e)
+            self._abort(msgs)
+            return
+        except BaseException:
+            # Ctrl+C ou erro inesperado no meio do lote: nada do lote fica visível
+            self._abort(msgs)
+            raise
+        TRANSACTIONS.inc(result="commit")
+        TRANSACTION_SIZE.observe(len(msgs))
+
+    def _begin_transaction(self) -> None:
+        self._producer.begin_transaction()
+
+    def _send_offsets_to_transaction(self, msgs: list[KafkaMessage]) -> None:
+        self._producer.send_offsets_to_transaction(
+            self._next_offsets(msgs), self._consumer.consumer_group_metadata(), self.send_timeout_s,
+        )
+
+    def _commit_transaction(self) -> None:
+        """commit_transaction() repetindo enquanto o erro for retriable."""
+        while True:
+            try:
+                self._producer.commit_transaction(self.send_timeout_s)
+                return
+            except KafkaException as e:
+                err = e.args[0] if e.args else None
+                if err is None or not err.retriable():
+                    raise
+                print("Commit da transação falhou (retriable), tentando de novo:", e)
+
+    def _abort(self, msgs: list[KafkaMessage]) -> None:
+        TRANSACTIONS.inc(result="abort")
+        try:
+            self._abort_transaction()
+        except KafkaException as e:
+            print("Erro ao abortar transação:", e)
+        self._rewind(msgs)
+
+    def _abort_transaction(self) -> None:
+        self._producer.abort_transaction(self.send_timeout_s)
+
+    def _poll_concurrent(self, key_fn, timeout: float) -> None:
+        # pausado, o poll só serve para heartbeat: volta rápido para ver as conclusões
+        msg = self._consumer.poll(min(timeout, 0.05) if self._paused else timeout)
+        self._producer.poll(0)
+        self._store_completed()
+        self._apply_backpressure()
+        if msg is None:
+            return
+        if msg.error():
+            print("Erro:", msg.error())
+            return
+        km = self._to_message(msg)
+        self._tracker.begin(km.topic, km.partition, km.offset)
+        self._pool.submit(km.key or key_fn(km.data), km)
+        self._apply_backpressure()
+
+    def _apply_backpressure(self) -> None:
+        """Pausa as partições acima de max_pending e retoma abaixo de low_pending."""
+        pending = self._tracker.pending()
+        PENDING.set(pending, group=self.group_id)
+        if not self._paused and pending >= self._max_pending:
+            self._set_paused(True)
+            print(f"Backpressure: {pending} mensagens em voo, pausando consumo")
+        elif self._paused and pending <= self._low_pending:
+            self._set_paused(False)
+            print(f"Backpressure: {pending} mensagens em voo, retomando consumo")
+
+    def _set_paused(self, paused: bool) -> None:
+        try:
+            assignment = self._consumer.assignment()
+            if paused:
+                self._consumer.pause(assignment)
+            else:
+                self._consumer.resume(assignment)
+        except KafkaException as e:
+            print("Erro ao pausar/retomar partições:", e)
+            return
+        self._paused = paused
+        PAUSED.set(1 if paused else 0, group=self.group_id)
+
+    def _store_completed(self) -> None:
+        """Drena conclusões das lanes e grava o high-water mark contíguo de cada partição."""
+        if self._pool is None:
+            return
+        while True:
+            try:
+                m = self._pool.completed.get_nowait()
+            except queue.Empty:
+                return
+            commit = self._tracker.complete(m.topic, m.partition, m.offset)
+            if commit is not None:
+                try:
+                    self._consumer.store_offsets(offsets=[TopicPartition(m.topic, m.partition, commit)])
+                except KafkaException as e:
+                    # partição pode ter sido revogada nesse meio tempo
+                    print("Erro ao gravar offset:", e)
+
+    def loop_retry(self, timeout: float = 1.0) -> None:
+        """
+        Scheduler dos tópicos de retry (já inscritos via subscribe()).
+        Mensagem ainda não vencida: volta o offset e pausa só aquela partição
+        até x-retry-not-before. Vencida: republica no tópico original com os
+        mesmos headers (o contador de tentativas segue junto).
+        """
+        paused: dict[tuple[str, int], float] = {}
+        try:
+            while True:
+                now = time.time()
+                for tp, resume_at in list(paused.items()):
+                    if resume_at <= now:
+                        paused.pop(tp)
+                        try:
+                            self._consumer.resume([TopicPartition(*tp)])
+                        except KafkaException as e:
+                            print("Erro ao retomar partição:", e)
+                wait = min([timeout] + [max(0.0, at - now) for at in paused.values()])
+                msg = self._consumer.poll(wait)
+                self._producer.poll(0)
+                if msg is None:
+                    continue
+                if msg.error():
+                    print("Erro:", msg.error())
+                    continue
+                headers = self._decode_headers(msg)
+                not_before = int(headers.get(RETRY_NOT_BEFORE_HEADER, "0") or 0) / 1000
+                if not_before > time.time():
+                    tp = TopicPartition(msg.topic(), msg.partition(), msg.offset())
+                    self._consumer.pause([tp])
+                    self._consumer.seek(tp)
+                    paused[(msg.topic(), msg.partition())] = not_before
+                    continue
+                original = headers.get(ORIGINAL_TOPIC_HEADER)
+                if not original:
+                    print(f"Mensagem de retry sem {ORIGINAL_TOPIC_HEADER}, descartando:", msg.topic(), msg.offset())
+                else:
+                    self._produce(original, msg.value(), msg.key(), None, msg.headers())
+                    self.flush(self.send_timeout_s)
+                self._consumer.store_offsets(message=msg)
         except KeyboardInterrupt:
             pass
         finally:
             self.close()
 
     def close(self) -> None:
+        self._closing.set()
+        self._interrupt.set()
         try:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._store_completed()
+                self._pool = None
             self._consumer.close()
         finally:
             self._producer.flush()
 
 
+def send_json(k, topic: str, obj: dict, key: str | None = None):
+    """
+    Helper de produção compartilhado pelos estágios: aceita clientes que
+    expõem send(...) ou publish(...). A chave padrão (source_id) vem do KafkaJSON.
+    """
+    if hasattr(k, "send"):
+        return k.send(topic, obj, key=key)
+    if hasattr(k, "publish"):
+        return k.publish(topic, obj)
+    raise AttributeError("KafkaJSON não possui 'send' nem 'publish'.")
+
+
+def start_retry_scheduler(broker: str, group_id: str, topic: str, policy: RetryPolicy) -> threading.Thread:
+    """
+    Sobe, numa thread daemon, o scheduler que devolve as mensagens dos
+    tópicos de retry de `topic` para ele quando o delay vence.
+    """
+    k = KafkaJSON(broker=broker, group_id=f"{group_id}-retry")
+    k.subscribe(policy.retry_topics(topic))
+    t = threading.Thread(target=k.loop_retry, name=f"RetryScheduler-{topic}", daemon=True)
+    t.start()
+    return t
+
+
 if __name__ == "__main__":
     def on_msg(topic, data):
         print("[MSG]", topic, data)
@@ -1,12 +1,737 @@
 import requests
+import asyncio
+import contextlib
+import contextvars
+import hashlib
 import json
+import os
 import re
-from typing import Optional, Dict, Any, List
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Optional, Dict, Any, Iterator, List, Sequence, Tuple, Union
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from core import metrics
+
+
+CACHE_REQUESTS = metrics.REGISTRY.counter("llm_cache_requests_total", "Consultas ao cache de LLM por camada e resultado")
+BREAKER_STATE = metrics.REGISTRY.gauge("llm_breaker_state", "Estado do circuit breaker por endpoint (0=fechado, 1=meio-aberto, 2=aberto)")
+BREAKER_REJECTED = metrics.REGISTRY.counter("llm_breaker_rejected_total", "Chamadas recusadas com o breaker aberto")
+FALLBACKS = metrics.REGISTRY.counter("llm_fallbacks_total", "Fallbacks determinísticos usados no lugar do LLM")
+OUTSTANDING = metrics.REGISTRY.gauge("llm_endpoint_outstanding", "Requisições em voo por endpoint do Ollama")
+ENDPOINT_UP = metrics.REGISTRY.gauge("llm_endpoint_up", "1 se o endpoint está saudável, 0 se está fora da seleção")
+HEDGED = metrics.REGISTRY.counter("llm_hedged_requests_total", "Requisições duplicadas (hedge) e qual cópia respondeu primeiro")
+
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+CALLS = metrics.REGISTRY.counter("llm_calls_total", "Chamadas ao LLM por call site e resultado (ok, cache_hit, fallback, error)")
+CALL_SECONDS = metrics.REGISTRY.histogram("llm_call_seconds", "Tempo de parede da chamada por call site e resultado")
+PHASE_SECONDS = metrics.REGISTRY.histogram(
+    "llm_phase_seconds", "Tempo por fase no Ollama (load, prompt_eval, eval) e fora dele (queue = fila + rede)",
+)
+PROMPT_CHARS = metrics.REGISTRY.histogram("llm_prompt_chars", "Tamanho do prompt enviado (caracteres)", buckets=metrics.SIZE_BUCKETS)
+PROMPT_TOKENS = metrics.REGISTRY.histogram("llm_prompt_tokens", "Tokens de prompt avaliados (prompt_eval_count)", buckets=TOKEN_BUCKETS)
+OUTPUT_TOKENS = metrics.REGISTRY.histogram("llm_output_tokens", "Tokens gerados (eval_count)", buckets=TOKEN_BUCKETS)
+
+# registro da chamada pública em andamento; os transportes anotam nele o que o servidor devolveu
+_CALL: "contextvars.ContextVar[Optional[Dict[str, Any]]]" = contextvars.ContextVar("llm_call", default=None)
+_OLLAMA_DURATIONS = (
+    ("load_duration", "load_s"),
+    ("prompt_eval_duration", "prompt_eval_s"),
+    ("eval_duration", "eval_s"),
+    ("total_duration", "total_s"),
+)
+
+# por event loop: um httpx.AsyncClient e um semáforo por endpoint
+# clientes por configuração (timeouts, limites, retries): wrappers diferentes não herdam a do primeiro
+_ASYNC_CLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple, Any]]" = weakref.WeakKeyDictionary()
+_SEMAPHORES: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, int], asyncio.Semaphore]]" = weakref.WeakKeyDictionary()
+
+
+_SESSIONS: Dict[Tuple[int, int, float], requests.Session] = {}
+_SESSIONS_LOCK = threading.Lock()
+
+_HEDGE_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_HEDGE_LOCK = threading.Lock()
+
+
+def _hedge_executor() -> ThreadPoolExecutor:
+    global _HEDGE_EXECUTOR
+    with _HEDGE_LOCK:
+        if _HEDGE_EXECUTOR is None:
+            _HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm-hedge")
+        return _HEDGE_EXECUTOR
+
+
+def shared_session(pool_size: int = 10, max_retries: int = 2, backoff_s: float = 0.5) -> requests.Session:
+    """
+    Session HTTP compartilhada pelo processo inteiro (todas as threads e
+    instâncias de LLMWrapper com a mesma configuração): mantém as conexões
+    keep-alive abertas, então o handshake TCP+TLS acontece uma vez por conexão
+    do pool, e não a cada chamada.
+    Retry com backoff exponencial só para falha de conexão e 429/502/503/504;
+    timeout de leitura não é repetido (a geração pode já ter rodado inteira).
+    """
+    key = (pool_size, max_retries, backoff_s)
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(key)
+        if session is None:
+            retry = Retry(
+                total=max_retries,
+                connect=max_retries,
+                read=0,
+                status=max_retries,
+                backoff_factor=backoff_s,
+                status_forcelist=(429, 502, 503, 504),
+                allowed_methods=frozenset({"GET", "POST"}),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry, pool_block=True)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _SESSIONS[key] = session
+        return session
+
+
+_TOKEN_PIECES = re.compile(r"\w+|[^\w\s]")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimativa de tokens sem tokenizer, puxada para cima: ~4 letras por token,
+    cada dígito e cada sinal de pontuação um token (os tokenizers do Qwen/Llama
+    quebram números dígito a dígito). Serve para orçamento de prompt, não
+    para cobrança.
+    """
+    n = 0
+    for piece in _TOKEN_PIECES.findall(text or ""):
+        digits = sum(c.isdigit() for c in piece)
+        letters = len(piece) - digits
+        n += digits + (letters + 3) // 4
+    return n
+
+
+class LLMJSONError(ValueError):
+    """Resposta do modelo que não virou JSON válido para o schema, mesmo após o reparo."""
+
+    def __init__(self, message: str, text: str = "", errors: Optional[List[str]] = None):
+        super().__init__(message)
+        self.text = text
+        self.errors = errors or []
+
+
+_JSON_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "boolean": bool,
+    "null": type(None),
+}
+
+
+def _is_type(value: Any, name: str) -> bool:
+    if name == "integer":
+        return isinstance(value, int) and not isinstance(value, bool)
+    if name == "number":
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    return isinstance(value, _JSON_TYPES.get(name, object))
+
+
+def validate_json(value: Any, schema: Dict[str, Any], path: str = "$") -> List[str]:
+    """
+    Validador mínimo de JSON Schema (o subconjunto que usamos nos prompts):
+    type (string ou lista), properties, required, additionalProperties=false,
+    items, enum, minimum/maximum. Retorna a lista de erros (vazia = válido).
+    """
+    errors: List[str] = []
+    types = schema.get("type")
+    if types is not None:
+        types = [types] if isinstance(types, str) else list(types)
+        if not any(_is_type(value, t) for t in types):
+            return [f"{path}: esperado {'|'.join(types)}, veio {type(value).__name__}"]
+    if "enum" in schema and value not in schema["enum"]:
+        errors.append(f"{path}: {value!r} fora de {schema['enum']}")
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if "minimum" in schema and value < schema["minimum"]:
+            errors.append(f"{path}: {value} < {schema['minimum']}")
+        if "maximum" in schema and value > schema["maximum"]:
+            errors.append(f"{path}: {value} > {schema['maximum']}")
+    if isinstance(value, dict):
+        props = schema.get("properties", {})
+        for name in schema.get("required", []):
+            if name not in value:
+                errors.append(f"{path}.{name}: obrigatório")
+        for name, sub in props.items():
+            if name in value:
+                errors.extend(validate_json(value[name], sub, f"{path}.{name}"))
+        if schema.get("additionalProperties") is False:
+            for name in value:
+                if name not in props:
+                    errors.append(f"{path}.{name}: campo não permitido")
+    if isinstance(value, list) and isinstance(schema.get("items"), dict):
+        for i, item in enumerate(value):
+            errors.extend(validate_json(item, schema["items"], f"{path}[{i}]"))
+    return errors
+
+
+class LLMUnavailable(RuntimeError):
+    """Circuit breaker aberto: a chamada nem foi feita."""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker por endpoint, com janela das últimas window_size chamadas:
+    - fechado → aberto quando, com pelo menos min_calls na janela, a taxa de
+      falhas passa de failure_rate ou a de chamadas lentas (> slow_call_s)
+      passa de slow_rate
+    - aberto: recusa na hora (LLMUnavailable) por open_s segundos
+    - meio-aberto: deixa passar até half_open_probes chamadas de teste; todas
+      ok → fecha; qualquer falha ou lentidão → abre de novo, com open_s
+      dobrando a cada reabertura até max_open_s
+    É seguro compartilhar entre threads (e entre a API síncrona e a assíncrona).
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+    _STATE_VALUE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(
+        self,
+        name: str = "llm",
+        *,
+        window_size: int = 20,
+        min_calls: int = 5,
+        failure_rate: float = 0.5,
+        slow_call_s: float = 30.0,
+        slow_rate: float = 0.8,
+        open_s: float = 30.0,
+        max_open_s: float = 300.0,
+        half_open_probes: int = 1,
+    ):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_s = slow_call_s
+        self.slow_rate = slow_rate
+        self.base_open_s = open_s
+        self.max_open_s = max_open_s
+        self.half_open_probes = half_open_probes
+        self._lock = threading.Lock()
+        self._window: "deque[Tuple[bool, bool]]" = deque(maxlen=window_size)  # (falhou, lenta)
+        self._state = self.CLOSED
+        self._open_s = open_s
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_ok = 0
+        BREAKER_STATE.set(0, endpoint=name)
+
+    @classmethod
+    def from_env(cls, name: str = "llm") -> Optional["CircuitBreaker"]:
+        """
+        LLM_BREAKER=1                 → liga o breaker (0 desliga)
+        LLM_BREAKER_WINDOW=20         → tamanho da janela (chamadas)
+        LLM_BREAKER_MIN_CALLS=5       → mínimo de chamadas antes de avaliar
+        LLM_BREAKER_FAILURE_RATE=0.5  → taxa de falhas que abre o circuito
+        LLM_BREAKER_SLOW_S=30         → acima disso a chamada conta como lenta
+        LLM_BREAKER_SLOW_RATE=0.8     → taxa de chamadas lentas que abre o circuito
+        LLM_BREAKER_OPEN_S=30         → tempo aberto antes do teste (dobra até LLM_BREAKER_MAX_OPEN_S)
+        """
+        if os.getenv("LLM_BREAKER", "1") == "0":
+            return None
+        return cls(
+            name,
+            window_size=int(os.getenv("LLM_BREAKER_WINDOW", "20")),
+            min_calls=int(os.getenv("LLM_BREAKER_MIN_CALLS", "5")),
+            failure_rate=float(os.getenv("LLM_BREAKER_FAILURE_RATE", "0.5")),
+            slow_call_s=float(os.getenv("LLM_BREAKER_SLOW_S", "30")),
+            slow_rate=float(os.getenv("LLM_BREAKER_SLOW_RATE", "0.8")),
+            open_s=float(os.getenv("LLM_BREAKER_OPEN_S", "30")),
+            max_open_s=float(os.getenv("LLM_BREAKER_MAX_OPEN_S", "300")),
+        )
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._maybe_half_open(time.monotonic())
+            return self._state
+
+    def _set_state(self, state: str) -> None:
+        if state != self._state:
+            print(f"[LLM] breaker {self.name}: {self._state} → {state}")
+        self._state = state
+        BREAKER_STATE.set(self._STATE_VALUE[state], endpoint=self.name)
+
+    def _maybe_half_open(self, now: float) -> None:
+        if self._state == self.OPEN and now - self._opened_at >= self._open_s:
+            self._probes = 0
+            self._probe_ok = 0
+            self._set_state(self.HALF_OPEN)
+
+    def _open(self, now: float, backoff: bool) -> None:
+        self._open_s = min(self._open_s * 2, self.max_open_s) if backoff else self.base_open_s
+        self._opened_at = now
+        self._window.clear()
+        self._set_state(self.OPEN)
+
+    def allow(self) -> bool:
+        """True se a chamada pode seguir; no meio-aberto, reserva uma vaga de teste."""
+        with self._lock:
+            self._maybe_half_open(time.monotonic())
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and self._probes < self.half_open_probes:
+                self._probes += 1
+                return True
+            BREAKER_REJECTED.inc(endpoint=self.name)
+            return False
+
+    def record(self, ok: bool, elapsed_s: float) -> None:
+        slow = elapsed_s > self.slow_call_s
+        now = time.monotonic()
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                if not ok or slow:
+                    self._open(now, backoff=True)
+                    return
+                self._probe_ok += 1
+                if self._probe_ok >= self.half_open_probes:
+                    self._open_s = self.base_open_s
+                    self._set_state(self.CLOSED)
+                return
+            if self._state == self.OPEN:
+                return  # chamada que começou antes de abrir
+            self._window.append((not ok, slow))
+            n = len(self._window)
+            if n < self.min_calls:
+                return
+            failures = sum(1 for f, _ in self._window if f)
+            slows = sum(1 for _, sl in self._window if sl)
+            if failures / n >= self.failure_rate or slows / n >= self.slow_rate:
+                self._open(now, backoff=False)
+
+    def release(self) -> None:
+        """Devolve a vaga de teste de uma chamada cancelada (sem resultado)."""
+        with self._lock:
+            if self._state == self.HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+
+def _note(**fields: Any) -> None:
+    call = _CALL.get()
+    if call is not None:
+        call.update(fields)
+
+
+def _note_counts(prompt_tokens: Optional[int], output_tokens: Optional[int], durations: Dict[str, float]) -> None:
+    """Soma no registro da chamada (generate_json pode fazer duas requisições)."""
+    call = _CALL.get()
+    if call is None:
+        return
+    call["requests"] = call.get("requests", 0) + 1
+    if prompt_tokens is not None:
+        call["prompt_tokens"] = call.get("prompt_tokens", 0) + prompt_tokens
+    if output_tokens is not None:
+        call["output_tokens"] = call.get("output_tokens", 0) + output_tokens
+    for name, value in durations.items():
+        call[name] = call.get(name, 0.0) + value
+
+
+def _note_ollama(data: Dict[str, Any]) -> None:
+    """Contadores que o Ollama devolve na resposta (durações em ns)."""
+    _note_counts(
+        data.get("prompt_eval_count"),
+        data.get("eval_count"),
+        {field: data[key] / 1e9 for key, field in _OLLAMA_DURATIONS if data.get(key) is not None},
+    )
+
+
+def _note_openai(resp: Any) -> None:
+    usage = (resp or {}).get("usage") or {}
+    _note_counts(usage.get("prompt_tokens"), usage.get("completion_tokens"), {})
+
+
+class LLMTrace:
+    """
+    Trace JSONL: uma linha por chamada pública do LLMWrapper, com call site,
+    tempo de parede, tokens, fases do Ollama, tamanho do prompt e resultado.
+    Instâncias com o mesmo path são compartilhadas (uma trava por arquivo).
+    """
+
+    _instances: Dict[str, "LLMTrace"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8", buffering=1)
+
+    @classmethod
+    def from_env(cls) -> Optional["LLMTrace"]:
+        """LLM_TRACE_PATH=/data/llm-trace.jsonl liga o trace (vazio = desligado)."""
+        path = os.getenv("LLM_TRACE_PATH")
+        if not path:
+            return None
+        with cls._instances_lock:
+            trace = cls._instances.get(path)
+            if trace is None:
+                trace = cls._instances[path] = cls(path)
+            return trace
+
+    def write(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+def _endpoint_fault(exc: BaseException) -> bool:
+    """
+    Falha atribuível ao endpoint: transporte (conexão, timeout) ou HTTP 5xx/429.
+    4xx do pedido e corpo que não decodifica (saída ruim do modelo) não tiram
+    o host da seleção.
+    """
+    if isinstance(exc, ValueError):  # LLMJSONError, JSONDecodeError
+        return False
+    status = getattr(getattr(exc, "response", None), "status_code", None)
+    if status is not None:
+        return status >= 500 or status == 429
+    if isinstance(exc, requests.RequestException):
+        return True
+    httpx = sys.modules.get("httpx")
+    return httpx is not None and isinstance(exc, httpx.TransportError)
+
+
+def _decode_body(r: Any, url: str) -> Dict[str, Any]:
+    """r.json() levantando LLMJSONError (e não erro de endpoint) quando o corpo não é JSON."""
+    try:
+        return r.json()
+    except ValueError as e:
+        raise LLMJSONError(f"Resposta não-JSON de {url}: {e}", (r.text or "")[:500]) from e
+
+
+class EndpointPool:
+    """
+    Vários hosts Ollama servindo o mesmo modelo.
+    Seleção por chamada:
+    - "least_outstanding": o endpoint com menos requisições em voo
+    - "ewma": menor latência média móvel × (em voo + 1); endpoint ainda sem
+      medida vai primeiro, para entrar na média
+    Empates alternam entre os endpoints (round-robin).
+    Saúde: falha de conexão, timeout ou 5xx tira o endpoint da seleção por
+    down_s; com health_interval_s > 0 uma thread faz GET /api/tags em cada
+    endpoint e devolve/tira da seleção. Se todos estiverem fora, usa todos.
+    Hedge (hedge=True, precisa de 2+ endpoints): se a resposta não chegou
+    depois do p95 das latências recentes (no mínimo hedge_min_s), a mesma
+    requisição vai para outro endpoint e vale a primeira que responder.
+    """
+
+    STRATEGIES = ("least_outstanding", "ewma")
+
+    def __init__(
+        self,
+        urls: Union[str, Sequence[str]],
+        *,
+        strategy: str = "least_outstanding",
+        hedge: bool = False,
+        hedge_min_s: float = 0.25,
+        health_interval_s: float = 0.0,
+        down_s: float = 10.0,
+        ewma_alpha: float = 0.3,
+    ):
+        if isinstance(urls, str):
+            urls = urls.split(",")
+        self.urls = [u.strip().rstrip("/") for u in urls if u.strip()]
+        if not self.urls:
+            raise ValueError("EndpointPool precisa de pelo menos uma URL.")
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Estratégia '{strategy}' inválida; use uma de {self.STRATEGIES}.")
+        self.strategy = strategy
+        self.hedge = hedge
+        self.hedge_min_s = hedge_min_s
+        self.health_interval_s = health_interval_s
+        self.down_s = down_s
+        self.ewma_alpha = ewma_alpha
+        self._lock = threading.Lock()
+        self._outstanding = {u: 0 for u in self.urls}
+        self._ewma: Dict[str, Optional[float]] = {u: None for u in self.urls}
+        self._down_until = {u: 0.0 for u in self.urls}
+        self._latencies: "deque[float]" = deque(maxlen=256)
+        self._rr = 0
+        self._health_thread: Optional[threading.Thread] = None
+        for u in self.urls:
+            ENDPOINT_UP.set(1, endpoint=u)
+
+    @classmethod
+    def from_env(cls, urls: Union[str, Sequence[str]]) -> "EndpointPool":
+        """
+        urls: "http://gpu1:11434,http://gpu2:11434" ou lista
+        LLM_ENDPOINT_STRATEGY=least_outstanding  → ou "ewma"
+        LLM_HEDGE=0                              → 1 liga o hedge
+        LLM_HEDGE_MIN_S=0.25                     → atraso mínimo antes do hedge
+        LLM_HEALTH_INTERVAL_S=0                  → intervalo do health check ativo (0 desliga)
+        LLM_ENDPOINT_DOWN_S=10                   → tempo fora da seleção após uma falha
+        """
+        return cls(
+            urls,
+            strategy=os.getenv("LLM_ENDPOINT_STRATEGY", "least_outstanding"),
+            hedge=os.getenv("LLM_HEDGE", "0") == "1",
+            hedge_min_s=float(os.getenv("LLM_HEDGE_MIN_S", "0.25")),
+            health_interval_s=float(os.getenv("LLM_HEALTH_INTERVAL_S", "0")),
+            down_s=float(os.getenv("LLM_ENDPOINT_DOWN_S", "10")),
+        )
+
+    def __len__(self) -> int:
+        return len(self.urls)
+
+    def _score(self, url: str) -> Tuple[float, int]:
+        n = self._outstanding[url]
+        if self.strategy == "ewma":
+            ewma = self._ewma[url]
+            return ((0.0 if ewma is None else ewma) * (n + 1), n)
+        return (float(n), 0)
+
+    def acquire(self, exclude: Sequence[str] = ()) -> Optional[str]:
+        """Escolhe um endpoint e conta uma requisição em voo nele (devolver com release)."""
+        with self._lock:
+            now = time.monotonic()
+            candidates = [u for u in self.urls if u not in exclude]
+            if not candidates:
+                return None
+            up = [u for u in candidates if self._down_until[u] <= now] or candidates
+            self._rr += 1
+            start = self._rr % len(up)
+            rotated = up[start:] + up[:start]
+            url = min(rotated, key=self._score)
+            self._outstanding[url] += 1
+            OUTSTANDING.set(self._outstanding[url], endpoint=url)
+            return url
+
+    def release(self, url: str, elapsed_s: Optional[float] = None, ok: bool = True) -> None:
+        """Fim da requisição: ok com latência entra na EWMA/p95; falha tira o endpoint por down_s."""
+        with self._lock:
+            self._outstanding[url] -= 1
+            OUTSTANDING.set(self._outstanding[url], endpoint=url)
+            if not ok:
+                self._set_down(url, time.monotonic() + self.down_s)
+            elif elapsed_s is not None:
+                prev = self._ewma[url]
+                self._ewma[url] = elapsed_s if prev is None else prev + self.ewma_alpha * (elapsed_s - prev)
+                self._latencies.append(elapsed_s)
+
+    def _set_down(self, url: str, until: float) -> None:
+        self._down_until[url] = until
+        ENDPOINT_UP.set(0 if until > time.monotonic() else 1, endpoint=url)
+
+    def hedge_delay(self) -> Optional[float]:
+        """Quanto esperar antes de duplicar a requisição; None = sem hedge."""
+        if not self.hedge or len(self.urls) < 2:
+            return None
+        with self._lock:
+            if len(self._latencies) < 20:
+                return None  # ainda sem amostra para um p95 confiável
+            ordered = sorted(self._latencies)
+        return max(self.hedge_min_s, ordered[int(0.95 * (len(ordered) - 1))])
+
+    def start_health_checks(self, session: requests.Session, timeout_s: float) -> None:
+        if self.health_interval_s <= 0 or self._health_thread is not None:
+            return
+
+        def run() -> None:
+            while True:
+                for url in self.urls:
+                    try:
+                        session.get(f"{url}/api/tags", timeout=(timeout_s, timeout_s)).raise_for_status()
+                        ok = True
+                    except Exception:
+                        ok = False
+                    with self._lock:
+                        self._set_down(url, 0.0 if ok else time.monotonic() + 2 * self.health_interval_s)
+                time.sleep(self.health_interval_s)
+
+        self._health_thread = threading.Thread(target=run, name="llm-health", daemon=True)
+        self._health_thread.start()
+
+
+class LLMCache:
+    """
+    Cache de respostas para chamadas determinísticas (temperature == 0).
+    - camada 1: LRU em memória (max_entries)
+    - camada 2 opcional: SQLite em disco (path), sobrevive a restarts e pode
+      ser compartilhado entre processos do mesmo host; limitado a max_disk_bytes
+    - ttl_s expira entradas nas duas camadas (0 = sem expiração)
+    A chave é o sha256 de (provider, model, temperature, system prompt, prompt).
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl_s: float = 0,
+        path: Optional[str] = None,
+        max_disk_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.max_disk_bytes = max_disk_bytes
+        self._lock = threading.Lock()
+        self._mem: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        self._puts = 0
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " created_at REAL NOT NULL, accessed_at REAL NOT NULL, size INTEGER NOT NULL)"
+            )
+
+    @classmethod
+    def from_env(cls) -> Optional["LLMCache"]:
+        """
+        LLM_CACHE_SIZE=1024         → entradas no LRU em memória (0 desliga o cache)
+        LLM_CACHE_TTL_S=86400       → expiração (0 = nunca)
+        LLM_CACHE_PATH=/data/llm.db → camada SQLite opcional
+        LLM_CACHE_MAX_MB=64         → limite da camada SQLite
+        """
+        size = int(os.getenv("LLM_CACHE_SIZE", "1024"))
+        if size <= 0:
+            return None
+        return cls(
+            max_entries=size,
+            ttl_s=float(os.getenv("LLM_CACHE_TTL_S", "0")),
+            path=os.getenv("LLM_CACHE_PATH") or None,
+            max_disk_bytes=int(float(os.getenv("LLM_CACHE_MAX_MB", "64")) * 1024 * 1024),
+        )
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_s > 0 and now - created_at > self.ttl_s
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            hit = self._mem.get(key)
+            if hit is not None:
+                if not self._expired(hit[0], now):
+                    self._mem.move_to_end(key)
+                    CACHE_REQUESTS.inc(tier="memory", result="hit")
+                    return hit[1]
+                del self._mem[key]
+            CACHE_REQUESTS.inc(tier="memory", result="miss")
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or self._expired(row[1], now):
+                if row is not None:
+                    self._db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                CACHE_REQUESTS.inc(tier="disk", result="miss")
+                return None
+            self._db.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._mem_put(key, row[1], row[0])
+            CACHE_REQUESTS.inc(tier="disk", result="hit")
+            return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._mem_put(key, now, value)
+            if self._db is None:
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created_at, accessed_at, size) VALUES (?, ?, ?, ?, ?)",
+                (key, value, now, now, len(value.encode("utf-8"))),
+            )
+            self._puts += 1
+            if self._puts % 64 == 0:  # limite de disco checado em lotes, não a cada put
+                self._evict_disk()
+
+    def _mem_put(self, key: str, created_at: float, value: str) -> None:
+        self._mem[key] = (created_at, value)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+    def _evict_disk(self) -> None:
+        """Remove expirados e, acima de max_disk_bytes, os menos acessados."""
+        if self.ttl_s > 0:
+            self._db.execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - self.ttl_s,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        excess = total - int(self.max_disk_bytes * 0.9)
+        freed = 0
+        doomed = []
+        for key, size in self._db.execute("SELECT key, size FROM llm_cache ORDER BY accessed_at"):
+            doomed.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self._db.executemany("DELETE FROM llm_cache WHERE key = ?", doomed)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
 
 
 class LLMWrapper:
     """
     Wrapper simples para chamadas a modelos LLM (Ollama local ou OpenAI API).
+    As chamadas ao Ollama usam uma Session com pool de conexões keep-alive
+    (pool_size conexões por host), retry com backoff e timeouts separados de
+    conexão (connect_timeout_s) e leitura (timeout_s). É seguro compartilhar
+    a mesma instância entre threads.
+    Com cache (LLMCache), chamadas com temperature == 0 são respondidas do
+    cache quando o mesmo prompt já foi visto; temperature pode ser passada
+    por chamada (ex.: 0.0 para classificação) sem mudar o padrão da instância.
+    API assíncrona (agenerate/achat, precisa de httpx):
+        várias chamadas em voo no mesmo event loop, limitadas a
+        max_concurrency por host: o semáforo é do endpoint escolhido pelo
+        EndpointPool, compartilhado no loop pelas instâncias com o mesmo
+        max_concurrency. deadline_s cobre a espera no semáforo + a chamada;
+        cancelar a task fecha a requisição em andamento.
+        Cache, escolha do provedor e payload vêm do mesmo _plan() da API
+        síncrona; só o transporte muda (requests.Session × httpx.AsyncClient).
+    Saída estruturada (generate_json):
+        pede JSON restrito ao schema (format do Ollama / response_format da
+        OpenAI), valida com validate_json e, se falhar, tenta reparar o texto
+        localmente e depois pede uma correção ao modelo uma única vez, se ainda
+        couber em budget_s. Levanta LLMJSONError quando não há JSON válido.
+    Vários endpoints (ollama_base_url="http://a:11434,http://b:11434" ou
+    lista, ou endpoints=EndpointPool): cada chamada vai para o endpoint com
+    menos carga, endpoints com falha saem da seleção e, com hedge, uma
+    requisição lenta é repetida em outro endpoint. Ver EndpointPool.
+    Telemetria (label=, por instância ou por chamada):
+        cada chamada pública registra, por call site, tempo de parede,
+        prompt_eval_count/eval_count, load/prompt_eval/eval do Ollama, o tempo
+        fora do modelo (fila + rede), tamanho do prompt e cache hit nos
+        histogramas llm_* do core.metrics e, com trace=LLMTrace, em JSONL.
+    Circuit breaker (breaker=CircuitBreaker):
+        com o endpoint fora do ar ou lento demais, as chamadas falham na hora
+        com LLMUnavailable em vez de esperar timeout_s cada uma. Só contam como
+        falha as do endpoint (ver _endpoint_fault): JSON inválido do modelo ou
+        4xx do pedido não abrem o circuito. Quem passa
+        fallback=fn recebe fn() direto enquanto o breaker estiver aberto.
+    Streaming (stream / generate_until):
+        stream() devolve os pedaços de texto conforme o modelo gera;
+        generate_until(..., stop=pred) para a geração (fecha a conexão, o
+        Ollama interrompe o modelo) assim que pred(texto_acumulado) for True.
     """
 
     def __init__(
@@ -14,77 +739,698 @@ class LLMWrapper:
         provider: str = "ollama",
         model: str = "qwen2.5:7b-instruct",
         temperature: float = 0.0,
-        ollama_base_url: str = "https://ollama.pedro-porto.com",
+        ollama_base_url: Union[str, Sequence[str]] = "https://ollama.pedro-porto.com",
         openai_api_key: Optional[str] = None,
         openai_model: Optional[str] = None,
         timeout_s: int = 60,
+        *,
+        connect_timeout_s: float = 5.0,
+        pool_size: int = 10,
+        max_retries: int = 2,
+        backoff_s: float = 0.5,
+        session: Optional[requests.Session] = None,
+        cache: Optional[LLMCache] = None,
+        max_concurrency: int = 4,
+        breaker: Optional[CircuitBreaker] = None,
+        endpoints: Optional[EndpointPool] = None,
+        label: str = "llm",
+        trace: Optional[LLMTrace] = None,
+        keep_alive: Optional[str] = None,
     ):
         self.provider = provider.lower()
         self.model = model
         self.temperature = temperature
-        self.ollama_base_url = ollama_base_url.rstrip("/")
+        self.endpoints = endpoints or EndpointPool(ollama_base_url)
+        self.ollama_base_url = self.endpoints.urls[0]
         self.openai_api_key = openai_api_key
         self.openai_model = openai_model or model
         self.timeout_s = timeout_s
+        self.connect_timeout_s = connect_timeout_s
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.session = session or shared_session(pool_size, max_retries, backoff_s)
+        self.cache = cache
+        self.max_concurrency = max_concurrency
+        self.breaker = breaker
+        self.label = label
+        self.trace = trace
+        self.keep_alive = keep_alive  # ex.: "30m"; quanto tempo o Ollama mantém o modelo carregado
+        if self.provider == "ollama":
+            self.endpoints.start_health_checks(self.session, connect_timeout_s)
+
+    @property
+    def _timeout(self) -> Tuple[float, float]:
+        return (self.connect_timeout_s, self.timeout_s)
 
    
-    def generate(self, prompt: str, system_prompt: Optional[str] = None) -> str:
+    def generate(
+        self,
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        temperature: Optional[float] = None,
+        *,
+        label: Optional[str] = None,
+        fallback: Optional[Callable[[], str]] = None,
+    ) -> str:
         """
         Gera texto a partir de um prompt.
         """
+        with self._observe("generate", label):
+            key, cached, call, _ = self._plan("generate", temperature, prompt, system_prompt)
+            if cached is not None:
+                return cached
+            try:
+                text = self._guard(call)
+            except LLMUnavailable as e:
+                return self._use_fallback(fallback, e)
+            return self._cache_put(key, text)
+
+    def chat(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: Optional[float] = None,
+        *,
+        label: Optional[str] = None,
+        fallback: Optional[Callable[[], str]] = None,
+    ) -> str:
+        """
+        Interface estilo Chat — recebe lista de mensagens [{"role": "user"/"system"/"assistant", "content": "..."}]
+        """
+        with self._observe("chat", label):
+            key, cached, call, _ = self._plan("chat", temperature, messages)
+            if cached is not None:
+                return cached
+            try:
+                text = self._guard(call)
+            except LLMUnavailable as e:
+                return self._use_fallback(fallback, e)
+            return self._cache_put(key, text)
+
+    def generate_json(
+        self,
+        prompt: str,
+        schema: Dict[str, Any],
+        system_prompt: Optional[str] = None,
+        temperature: Optional[float] = None,
+        budget_s: Optional[float] = None,
+        *,
+        label: Optional[str] = None,
+        fallback: Optional[Callable[[], Dict[str, Any]]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Gera e devolve um objeto JSON já validado contra schema.
+        budget_s (padrão timeout_s) limita o tempo total, incluindo a nova tentativa.
+        """
+        with self._observe("generate_json", label):
+            temperature = self.temperature if temperature is None else temperature
+            budget_s = self.timeout_s if budget_s is None else budget_s
+            key = self._cache_key(temperature, "generate_json", system_prompt, prompt, schema)
+            cached = self._cache_get(key)
+            if cached is not None:
+                return json.loads(cached)
+
+            t0 = time.monotonic()
+            try:
+                text = self._generate_structured(prompt, system_prompt, temperature, schema)
+                data, errors = self._parse_json(text, schema)
+                elapsed = time.monotonic() - t0
+                # só tenta de novo se outra chamada do mesmo tamanho ainda cabe no orçamento
+                if errors and elapsed * 2 <= budget_s:
+                    repair = (
+                        f"{prompt}\n\nSua resposta anterior foi:\n{text}\n\n"
+                        f"Ela não é válida: {'; '.join(errors[:5])}.\n"
+                        "Responda novamente APENAS com o JSON corrigido."
+                    )
+                    text = self._generate_structured(repair, system_prompt, temperature, schema)
+                    data, errors = self._parse_json(text, schema)
+            except LLMUnavailable as e:
+                return self._use_fallback(fallback, e)
+            if errors:
+                raise LLMJSONError(f"JSON inválido do LLM: {'; '.join(errors[:5])}", text, errors)
+            self._cache_put(key, json.dumps(data, ensure_ascii=False))
+            return data
+
+    def _generate_structured(
+        self, prompt: str, system_prompt: Optional[str], temperature: float, schema: Dict[str, Any]
+    ) -> str:
         if self.provider == "ollama":
-            return self._generate_ollama(prompt, system_prompt)
+            return self._guard(lambda: self._generate_ollama(prompt, system_prompt, temperature, fmt=schema))
         elif self.provider == "openai":
-            return self._generate_openai(prompt, system_prompt)
-        else:
-            raise ValueError(f"Provedor '{self.provider}' não suportado.")
+            return self._guard(lambda: self._generate_openai(prompt, system_prompt, temperature, fmt=schema))
+        raise ValueError(f"Provedor '{self.provider}' não suportado.")
+
+    @classmethod
+    def _parse_json(cls, text: str, schema: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], List[str]]:
+        """JSON direto; se não der, reparo local (cercas ``` / texto em volta) antes de desistir."""
+        try:
+            data = json.loads(text)
+        except (json.JSONDecodeError, TypeError):
+            data = cls.extract_json(re.sub(r"```(?:json)?", "", text or ""))
+            if data is None:
+                return None, ["resposta não é JSON"]
+        return data, validate_json(data, schema)
 
-    def chat(self, messages: List[Dict[str, str]]) -> str:
+    def stream(
+        self, prompt: str, system_prompt: Optional[str] = None, temperature: Optional[float] = None
+    ) -> Iterator[str]:
         """
-        Interface estilo Chat — recebe lista de mensagens [{"role": "user"/"system"/"assistant", "content": "..."}]
+        Gera texto incrementalmente. Interromper a iteração (break / close())
+        encerra a requisição e, com ela, a geração no servidor.
+        Com o breaker aberto, o primeiro next() levanta LLMUnavailable.
         """
+        temperature = self.temperature if temperature is None else temperature
         if self.provider == "ollama":
-            return self._chat_ollama(messages)
+            return self._guard_stream(self._stream_ollama(prompt, system_prompt, temperature))
         elif self.provider == "openai":
-            return self._chat_openai(messages)
+            return self._guard_stream(self._stream_openai(prompt, system_prompt, temperature))
+        raise ValueError(f"Provedor '{self.provider}' não suportado.")
+
+    def generate_until(
+        self,
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        stop: Optional[Callable[[str], bool]] = None,
+        temperature: Optional[float] = None,
+        *,
+        label: Optional[str] = None,
+        fallback: Optional[Callable[[], str]] = None,
+    ) -> str:
+        """
+        generate() via streaming, parando assim que stop(texto_acumulado) for True.
+        Devolve o texto acumulado até ali (sem strip do que veio depois).
+        """
+        with self._observe("generate_until", label):
+            chunks: List[str] = []
+            text = ""
+            gen = self.stream(prompt, system_prompt, temperature)
+            try:
+                for chunk in gen:
+                    chunks.append(chunk)
+                    text = "".join(chunks)
+                    if stop is not None and stop(text):
+                        break
+            except LLMUnavailable as e:
+                return self._use_fallback(fallback, e)
+            finally:
+                gen.close()
+            return text.strip()
+
+    async def agenerate(
+        self,
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        temperature: Optional[float] = None,
+        *,
+        label: Optional[str] = None,
+        deadline_s: Optional[float] = None,
+        fallback: Optional[Callable[[], str]] = None,
+    ) -> str:
+        """
+        Versão assíncrona de generate(). Levanta TimeoutError se deadline_s
+        estourar (contando a fila do semáforo).
+        """
+        with self._observe("agenerate", label):
+            key, cached, _, call = self._plan("generate", temperature, prompt, system_prompt)
+            if cached is not None:
+                return cached
+            try:
+                text = await self._bounded(call, deadline_s)
+            except LLMUnavailable as e:
+                return self._use_fallback(fallback, e)
+            return self._cache_put(key, text)
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: Optional[float] = None,
+        *,
+        label: Optional[str] = None,
+        deadline_s: Optional[float] = None,
+        fallback: Optional[Callable[[], str]] = None,
+    ) -> str:
+        """Versão assíncrona de chat()."""
+        with self._observe("achat", label):
+            key, cached, _, call = self._plan("chat", temperature, messages)
+            if cached is not None:
+                return cached
+            try:
+                text = await self._bounded(call, deadline_s)
+            except LLMUnavailable as e:
+                return self._use_fallback(fallback, e)
+            return self._cache_put(key, text)
+
+    def _plan(self, op: str, temperature: Optional[float], *args: Any) -> Tuple[Optional[str], Optional[str], Callable, Callable]:
+        """
+        Núcleo comum de generate/chat e agenerate/achat (op = "generate" | "chat";
+        args = (prompt, system_prompt) ou (messages,)): chave e hit do cache e
+        as duas formas de transporte da chamada, (síncrona, assíncrona).
+        """
+        temperature = self.temperature if temperature is None else temperature
+        parts = (args[1], args[0]) if op == "generate" else args
+        key = self._cache_key(temperature, op, *parts)
+        cached = self._cache_get(key)
+        if self.provider == "ollama":
+            sync = getattr(self, f"_{op}_ollama")
+            asyn = getattr(self, f"_a{op}_ollama")
+            return key, cached, lambda: sync(*args, temperature), lambda: asyn(*args, temperature)
+        if self.provider == "openai":
+            sync = getattr(self, f"_{op}_openai")
+            # o SDK síncrono numa thread, limitado pelo semáforo do "endpoint" openai
+            asyn = lambda: self._alimited(self._endpoint(), lambda: asyncio.to_thread(sync, *args, temperature))
+            return key, cached, lambda: sync(*args, temperature), asyn
+        raise ValueError(f"Provedor '{self.provider}' não suportado.")
+
+    def _cache_key(self, temperature: float, *parts: Any) -> Optional[str]:
+        """Chave do cache, ou None quando a chamada não é determinística (ou não há cache)."""
+        if self.cache is None or temperature != 0:
+            return None
+        model = self.openai_model if self.provider == "openai" else self.model
+        return LLMCache.make_key(self.provider, model, temperature, *parts)
+
+    def _cache_get(self, key: Optional[str]) -> Optional[str]:
+        if key is None:
+            return None
+        hit = self.cache.get(key)
+        _note(cache="hit" if hit is not None else "miss")
+        return hit
+
+    def _cache_put(self, key: Optional[str], text: str) -> str:
+        if key is not None and text:
+            self.cache.put(key, text)
+        return text
+
+    def _endpoint(self) -> str:
+        return ",".join(self.endpoints.urls) if self.provider == "ollama" else f"openai:{self.openai_model}"
+
+    def _unavailable(self) -> LLMUnavailable:
+        return LLMUnavailable(f"LLM indisponível ({self._endpoint()}): circuit breaker aberto")
+
+    def _use_fallback(self, fallback: Optional[Callable[[], Any]], error: LLMUnavailable) -> Any:
+        if fallback is None:
+            raise error
+        FALLBACKS.inc(endpoint=self._endpoint())
+        _note(fallback=True)
+        return fallback()
+
+    @contextlib.contextmanager
+    def _observe(self, kind: str, label: Optional[str]) -> Iterator[Dict[str, Any]]:
+        """Abre o registro da chamada (lido pelos transportes via _CALL) e publica ao sair."""
+        call: Dict[str, Any] = {"label": label or self.label, "kind": kind}
+        token = _CALL.set(call)
+        t0 = time.monotonic()
+        try:
+            yield call
+        except BaseException as e:
+            call["error"] = type(e).__name__
+            raise
+        finally:
+            _CALL.reset(token)
+            call["wall_s"] = time.monotonic() - t0
+            self._record_call(call)
+
+    def _record_call(self, call: Dict[str, Any]) -> None:
+        label = call["label"]
+        if "error" in call:
+            result = "error"
+        elif call.get("fallback"):
+            result = "fallback"
+        elif call.get("cache") == "hit":
+            result = "cache_hit"
         else:
-            raise ValueError(f"Provedor '{self.provider}' não suportado.")
+            result = "ok"
+        call["result"] = result
+        CALLS.inc(label=label, result=result)
+        CALL_SECONDS.observe(call["wall_s"], label=label, result=result)
+        if "prompt_chars" in call:
+            PROMPT_CHARS.observe(call["prompt_chars"], label=label)
+        if "prompt_tokens" in call:
+            PROMPT_TOKENS.observe(call["prompt_tokens"], label=label)
+        if "output_tokens" in call:
+            OUTPUT_TOKENS.observe(call["output_tokens"], label=label)
+        for _, field in _OLLAMA_DURATIONS[:3]:
+            if field in call:
+                PHASE_SECONDS.observe(call[field], label=label, phase=field[:-2])
+        if "total_s" in call and result == "ok":
+            # o que não foi tempo de modelo: fila no servidor, rede, retries
+            call["queue_s"] = max(0.0, call["wall_s"] - call["total_s"])
+            PHASE_SECONDS.observe(call["queue_s"], label=label, phase="queue")
+        if self.trace is not None:
+            record = {"ts": round(time.time(), 3), "model": self.openai_model if self.provider == "openai" else self.model}
+            record.update(call)
+            self.trace.write(record)
 
-   
-    def _generate_ollama(self, prompt: str, system_prompt: Optional[str] = None) -> str:
+    def _guard(self, call: Callable[[], Any]) -> Any:
+        """Passa call() pelo breaker: recusa na hora se aberto, registra resultado e latência."""
+        breaker = self.breaker
+        if breaker is None:
+            return call()
+        if not breaker.allow():
+            raise self._unavailable()
+        t0 = time.monotonic()
+        try:
+            result = call()
+        except Exception as e:
+            # só falha do endpoint conta: saída ruim do modelo (LLMJSONError) ou 4xx não derruba o circuito
+            breaker.record(not _endpoint_fault(e), time.monotonic() - t0)
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record(True, time.monotonic() - t0)
+        return result
+
+    def _guard_stream(self, gen: Iterator[str]) -> Iterator[str]:
+        """_guard() para streaming; parar cedo (close()) conta como sucesso."""
+        breaker = self.breaker
+        if breaker is None:
+            yield from gen
+            return
+        if not breaker.allow():
+            gen.close()
+            raise self._unavailable()
+        t0 = time.monotonic()
+        try:
+            yield from gen
+        except GeneratorExit:
+            breaker.record(True, time.monotonic() - t0)
+            raise
+        except Exception as e:
+            breaker.record(not _endpoint_fault(e), time.monotonic() - t0)
+            raise
+        breaker.record(True, time.monotonic() - t0)
+
+    def _semaphore(self, endpoint: str) -> asyncio.Semaphore:
         """
-        Chamada ao Ollama via /api/generate.
+        Semáforo de max_concurrency vagas do endpoint no loop atual. A chave
+        inclui max_concurrency: instâncias com limites diferentes não herdam
+        o limite de quem criou o semáforo primeiro.
         """
+        sems = _SEMAPHORES.setdefault(asyncio.get_running_loop(), {})
+        key = (endpoint, self.max_concurrency)
+        sem = sems.get(key)
+        if sem is None:
+            sem = sems[key] = asyncio.Semaphore(self.max_concurrency)
+        return sem
+
+    async def _alimited(self, endpoint: str, call) -> Any:
+        """call() segurando o semáforo do endpoint; a espera fica fora da latência do breaker."""
+        t0 = time.monotonic()
+        async with self._semaphore(endpoint):
+            record = _CALL.get()
+            if record is not None:
+                record.setdefault("semaphore_wait_s", time.monotonic() - t0)
+            return await call()
+
+    async def _bounded(self, call, deadline_s: Optional[float]) -> str:
+        """Roda call() (que pega o semáforo do endpoint escolhido) passando pelo breaker, dentro do deadline."""
+        breaker = self.breaker
+        if breaker is not None and not breaker.allow():
+            raise self._unavailable()
+
+        async def run() -> str:
+            t0 = time.monotonic()
+            try:
+                result = await call()
+            except asyncio.CancelledError:
+                if breaker is not None:
+                    breaker.release()
+                raise
+            except Exception as e:
+                if breaker is not None:
+                    breaker.record(not _endpoint_fault(e), self._call_elapsed(t0))
+                raise
+            if breaker is not None:
+                breaker.record(True, self._call_elapsed(t0))
+            return result
+
+        if deadline_s is None:
+            return await run()
+        try:
+            return await asyncio.wait_for(run(), deadline_s)
+        except asyncio.TimeoutError:
+            if breaker is not None:
+                breaker.record(False, deadline_s)  # deadline estourado conta como falha
+            raise TimeoutError(f"LLM não respondeu em {deadline_s:g}s ({self._endpoint()})") from None
+
+    @staticmethod
+    def _call_elapsed(t0: float) -> float:
+        """Tempo desde t0 sem a espera na fila local do semáforo (não é lentidão do endpoint)."""
+        record = _CALL.get()
+        waited = record.get("semaphore_wait_s", 0.0) if record is not None else 0.0
+        return max(0.0, time.monotonic() - t0 - waited)
+
+    def _async_client(self):
+        """httpx.AsyncClient do event loop atual (conexões keep-alive reaproveitadas no loop)."""
+        import httpx  # precisa de pip install httpx
+
+        loop = asyncio.get_running_loop()
+        clients = _ASYNC_CLIENTS.setdefault(loop, {})
+        key = self._async_client_key()
+        client = clients.get(key)
+        if client is None:
+            client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout_s, connect=self.connect_timeout_s),
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                transport=httpx.AsyncHTTPTransport(retries=self.max_retries),
+            )
+            clients[key] = client
+        return client
+
+    def _async_client_key(self) -> Tuple:
+        return (self.timeout_s, self.connect_timeout_s, self.pool_size, self.max_retries)
+
+    def warm_up(self) -> Dict[str, float]:
+        """
+        Carrega o modelo em todos os endpoints (POST /api/generate sem prompt),
+        para a primeira mensagem não pagar o load. Devolve segundos por endpoint;
+        falhas são logadas e não interrompem.
+        """
+        if self.provider != "ollama":
+            return {}
+        payload: Dict[str, Any] = {"model": self.model}
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        took: Dict[str, float] = {}
+        for url in self.endpoints.urls:
+            t0 = time.monotonic()
+            try:
+                r = self.session.post(f"{url}/api/generate", json=payload, timeout=self._timeout)
+                r.raise_for_status()
+            except Exception as e:
+                print(f"[LLM] warm-up {self.model} em {url} falhou: {e}")
+                continue
+            took[url] = time.monotonic() - t0
+        return took
+
+    async def aclose(self) -> None:
+        """Fecha o AsyncClient desta configuração no loop atual (chamar antes de encerrar o loop)."""
+        loop = asyncio.get_running_loop()
+        client = _ASYNC_CLIENTS.get(loop, {}).pop(self._async_client_key(), None)
+        if client is not None:
+            await client.aclose()
+
+   
+    def _ollama_generate_payload(
+        self, prompt: str, system_prompt: Optional[str], temperature: float, fmt: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        _note(prompt_chars=len(prompt) + len(system_prompt or ""))
         payload = {
             "model": self.model,
             "prompt": f"{system_prompt or ''}\n{prompt}",
             "stream": False,
-            "options": {"temperature": self.temperature},
+            "options": {"temperature": temperature},
         }
-        r = requests.post(
-            f"{self.ollama_base_url}/api/generate",
-            json=payload,
-            timeout=self.timeout_s,
-        )
-        r.raise_for_status()
-        data = r.json()
+        if fmt is not None:
+            # Ollama >= 0.5 aceita o JSON schema direto em "format"
+            payload["format"] = fmt
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        return payload
+
+    def _ollama_chat_payload(self, messages: List[Dict[str, str]], temperature: float) -> Dict[str, Any]:
+        _note(prompt_chars=sum(len(m.get("content") or "") for m in messages))
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "stream": False,
+            "options": {"temperature": temperature},
+        }
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        return payload
+
+    def _post_to(self, url: str, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """POST em um endpoint já escolhido (acquire); sempre faz o release."""
+        t0 = time.monotonic()
+        try:
+            r = self.session.post(f"{url}{path}", json=payload, timeout=self._timeout)
+            r.raise_for_status()
+            data = _decode_body(r, url)
+        except Exception as e:
+            self.endpoints.release(url, ok=not _endpoint_fault(e))
+            raise
+        self.endpoints.release(url, time.monotonic() - t0)
+        return data
+
+    def _post_ollama(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        POST no endpoint escolhido pelo EndpointPool. Falha de conexão ou 5xx
+        tenta outro endpoint uma vez; com hedge, a requisição lenta é duplicada.
+        """
+        delay = self.endpoints.hedge_delay()
+        if delay is not None:
+            return self._post_hedged(path, payload, delay)
+        url = self.endpoints.acquire()
+        try:
+            return self._post_to(url, path, payload)
+        except (requests.ConnectionError, requests.HTTPError) as e:
+            if not _endpoint_fault(e):
+                raise
+            other = self.endpoints.acquire(exclude=(url,))
+            if other is None:
+                raise
+            return self._post_to(other, path, payload)
+
+    def _post_hedged(self, path: str, payload: Dict[str, Any], delay: float) -> Dict[str, Any]:
+        # a cópia que perder não é cancelada (requests não interrompe a chamada),
+        # só é ignorada; o release acontece quando ela terminar
+        executor = _hedge_executor()
+        url = self.endpoints.acquire()
+        first = executor.submit(self._post_to, url, path, payload)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        other = self.endpoints.acquire(exclude=(url,))
+        if other is None:
+            return first.result()
+        second = executor.submit(self._post_to, other, path, payload)
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                if fut.exception() is None:
+                    HEDGED.inc(winner="primary" if fut is first else "hedge")
+                    return fut.result()
+        return first.result()  # as duas falharam: propaga o erro da original
+
+    async def _apost_to(self, url: str, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """POST assíncrono no endpoint já escolhido (acquire), segurando o semáforo dele."""
+        try:
+            return await self._alimited(url, lambda: self._apost_once(url, path, payload))
+        except asyncio.CancelledError:
+            self.endpoints.release(url)
+            raise
+
+    async def _apost_once(self, url: str, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        t0 = time.monotonic()
+        try:
+            r = await self._async_client().post(f"{url}{path}", json=payload)
+            r.raise_for_status()
+            data = _decode_body(r, url)
+        except Exception as e:  # cancelamento (CancelledError) faz o release no _apost_to
+            self.endpoints.release(url, ok=not _endpoint_fault(e))
+            raise
+        self.endpoints.release(url, time.monotonic() - t0)
+        return data
+
+    async def _apost_ollama(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Versão assíncrona de _post_ollama(); aqui a cópia perdedora do hedge é cancelada."""
+        delay = self.endpoints.hedge_delay()
+        url = self.endpoints.acquire()
+        if delay is None:
+            return await self._apost_to(url, path, payload)
+        first = asyncio.ensure_future(self._apost_to(url, path, payload))
+        pending = {first}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return first.result()
+            other = self.endpoints.acquire(exclude=(url,))
+            if other is None:
+                return await first
+            second = asyncio.ensure_future(self._apost_to(other, path, payload))
+            pending = {first, second}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        HEDGED.inc(winner="primary" if task is first else "hedge")
+                        return task.result()
+            return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _generate_ollama(
+        self, prompt: str, system_prompt: Optional[str], temperature: float, fmt: Optional[Dict[str, Any]] = None
+    ) -> str:
+        """
+        Chamada ao Ollama via /api/generate.
+        """
+        data = self._post_ollama("/api/generate", self._ollama_generate_payload(prompt, system_prompt, temperature, fmt))
+        _note_ollama(data)
         return data.get("response", "").strip()
 
-    def _chat_ollama(self, messages: List[Dict[str, str]]) -> str:
+    def _chat_ollama(self, messages: List[Dict[str, str]], temperature: float) -> str:
         """
         Chamada ao Ollama via /api/chat.
         """
-        payload = {"model": self.model, "messages": messages, "stream": False}
-        r = requests.post(
-            f"{self.ollama_base_url}/api/chat",
-            json=payload,
-            timeout=self.timeout_s,
-        )
-        r.raise_for_status()
-        data = r.json()
+        data = self._post_ollama("/api/chat", self._ollama_chat_payload(messages, temperature))
+        _note_ollama(data)
+        return data.get("message", {}).get("content", "").strip()
+
+    def _stream_ollama(self, prompt: str, system_prompt: Optional[str], temperature: float) -> Iterator[str]:
+        """Ollama /api/generate com stream=true: uma linha JSON por pedaço (sem hedge)."""
+        payload = self._ollama_generate_payload(prompt, system_prompt, temperature)
+        payload["stream"] = True
+        url = self.endpoints.acquire()
+        ok = True
+        chunks = 0
+        done = False
+        try:
+            with self.session.post(
+                f"{url}/api/generate",
+                json=payload,
+                timeout=self._timeout,
+                stream=True,
+            ) as r:
+                r.raise_for_status()
+                for line in r.iter_lines():
+                    if not line:
+                        continue
+                    try:
+                        data = json.loads(line)
+                    except ValueError as e:
+                        raise LLMJSONError(f"Linha não-JSON no stream de {url}: {e}", line[:500].decode("utf-8", "replace")) from e
+                    if data.get("response"):
+                        chunks += 1
+                        yield data["response"]
+                    if data.get("done"):
+                        done = True
+                        _note_ollama(data)  # contadores vêm só na última linha
+                        return
+        except Exception as e:
+            ok = not _endpoint_fault(e)
+            raise
+        finally:
+            if not done:
+                _note_counts(None, chunks, {})  # parada cedo: um pedaço por token
+            # geração parcial (parada cedo) não entra na EWMA/p95
+            self.endpoints.release(url, ok=ok)
+
+    async def _agenerate_ollama(self, prompt: str, system_prompt: Optional[str], temperature: float) -> str:
+        data = await self._apost_ollama("/api/generate", self._ollama_generate_payload(prompt, system_prompt, temperature))
+        _note_ollama(data)
+        return data.get("response", "").strip()
+
+    async def _achat_ollama(self, messages: List[Dict[str, str]], temperature: float) -> str:
+        data = await self._apost_ollama("/api/chat", self._ollama_chat_payload(messages, temperature))
+        _note_ollama(data)
         return data.get("message", {}).get("content", "").strip()
 
-    def _generate_openai(self, prompt: str, system_prompt: Optional[str] = None) -> str:
+    def _generate_openai(
+        self, prompt: str, system_prompt: Optional[str], temperature: float, fmt: Optional[Dict[str, Any]] = None
+    ) -> str:
         """
         Chamada à OpenAI Chat Completions API.
         """
@@ -95,22 +1441,52 @@ class LLMWrapper:
         if system_prompt:
             messages.append({"role": "system", "content": system_prompt})
         messages.append({"role": "user", "content": prompt})
+        _note(prompt_chars=len(prompt) + len(system_prompt or ""))
 
+        extra = {}
+        if fmt is not None:
+            extra["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "response", "schema": fmt},
+            }
         resp = openai.ChatCompletion.create(
             model=self.openai_model,
             messages=messages,
-            temperature=self.temperature,
+            temperature=temperature,
+            **extra,
         )
+        _note_openai(resp)
         return resp["choices"][0]["message"]["content"].strip()
 
-    def _chat_openai(self, messages: List[Dict[str, str]]) -> str:
+    def _stream_openai(self, prompt: str, system_prompt: Optional[str], temperature: float) -> Iterator[str]:
+        import openai  # precisa de pip install openai
+
+        openai.api_key = self.openai_api_key
+        messages = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        messages.append({"role": "user", "content": prompt})
+        _note(prompt_chars=len(prompt) + len(system_prompt or ""))
+        for chunk in openai.ChatCompletion.create(
+            model=self.openai_model,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+        ):
+            content = chunk["choices"][0].get("delta", {}).get("content")
+            if content:
+                yield content
+
+    def _chat_openai(self, messages: List[Dict[str, str]], temperature: float) -> str:
         import openai
         openai.api_key = self.openai_api_key
+        _note(prompt_chars=sum(len(m.get("content") or "") for m in messages))
         resp = openai.ChatCompletion.create(
             model=self.openai_model,
             messages=messages,
-            temperature=self.temperature,
+            temperature=temperature,
         )
+        _note_openai(resp)
         return resp["choices"][0]["message"]["content"].strip()
 
 
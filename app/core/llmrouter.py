@@ -0,0 +1,110 @@
+import copy
+import os
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+from core.llm import LLMWrapper
+
+
+class LLMRouter:
+    """
+    Roteamento de modelo por tarefa sobre um LLMWrapper base.
+    - for_task("bank_match") devolve um LLMWrapper com o modelo da tarefa,
+      compartilhando sessão, endpoints, cache, breaker e trace com o base
+      (a chave do cache inclui o modelo, então tarefas não se misturam)
+    - tarefas sem modelo configurado usam o modelo do base
+    - keep_alive vai em toda requisição, para o Ollama manter o modelo carregado
+    - warm_up() carrega os modelos das tarefas em uso em todos os endpoints;
+      start() faz isso na hora e repete a cada warmup_interval_s em segundo plano
+    Tarefas usadas hoje: "extract" (interpreter), "bank_match" (verify/match),
+    "compose" (compose).
+    """
+
+    def __init__(
+        self,
+        base: LLMWrapper,
+        models: Optional[Dict[str, str]] = None,
+        *,
+        keep_alive: Optional[str] = "30m",
+        warmup_interval_s: float = 0.0,
+    ):
+        self.base = base
+        self.models = dict(models or {})
+        self.keep_alive = keep_alive
+        self.warmup_interval_s = warmup_interval_s
+        self._tasks: Dict[str, LLMWrapper] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        base.keep_alive = keep_alive
+
+    @staticmethod
+    def parse_models(raw: str) -> Dict[str, str]:
+        """"extract=qwen2.5:7b-instruct,bank_match=qwen2.5:1.5b-instruct" → dict."""
+        models = {}
+        for item in raw.split(","):
+            task, sep, model = item.partition("=")
+            if sep and task.strip() and model.strip():
+                models[task.strip()] = model.strip()
+        return models
+
+    @classmethod
+    def from_env(cls, base: LLMWrapper) -> "LLMRouter":
+        """
+        LLM_MODELS="bank_match=qwen2.5:1.5b-instruct"  → modelo por tarefa (o resto usa o do base)
+        LLM_KEEP_ALIVE=30m                             → keep_alive enviado ao Ollama ("" = padrão do servidor)
+        LLM_WARMUP_INTERVAL_S=240                      → pings de warm-up periódicos (0 = só no start)
+        """
+        return cls(
+            base,
+            cls.parse_models(os.getenv("LLM_MODELS", "")),
+            keep_alive=os.getenv("LLM_KEEP_ALIVE", "30m") or None,
+            warmup_interval_s=float(os.getenv("LLM_WARMUP_INTERVAL_S", "240")),
+        )
+
+    def model_for(self, task: str) -> str:
+        return self.models.get(task, self.base.model)
+
+    def for_task(self, task: str) -> LLMWrapper:
+        with self._lock:
+            llm = self._tasks.get(task)
+            if llm is None:
+                llm = copy.copy(self.base)
+                llm.model = self.model_for(task)
+                if llm.provider == "openai" and task in self.models:
+                    llm.openai_model = llm.model
+                llm.label = task
+                llm.keep_alive = self.keep_alive
+                self._tasks[task] = llm
+            return llm
+
+    def warm_up(self, tasks: Optional[Iterable[str]] = None) -> None:
+        """Um ping por modelo distinto (tarefas que compartilham modelo não repetem)."""
+        with self._lock:
+            names = list(tasks) if tasks is not None else list(self._tasks)
+        seen = set()
+        for task in names:
+            llm = self.for_task(task)
+            if llm.model in seen:
+                continue
+            seen.add(llm.model)
+            for url, took in llm.warm_up().items():
+                print(f"[LLM] warm-up {task} → {llm.model} em {url}: {took:.2f}s")
+
+    def start(self, tasks: Optional[Iterable[str]] = None) -> None:
+        """warm_up() agora (bloqueia até os modelos carregarem) e, se configurado, periodicamente."""
+        tasks = list(tasks) if tasks is not None else None
+        self.warm_up(tasks)
+        if self.warmup_interval_s <= 0 or self._thread is not None:
+            return
+
+        def run() -> None:
+            while True:
+                time.sleep(self.warmup_interval_s)
+                try:
+                    self.warm_up(tasks)
+                except Exception as e:
+                    print(f"[LLM] warm-up periódico falhou: {e}")
+
+        self._thread = threading.Thread(target=run, name="llm-warmup", daemon=True)
+        self._thread.start()
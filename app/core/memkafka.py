@@ -0,0 +1,339 @@
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+from typing import Any, Callable
+
+from core.kafka import (
+    ORIGINAL_TOPIC_HEADER,
+    PAYLOAD_BYTES,
+    PRODUCED,
+    RETRY_NOT_BEFORE_HEADER,
+    KafkaJSON,
+    KafkaMessage,
+    RetryPolicy,
+    _KeyedPool,
+    source_id_key,
+)
+
+
+class InMemoryBroker:
+    """
+    Broker Kafka em processo, para testes de carga e benchmarks sem infraestrutura.
+    - tópicos criados sob demanda, com N partições cada
+    - partição escolhida por crc32(key), como o particionador padrão faz por hash
+    - offsets commitados por (grupo, tópico, partição); leitura a partir do início
+    """
+
+    def __init__(self, partitions: int = 3):
+        self.partitions = partitions
+        self._cond = threading.Condition()
+        self._topics: dict[str, list[list[tuple[bytes | None, bytes, list]]]] = {}
+        self._committed: dict[tuple[str, str, int], int] = {}
+
+    def _topic(self, topic: str) -> list:
+        t = self._topics.get(topic)
+        if t is None:
+            t = [[] for _ in range(self.partitions)]
+            self._topics[topic] = t
+        return t
+
+    def produce(self, topic: str, value: bytes, key: bytes | None, headers: list) -> tuple[int, int]:
+        with self._cond:
+            parts = self._topic(topic)
+            if key is None:
+                p = min(range(len(parts)), key=lambda i: len(parts[i]))
+            else:
+                p = zlib.crc32(key) % len(parts)
+            parts[p].append((key, value, headers))
+            self._cond.notify_all()
+            return p, len(parts[p]) - 1
+
+    def fetch(self, topics: list[str], positions: dict, max_messages: int, timeout: float) -> list:
+        """Até max_messages registros a partir de positions (atualizado in-place)."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                out = []
+                for topic in topics:
+                    for p, log in enumerate(self._topic(topic)):
+                        pos = positions.setdefault((topic, p), 0)
+                        while pos < len(log) and len(out) < max_messages:
+                            key, value, headers = log[pos]
+                            out.append((topic, p, pos, key, value, headers))
+                            pos += 1
+                        positions[(topic, p)] = pos
+                if out:
+                    return out
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._cond.wait(remaining)
+
+    def committed(self, group: str, topic: str, partition: int) -> int:
+        with self._cond:
+            return self._committed.get((group, topic, partition), 0)
+
+    def commit(self, group: str, topic: str, partition: int, offset: int) -> None:
+        with self._cond:
+            k = (group, topic, partition)
+            self._committed[k] = max(offset, self._committed.get(k, 0))
+
+    def lag(self, group: str, topic: str) -> int:
+        with self._cond:
+            return sum(
+                len(log) - self._committed.get((group, topic, p), 0)
+                for p, log in enumerate(self._topic(topic))
+            )
+
+    def wake(self) -> None:
+        with self._cond:
+            self._cond.notify_all()
+
+
+class _Record:
+    """Imita o suficiente de confluent_kafka.Message para reaproveitar o decode do KafkaJSON."""
+
+    def __init__(self, topic, partition, offset, key, value, headers):
+        self._t, self._p, self._o, self._k, self._v, self._h = topic, partition, offset, key, value, headers
+
+    def topic(self): return self._t
+    def partition(self): return self._p
+    def offset(self): return self._o
+    def key(self): return self._k
+    def value(self): return self._v
+    def headers(self): return self._h
+    def error(self): return None
+
+
+class InMemoryKafka(KafkaJSON):
+    """
+    Mesma interface do KafkaJSON (send/subscribe/poll_once/loop/consume_batch/
+    loop_batch/loop_retry/commit/partition_state/flush/close), sobre um InMemoryBroker.
+    Serializa com o mesmo Codec, então custo de CPU e tamanho de payload batem
+    com o caminho real. stop() encerra um loop() rodando em outra thread.
+    Backpressure (max_pending) não se aplica: não há fetch em segundo plano.
+    Com transactional_id, loop() usa o mesmo _loop_transactional_once do
+    KafkaJSON: os send() do lote ficam retidos e só chegam ao broker, junto
+    com os offsets, no commit; abort descarta os dois.
+    """
+
+    def __init__(
+        self,
+        broker: InMemoryBroker,
+        group_id: str = "python-client",
+        *,
+        codec: str | None = None,
+        key_fn: Callable[[Any], str | None] = source_id_key,
+        transactional_id: str | None = None,
+        transaction_max_messages: int = 200,
+        transaction_max_s: float = 15.0,
+        transaction_timeout_ms: int = 60_000,
+    ):
+        self._init_state(
+            group_id, codec=codec or "json", key_fn=key_fn, async_send=False, send_timeout_s=0.0,
+            transactional_id=transactional_id,
+            transaction_max_messages=transaction_max_messages,
+            transaction_max_s=transaction_max_s,
+            transaction_timeout_ms=transaction_timeout_ms,
+        )
+        self.broker = broker
+        self._topics: list[str] = []
+        self._positions: dict[tuple[str, int], int] = {}
+        self._stop = threading.Event()
+        self._txn_lock = threading.Lock()
+        self._txn_records: list | None = None
+        self._txn_offsets: list[KafkaMessage] = []
+
+    def send(self, topic, data, key=None, on_delivery=None, headers=None) -> Future:
+        if key is None and self.key_fn is not None:
+            key = self.key_fn(data)
+        payload = self.codec.encode(data)
+        PRODUCED.inc(topic=topic)
+        PAYLOAD_BYTES.observe(len(payload), topic=topic, direction="out")
+        all_headers = self.codec.headers()
+        if headers:
+            all_headers += [(k, str(v).encode("utf-8")) for k, v in headers.items()]
+        kb = key.encode("utf-8") if isinstance(key, str) else key
+        with self._txn_lock:
+            if self._txn_records is not None:
+                # dentro de transação: só vai para o broker no commit
+                self._txn_records.append((topic, payload, kb, all_headers))
+                p, o = -1, -1
+            else:
+                p, o = self.broker.produce(topic, payload, kb, all_headers)
+        rec = _Record(topic, p, o, kb, payload, all_headers)
+        if on_delivery is not None:
+            on_delivery(None, rec)
+        fut: Future = Future()
+        fut.set_result(rec)
+        self._track_sent(fut)
+        return fut
+
+    def flush(self, timeout: float | None = None) -> int:
+        return 0
+
+    def subscribe(self, topics: str | list[str]) -> None:
+        if isinstance(topics, str):
+            topics = [topics]
+        self._topics = list(topics)
+        for topic in self._topics:
+            for p in range(self.broker.partitions):
+                self._positions[(topic, p)] = self.broker.committed(self.group_id, topic, p)
+
+    def _fetch(self, max_messages: int, timeout: float) -> list[KafkaMessage]:
+        raw = self.broker.fetch(self._topics, self._positions, max_messages, timeout)
+        return [self._to_message(_Record(*r)) for r in raw]
+
+    def poll_once(self, callback, timeout: float = 1.0) -> bool:
+        msgs = self._fetch(1, timeout)
+        if not msgs:
+            return False
+        m = msgs[0]
+        if self._dispatch(callback, m):
+            self.broker.commit(self.group_id, m.topic, m.partition, m.offset + 1)
+        else:
+            self._rewind(msgs)
+        return True
+
+    def consume_batch(self, max_messages: int = 100, timeout: float = 1.0) -> list[KafkaMessage]:
+        return self._fetch(max_messages, timeout)
+
+    def commit(self, msgs: list[KafkaMessage]) -> None:
+        for m in msgs:
+            self.broker.commit(self.group_id, m.topic, m.partition, m.offset + 1)
+
+    def _rewind(self, msgs: list[KafkaMessage]) -> None:
+        for m in msgs:
+            tp = (m.topic, m.partition)
+            self._positions[tp] = min(self._positions.get(tp, m.offset), m.offset)
+
+    def _begin_transaction(self) -> None:
+        with self._txn_lock:
+            self._txn_records = []
+            self._txn_offsets = []
+
+    def _send_offsets_to_transaction(self, msgs: list[KafkaMessage]) -> None:
+        self._txn_offsets = list(msgs)
+
+    def _commit_transaction(self) -> None:
+        with self._txn_lock:
+            records, self._txn_records = self._txn_records or [], None
+            for topic, payload, key, headers in records:
+                self.broker.produce(topic, payload, key, headers)
+            self.commit(self._txn_offsets)
+            self._txn_offsets = []
+
+    def _abort_transaction(self) -> None:
+        with self._txn_lock:
+            self._txn_records = None
+            self._txn_offsets = []
+
+    def loop_batch(
+        self,
+        callback,
+        max_messages: int = 100,
+        timeout: float = 1.0,
+        *,
+        retry: RetryPolicy | None = None,
+    ) -> None:
+        self._retry = retry
+        backoff = 0.0
+        while not self._stop.is_set():
+            msgs = self.consume_batch(max_messages, timeout)
+            if not msgs:
+                continue
+            backoff = self._run_batch(callback, msgs, backoff)
+
+    def loop(
+        self,
+        callback,
+        timeout: float = 1.0,
+        *,
+        concurrency: int = 1,
+        key_fn: Callable[[Any], str | None] = source_id_key,
+        retry: RetryPolicy | None = None,
+        max_pending: int | None = None,
+        low_pending: int | None = None,
+    ) -> None:
+        self._retry = retry
+        try:
+            if self.transactional:
+                if concurrency > 1:
+                    self._pool = _KeyedPool(lambda m: self._dispatch(callback, m, persistent=True), concurrency)
+                while not self._stop.is_set():
+                    self._loop_transactional_once(callback, key_fn, timeout)
+                return
+            if concurrency <= 1:
+                while not self._stop.is_set():
+                    self.poll_once(callback, timeout)
+                return
+            self._pool = _KeyedPool(lambda m: self._dispatch(callback, m, persistent=True), concurrency)
+            while not self._stop.is_set():
+                for m in self._fetch(1, timeout):
+                    self._tracker.begin(m.topic, m.partition, m.offset)
+                    self._pool.submit(m.key or key_fn(m.data), m)
+                self._store_completed()
+        finally:
+            self.close()
+
+    def _store_completed(self) -> None:
+        if self._pool is None:
+            return
+        while not self._pool.completed.empty():
+            m = self._pool.completed.get_nowait()
+            commit = self._tracker.complete(m.topic, m.partition, m.offset)
+            if commit is not None:
+                self.broker.commit(self.group_id, m.topic, m.partition, commit)
+
+    def loop_retry(self, timeout: float = 1.0) -> None:
+        """
+        Scheduler dos tópicos de retry, como o do KafkaJSON: mensagem ainda
+        não vencida volta a posição e "pausa" só aquela partição até
+        x-retry-not-before; vencida é republicada no tópico original com os
+        mesmos headers.
+        """
+        paused: dict[tuple[str, int], float] = {}
+        try:
+            while not self._stop.is_set():
+                now = time.time()
+                for tp, resume_at in list(paused.items()):
+                    if resume_at <= now:
+                        paused.pop(tp)
+                moved = False
+                for r in self.broker.fetch(self._topics, self._positions, 100, timeout):
+                    rec = _Record(*r)
+                    tp = (rec.topic(), rec.partition())
+                    if tp in paused:
+                        self._positions[tp] = min(self._positions[tp], rec.offset())
+                        continue
+                    headers = self._decode_headers(rec)
+                    not_before = int(headers.get(RETRY_NOT_BEFORE_HEADER, "0") or 0) / 1000
+                    if not_before > now:
+                        self._positions[tp] = min(self._positions[tp], rec.offset())
+                        paused[tp] = not_before
+                        continue
+                    original = headers.get(ORIGINAL_TOPIC_HEADER)
+                    if not original:
+                        print(f"Mensagem de retry sem {ORIGINAL_TOPIC_HEADER}, descartando:", rec.topic(), rec.offset())
+                    else:
+                        self.broker.produce(original, rec.value(), rec.key(), rec.headers())
+                    self.broker.commit(self.group_id, rec.topic(), rec.partition(), rec.offset() + 1)
+                    moved = True
+                if not moved and paused:
+                    # só há mensagens não vencidas: dorme até a primeira vencer
+                    self._stop.wait(max(0.0, min([timeout] + [at - time.time() for at in paused.values()])))
+        finally:
+            self.close()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self.broker.wake()
+
+    def close(self) -> None:
+        self._closing.set()
+        self._interrupt.set()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._store_completed()
+            self._pool = None
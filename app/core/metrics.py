@@ -0,0 +1,226 @@
+import bisect
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+def _key(labels: Optional[Dict[str, object]]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in (labels or {}).items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(key: LabelKey) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in key) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        k = _key(labels)
+        with self._lock:
+            self._values[k] = self._values.get(k, 0.0) + amount
+
+    def samples(self) -> List[Tuple[str, LabelKey, float]]:
+        with self._lock:
+            return [(self.name, k, v) for k, v in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        k = _key(labels)
+        with self._lock:
+            self._values[k] = float(value)
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # por label: (contagem por bucket, soma, total)
+        self._values: Dict[LabelKey, Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        k = _key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total, n = self._values.get(k) or ([0] * (len(self.buckets) + 1), 0.0, 0)
+            counts[idx] += 1
+            self._values[k] = (counts, total + value, n + 1)
+
+    def time(self, **labels) -> "_Timer":
+        return _Timer(self, labels)
+
+    def snapshot(self) -> Dict[LabelKey, Tuple[List[int], float, int]]:
+        with self._lock:
+            return {k: (list(c), s, n) for k, (c, s, n) in self._values.items()}
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """Estimativa pelo limite superior do bucket (suficiente para dumps/benchmarks)."""
+        data = self.snapshot().get(_key(labels))
+        if not data or data[2] == 0:
+            return None
+        counts, _, n = data
+        target = q * n
+        acc = 0
+        for i, c in enumerate(counts):
+            acc += c
+            if acc >= target:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def samples(self) -> List[Tuple[str, LabelKey, float]]:
+        out = []
+        for k, (counts, total, n) in self.snapshot().items():
+            acc = 0
+            for bound, c in zip(list(self.buckets) + [float("inf")], counts):
+                acc += c
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                out.append((f"{self.name}_bucket", k + (("le", le),), acc))
+            out.append((f"{self.name}_sum", k, total))
+            out.append((f"{self.name}_count", k, n))
+        return out
+
+
+class _Timer:
+    def __init__(self, hist: Histogram, labels: Dict[str, object]):
+        self._hist = hist
+        self._labels = labels
+
+    def __enter__(self):
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._hist.observe(time.perf_counter() - self._t0, **self._labels)
+
+
+class Registry:
+    """
+    Registro de métricas em memória (processo inteiro), no formato texto do Prometheus.
+    - counter()/gauge()/histogram() criam ou devolvem a métrica pelo nome
+    - render() gera o texto de /metrics
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, object] = {}
+
+    def _get(self, cls, name: str, help_text: str, **kw):
+        with self._lock:
+            m = self._metrics.get(name)
+            if m is None:
+                m = cls(name, help_text, **kw)
+                self._metrics[name] = m
+            return m
+
+    def counter(self, name: str, help_text: str = "") -> Counter:
+        return self._get(Counter, name, help_text)
+
+    def gauge(self, name: str, help_text: str = "") -> Gauge:
+        return self._get(Gauge, name, help_text)
+
+    def histogram(self, name: str, help_text: str = "", buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help_text, buckets=buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for m in metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            for name, key, value in m.samples():
+                lines.append(f"{name}{_fmt_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Sobe GET /metrics numa thread daemon."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"Métricas em http://{host}:{port}/metrics")
+    return server
+
+
+def start_stats_dump(interval_s: float) -> threading.Thread:
+    """Imprime periodicamente o texto das métricas no stdout (sem precisar de scrape)."""
+    def _run():
+        while True:
+            time.sleep(interval_s)
+            print("[METRICS]\n" + REGISTRY.render(), end="")
+
+    t = threading.Thread(target=_run, name="metrics-dump", daemon=True)
+    t.start()
+    return t
+
+
+_started = False
+_started_lock = threading.Lock()
+
+
+def start_from_env() -> None:
+    """
+    Liga a exposição de métricas uma única vez por processo:
+      METRICS_PORT=9100            → endpoint Prometheus
+      METRICS_DUMP_INTERVAL_S=60   → dump periódico no stdout
+    """
+    global _started
+    with _started_lock:
+        if _started:
+            return
+        _started = True
+    port = os.getenv("METRICS_PORT", "")
+    if port:
+        try:
+            start_http_server(int(port))
+        except OSError as e:
+            print(f"Não foi possível abrir METRICS_PORT={port}: {e}")
+    interval = os.getenv("METRICS_DUMP_INTERVAL_S", "")
+    if interval:
+        start_stats_dump(float(interval))
@@ -3,7 +3,7 @@ from typing import Optional, List, Dict, Any
 import os
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from core.database import Database
+from core.database import Database, is_transient_error
 
 
 class DatabaseEnricher:
@@ -15,19 +15,23 @@ class DatabaseEnricher:
     def get_user_id_from_source(self, source_id: int) -> Optional[int]:
         try:
             sql = "SELECT user_id FROM user_source WHERE source_id = %s"
-            return self.db.fetchval(sql, (source_id,))
+            return self.db.fetchval(sql, (source_id,), prepare=True)
         except Exception as e:
+            if is_transient_error(e):
+                raise
             print(f"[ERRO] get_user_id_from_source: {e}")
             return None
 
     def get_user_metadata(self, user_id: int) -> Optional[Dict[str, Any]]:
         try:
             sql = "SELECT user_id, full_name FROM users WHERE user_id = %s"
-            row = self.db.fetchone(sql, (user_id,))
+            row = self.db.fetchone(sql, (user_id,), prepare=True)
             if not row:
                 return None
             return {"id": row["user_id"], "full_name": row["full_name"]}
         except Exception as e:
+            if is_transient_error(e):
+                raise
             print(f"[ERRO] get_user_metadata: {e}")
             return None
 
@@ -39,7 +43,7 @@ class DatabaseEnricher:
                 WHERE user_id = %s
                 LIMIT 1
             """
-            row = self.db.fetchone(sql, (user_id,))
+            row = self.db.fetchone(sql, (user_id,), prepare=True)
             if not row:
                 return None
             return {
@@ -48,6 +52,8 @@ class DatabaseEnricher:
                 "credit_usage": float(row.get("credit_usage") or 0.0),
             }
         except Exception as e:
+            if is_transient_error(e):
+                raise
             print(f"[ERRO] get_account_data: {e}")
             return None
 
@@ -63,7 +69,7 @@ class DatabaseEnricher:
                 WHERE user_id = %s
                 ORDER BY transaction_ts DESC
             """
-            rows = self.db.fetchall(sql, (user_id,))
+            rows = self.db.fetchall(sql, (user_id,), prepare=True)
             return [
                 {
                     "transaction_id": r["transaction_id"],
@@ -75,6 +81,8 @@ class DatabaseEnricher:
                 for r in rows
             ]
         except Exception as e:
+            if is_transient_error(e):
+                raise
             print(f"[ERRO] get_transactions: {e}")
             return []
 
@@ -90,7 +98,7 @@ class DatabaseEnricher:
                 WHERE a.user_id = %s
                 ORDER BY i.invested_at DESC
             """
-            rows = self.db.fetchall(sql, (user_id,))
+            rows = self.db.fetchall(sql, (user_id,), prepare=True)
             return [
                 {
                     "investment_id": r["investment_id"],
@@ -101,6 +109,8 @@ class DatabaseEnricher:
                 for r in rows
             ]
         except Exception as e:
+            if is_transient_error(e):
+                raise
             print(f"[ERRO] get_investments: {e}")
             return []
 
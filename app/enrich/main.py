@@ -1,26 +1,16 @@
 # file: ingest/enrich_worker.py
 import os
 import sys
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from core.kafka import KafkaJSON
+from core.kafka import KafkaJSON, RetryPolicy, instance_transactional_id, send_json, start_retry_scheduler
 from core.database import Database
 from database_enricher import DatabaseEnricher
 from message_enricher import MessageEnricher
 
 
-def send_json(k: KafkaJSON, topic: str, obj: Dict[str, Any]) -> None:
-    """Compatível com clientes que expõem send(...) ou publish(...)."""
-    if hasattr(k, "send"):
-        k.send(topic, obj)
-    elif hasattr(k, "publish"):
-        k.publish(topic, obj)
-    else:
-        raise AttributeError("KafkaJSON não possui 'send' nem 'publish'.")
-
-
 class EnrichWorker:
     def __init__(
         self,
@@ -29,18 +19,33 @@ class EnrichWorker:
         output_topic: str,
         group_id: str,
         database_enricher: DatabaseEnricher,
+        concurrency: int = 1,
+        retry: Optional[RetryPolicy] = None,
+        kafka_client: Optional[KafkaJSON] = None,
+        transactional_id: Optional[str] = None,
+        transaction_max_messages: int = 200,
+        transaction_max_s: float = 15.0,
+        cache_size: int = 10_000,
+        cache_ttl_s: float = 300.0,
     ):
-        self.kafka_client = KafkaJSON(broker=kafka_broker, group_id=group_id)
+        self.kafka_client = kafka_client or KafkaJSON(
+            broker=kafka_broker, group_id=group_id, transactional_id=transactional_id,
+            transaction_max_messages=transaction_max_messages, transaction_max_s=transaction_max_s,
+        )
+        self.kafka_broker = kafka_broker
+        self.group_id = group_id
+        self.retry = retry
         self.input_topic = input_topic
         self.output_topic = output_topic
         self.database_enricher = database_enricher
-        self.message_enricher = MessageEnricher(database_enricher)
+        self.concurrency = concurrency
+        self.message_enricher = MessageEnricher(database_enricher, cache_size=cache_size, cache_ttl_s=cache_ttl_s)
         print(f"EnrichWorker pronto. IN={self.input_topic} OUT={self.output_topic} BROKER={kafka_broker} GROUP={group_id}")
 
     def process_message(self, topic: str, data: Dict[str, Any]):
         print(f"[MSG] recebido de '{topic}': {data}")
         try:
-            enriched = self.message_enricher.enrich(data)
+            enriched = self.message_enricher.enrich(data, cache=self.kafka_client.partition_state())
             if enriched:
                 send_json(self.kafka_client, self.output_topic, enriched)
                 print(f"[OK] enviado para '{self.output_topic}': {enriched}")
@@ -48,13 +53,16 @@ class EnrichWorker:
                 print("[SKIP] não foi possível enriquecer a mensagem.")
         except Exception as e:
             print(f"[ERRO] process_message: {e}")
+            raise
 
     def start(self):
         print("Iniciando EnrichWorker...")
         print(f"→ Subscribing: {self.input_topic}")
         self.kafka_client.subscribe(self.input_topic)
+        if self.retry:
+            start_retry_scheduler(self.kafka_broker, self.group_id, self.input_topic, self.retry)
         try:
-            self.kafka_client.loop(self.process_message)
+            self.kafka_client.loop(self.process_message, concurrency=self.concurrency, retry=self.retry)
         except KeyboardInterrupt:
             print("\nEncerrando por KeyboardInterrupt...")
         finally:
@@ -67,6 +75,14 @@ def main():
     INPUT_TOPIC = os.getenv("INPUT_TOPIC", "btg.verified")
     OUTPUT_TOPIC = os.getenv("OUTPUT_TOPIC", "btg.enriched")
     GROUP_ID = os.getenv("GROUP_ID", "btg-enrich-worker-group")
+    HANDLER_CONCURRENCY = int(os.getenv("HANDLER_CONCURRENCY", "1"))
+    # exactly-once: prefixo do transactional.id; o hostname da réplica é anexado
+    TRANSACTIONAL_ID = instance_transactional_id(os.getenv("KAFKA_TRANSACTIONAL_ID"))
+    TRANSACTION_MAX_MESSAGES = int(os.getenv("KAFKA_TRANSACTION_MAX_MESSAGES", "200"))
+    TRANSACTION_MAX_S = float(os.getenv("KAFKA_TRANSACTION_MAX_S", "15"))
+    # cache por partição de source_id → user_id e perfil do usuário
+    CACHE_SIZE = int(os.getenv("ENRICH_CACHE_SIZE", "10000"))
+    CACHE_TTL_S = float(os.getenv("ENRICH_CACHE_TTL_S", "300"))
 
     DB_CONFIG = {
         "host": os.getenv("PGHOST", "localhost"),
@@ -88,6 +104,13 @@ def main():
         output_topic=OUTPUT_TOPIC,
         group_id=GROUP_ID,
         database_enricher=db_enricher,
+        concurrency=HANDLER_CONCURRENCY,
+        retry=RetryPolicy.from_env(),
+        transactional_id=TRANSACTIONAL_ID,
+        transaction_max_messages=TRANSACTION_MAX_MESSAGES,
+        transaction_max_s=TRANSACTION_MAX_S,
+        cache_size=CACHE_SIZE,
+        cache_ttl_s=CACHE_TTL_S,
     )
     worker.start()
 
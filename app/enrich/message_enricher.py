@@ -1,11 +1,22 @@
 from typing import Dict, Any, Optional
 from database_enricher import DatabaseEnricher
+from core.ttlcache import TTLCache
 
 
 class MessageEnricher:
     
-    def __init__(self, database_enricher: DatabaseEnricher):
+    def __init__(self, database_enricher: DatabaseEnricher, cache_size: int = 10_000, cache_ttl_s: float = 300.0):
         self.database = database_enricher
+        self.cache_size = cache_size
+        self.cache_ttl_s = cache_ttl_s
+
+    def _cache(self, cache: Optional[Dict[str, Any]], name: str) -> TTLCache:
+        if cache is None:
+            return TTLCache(0)
+        found = cache.get(name)
+        if found is None:
+            found = cache.setdefault(name, TTLCache(self.cache_size, self.cache_ttl_s))
+        return found
     
     def validate_schema(self, message_value: Dict[str, Any]) -> bool:
         if not isinstance(message_value.get('source_id'), int):
@@ -53,7 +64,13 @@ class MessageEnricher:
         
         return True
     
-    def enrich(self, message_value: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    def enrich(self, message_value: Dict[str, Any], cache: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """
+        cache (opcional) é o estado da partição: guarda source_id → user_id e os
+        metadados do usuário, que quase não mudam, por até cache_ttl_s e no
+        máximo cache_size entradas (descartado no rebalance). Conta, transações
+        e investimentos sempre vêm do banco.
+        """
         try:
             if not isinstance(message_value, dict):
                 print(f"Message discarded: expected dict but got {type(message_value).__name__}. Message: {message_value}")
@@ -64,13 +81,23 @@ class MessageEnricher:
             
             source_id = message_value['source_id']
             
-            user_id = self.database.get_user_id_from_source(source_id)
+            user_ids = self._cache(cache, "user_ids")
+            user_id = user_ids.get(source_id)
+            if user_id is None:
+                user_id = self.database.get_user_id_from_source(source_id)
+                if user_id is not None:
+                    user_ids[source_id] = user_id
             
             if user_id is None:
                 print(f"user_id not found for source_id={source_id}, cannot enrich message")
                 return None
             
-            user_metadata = self.database.get_user_metadata(user_id)
+            metadata_cache = self._cache(cache, "user_metadata")
+            user_metadata = metadata_cache.get(user_id)
+            if user_metadata is None:
+                user_metadata = self.database.get_user_metadata(user_id)
+                if user_metadata is not None:
+                    metadata_cache[user_id] = user_metadata
             if user_metadata is None:
                 print(f"user_metadata not found for user_id={user_id}")
                 return None
@@ -105,5 +132,5 @@ class MessageEnricher:
                 
         except Exception as e:
             print(f"Error enriching message: {e}")
-            return None
+            raise
 
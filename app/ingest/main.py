@@ -3,11 +3,13 @@ import sys
 import time
 import json
 import base64
-from typing import Optional
+import mimetypes
+from typing import Any, Dict, Optional
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from core.kafka import KafkaJSON
+from core.blobstore import blob_store_from_url
 
 
 class RawPublisher:
@@ -16,7 +18,9 @@ class RawPublisher:
     - Conecta no __init__ (ou via with ... as ...)
     - publish() envia payload já montado
     - publish_base64() envia string base64 como attachment_data
-    - publish_file() lê um arquivo binário e envia em base64 com padding correto
+    - publish_bytes() grava o conteúdo no blob store e envia só a referência
+      (claim-check); sem blob store configurado, cai para base64 inline
+    - publish_file() lê um arquivo binário e envia via publish_bytes()
     """
 
     def __init__(
@@ -25,10 +29,12 @@ class RawPublisher:
         topic: Optional[str] = None,
         *,
         auto_connect: bool = True,
+        blob_store=None,
     ):
         self.broker_url = broker_url or os.getenv("KAFKA_BROKER_URL", "localhost:29092")
         self.topic = topic or os.getenv("TOPIC_OUT_NAME", "btg.raw")
         self._kafka: Optional[KafkaJSON] = None
+        self.blob_store = blob_store if blob_store is not None else blob_store_from_url()
 
         if auto_connect:
             self.connect()
@@ -74,18 +80,25 @@ class RawPublisher:
         *,
         source_id: int,
         attachment_type: str,
-        attachment_data: str,
+        attachment_data: Optional[str] = None,
+        attachment_ref: Optional[Dict[str, Any]] = None,
         timestamp_ms: Optional[int] = None,
     ) -> None:
         """
-        Publica uma mensagem já com attachment_data pronto (ex.: base64).
+        Publica uma mensagem já com attachment_data pronto (ex.: base64)
+        ou com attachment_ref (referência do blob store).
         """
+        if attachment_data is None and attachment_ref is None:
+            raise ValueError("Informe attachment_data ou attachment_ref.")
         payload = {
             "source_id": int(source_id),
             "attachment_type": str(attachment_type),
-            "attachment_data": str(attachment_data),
             "timestamp": int(timestamp_ms if timestamp_ms is not None else self._now_ms()),
         }
+        if attachment_ref is not None:
+            payload["attachment_ref"] = dict(attachment_ref)
+        else:
+            payload["attachment_data"] = str(attachment_data)
 
         print(f"Publicando no tópico '{self.topic}': {json.dumps(payload)[:400]}...")
         try:
@@ -121,6 +134,35 @@ class RawPublisher:
             timestamp_ms=timestamp_ms,
         )
 
+    def publish_bytes(
+        self,
+        *,
+        source_id: int,
+        data: bytes,
+        attachment_type: str = "image",
+        mime: str = "application/octet-stream",
+        timestamp_ms: Optional[int] = None,
+    ) -> None:
+        """
+        Grava os bytes no blob store e publica só a referência (sha256, size, mime).
+        Sem blob store configurado (BLOB_STORE_URL), envia base64 inline como antes.
+        """
+        if self.blob_store is None:
+            self.publish(
+                source_id=source_id,
+                attachment_type=attachment_type,
+                attachment_data=base64.b64encode(data).decode("ascii"),
+                timestamp_ms=timestamp_ms,
+            )
+            return
+        ref = self.blob_store.put(data, mime=mime)
+        self.publish(
+            source_id=source_id,
+            attachment_type=attachment_type,
+            attachment_ref=ref,
+            timestamp_ms=timestamp_ms,
+        )
+
     def publish_file(
         self,
         *,
@@ -130,16 +172,18 @@ class RawPublisher:
         timestamp_ms: Optional[int] = None,
     ) -> None:
         """
-        Lê um arquivo binário e envia como base64 (padding correto, sem quebras).
+        Lê um arquivo binário e envia via publish_bytes()
+        (referência no blob store, ou base64 sem quebras se não houver store).
         Ideal para imagens: attachment_type="image".
         """
         if not os.path.isfile(filepath):
             raise FileNotFoundError(f"Arquivo não encontrado: {filepath}")
         with open(filepath, "rb") as f:
-            b64 = base64.b64encode(f.read()).decode("ascii")
-        self.publish(
+            data = f.read()
+        self.publish_bytes(
             source_id=source_id,
+            data=data,
             attachment_type=attachment_type,
-            attachment_data=b64,
+            mime=mimetypes.guess_type(filepath)[0] or "application/octet-stream",
             timestamp_ms=timestamp_ms,
         )
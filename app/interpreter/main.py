@@ -6,8 +6,9 @@ from typing import Any, Dict, Optional, List, Callable, Tuple
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from core.llm import LLMWrapper
-from core.kafka import KafkaJSON
+from core.llm import CircuitBreaker, EndpointPool, LLMCache, LLMJSONError, LLMTrace, LLMWrapper, estimate_tokens
+from core.llmrouter import LLMRouter
+from core.kafka import KafkaJSON, send_json
 
 
 INPUT_TOPIC = os.getenv("INPUT_TOPIC", "btg.parsed")
@@ -20,6 +21,10 @@ OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "qwen2.5:7b-instruct")  # ajuste p/ qwe
 LLM_PROVIDER = os.getenv("LLM_PROVIDER", "ollama")
 LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.0"))
 DEBUG = os.getenv("DEBUG", "0") == "1"
+HANDLER_CONCURRENCY = int(os.getenv("HANDLER_CONCURRENCY", "1"))
+MAX_PENDING = int(os.getenv("MAX_PENDING", "0")) or None
+OCR_PROMPT_MAX_TOKENS = int(os.getenv("OCR_PROMPT_MAX_TOKENS", "600"))  # orçamento dos campos OCR no prompt
+OCR_VALUE_MAX_CHARS = 160
 
 def extract_brl_amount(text: str) -> Optional[float]:
     """
@@ -214,18 +219,6 @@ def tiny_fallback(payload: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
-def send_json(k: KafkaJSON, topic: str, obj: Dict[str, Any]) -> None:
-    """
-    Compatibiliza clientes que expõem k.send(...) ou k.publish(...).
-    """
-    if hasattr(k, "send"):
-        k.send(topic, obj)
-    elif hasattr(k, "publish"):
-        k.publish(topic, obj)
-    else:
-        raise AttributeError("KafkaJSON não possui 'send' nem 'publish'.")
-
-
 SYSTEM = "Você extrai dados de boletos/contratos. Responda apenas JSON válido."
 USER_TPL = """Você é um extrator de dados de documentos bancários.
 
@@ -249,35 +242,98 @@ Regras:
 Campos OCR:
 {payload}
 """
+OUTPUT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "company": {"type": ["string", "null"]},
+        "installment_amount": {"type": ["number", "string", "null"]},
+    },
+    "required": ["company", "installment_amount"],
+}
+
+OCR_LABEL_WEIGHTS = (
+    ("VALOR", 4), ("PARCELA", 3), ("PLANO", 2), ("DOCUMENTO", 1),
+    ("BANCO", 4), ("BENEFICI", 4), ("CEDENTE", 3), ("FAVORECIDO", 3), ("CREDOR", 3),
+)
+MONEY_RE = re.compile(r"(?<!\d)(\d{1,3}(?:\.\d{3})*,\d{2}|\d+,\d{2})(?!\d)")
+BANK_RE = re.compile(r"\b(Banco|BV|Votorantim|Financeira|S\.?A\.?)\b", re.IGNORECASE)
+
+
+def ocr_relevance(label: Optional[str], value: str, conf: float) -> float:
+    """
+    Quanto um campo OCR ajuda a achar company/installment_amount:
+    palavras-chave no label, valor com cara de dinheiro ou de banco,
+    e a confiança do OCR (0-100) como desempate.
+    """
+    L = (label or "").upper()
+    score = float(sum(w for key, w in OCR_LABEL_WEIGHTS if key in L))
+    if MONEY_RE.search(value):
+        score += 3
+    if BANK_RE.search(value):
+        score += 3
+    return score + conf / 100.0
+
 
-def prepare_reduced_ocr(payload: Dict[str, Any]) -> List[Dict[str, Optional[str]]]:
+def build_ocr_prompt_fields(payload: Dict[str, Any], max_tokens: int = OCR_PROMPT_MAX_TOKENS) -> str:
+    """
+    Campos OCR para o prompt, dentro de max_tokens (estimate_tokens):
+    - remove duplicados e corta valores longos
+    - escolhe os campos por relevância até o orçamento acabar
+    - devolve na ordem do documento, em JSON compacto (sem indent)
+    """
     att = payload.get("attachment_parsed", []) or []
-    reduced = []
-    for it in att:
+    seen = set()
+    ranked = []
+    for pos, it in enumerate(att):
+        value = " ".join(str(it.get("value_text") or "").split())
+        if not value:
+            continue
         label = it.get("label_text")
-        value = it.get("value_text")
-        if value:
-            lab_norm = None if label is None else " ".join(str(label).split())
-            val_norm = " ".join(str(value).split())
-            reduced.append({"label": lab_norm, "value": val_norm})
-    return reduced
+        label = None if label is None else " ".join(str(label).split())
+        if (label, value) in seen:
+            continue
+        seen.add((label, value))
+        conf = float(it.get("value_conf") or 0.0)
+        ranked.append((ocr_relevance(label, value, conf), pos, label, value))
+
+    ranked.sort(key=lambda x: (-x[0], x[1]))
+    chosen = []
+    used = 2  # colchetes
+    for _, pos, label, value in ranked:
+        if max_tokens - used < 12:
+            break  # nem o menor campo ({"label":null,"value":"x"}) cabe mais
+        field = {"label": label, "value": value[:OCR_VALUE_MAX_CHARS]}
+        text = json.dumps(field, ensure_ascii=False, separators=(",", ":"))
+        cost = estimate_tokens(text) + 1  # vírgula
+        if used + cost > max_tokens:
+            continue  # um campo menor ainda pode caber
+        chosen.append((pos, text))
+        used += cost
+    if DEBUG:
+        print(f"[DBG] OCR prompt: {len(chosen)}/{len(ranked)} campos, ~{used} tokens")
+    chosen.sort()
+    return "[" + ",".join(text for _, text in chosen) + "]"
 
 
 def call_llm(payload: Dict[str, Any], llm: LLMWrapper) -> Optional[Dict[str, Any]]:
     """
-    Usa seu LLMWrapper.generate() e tenta extrair JSON com: company, installment_amount.
+    Usa LLMWrapper.generate_json() (saída estruturada) para extrair: company, installment_amount.
     Parcelas NÃO vêm da LLM aqui.
     """
     try:
-        reduced = prepare_reduced_ocr(payload)
-        txt = llm.generate(
-            prompt=USER_TPL.format(payload=json.dumps(reduced, ensure_ascii=False, indent=2)),
-            system_prompt=SYSTEM,
-        )
-        data = LLMWrapper.extract_json(txt)
-        if not data:
+        fields = build_ocr_prompt_fields(payload)
+        try:
+            data = llm.generate_json(
+                prompt=USER_TPL.format(payload=fields),
+                schema=OUTPUT_SCHEMA,
+                system_prompt=SYSTEM,
+                label="interpreter.extract",
+                # breaker aberto: extração por regex na hora, sem esperar o timeout
+                fallback=lambda: tiny_fallback(payload),
+            )
+        except LLMJSONError as e:
             if DEBUG:
-                print("[DBG] LLM returned no JSON")
+                print(f"[DBG] LLM returned no valid JSON: {e}")
             return None
 
         # normaliza installment_amount se vier string BR
@@ -356,18 +412,27 @@ def make_handler(k: KafkaJSON, llm: LLMWrapper) -> Callable[[str, Dict[str, Any]
 
 
 def main():
-    llm = LLMWrapper(
+    base_llm = LLMWrapper(
         provider=LLM_PROVIDER,
         model=OLLAMA_MODEL,
         temperature=LLM_TEMPERATURE,
         ollama_base_url=OLLAMA_BASE_URL,
+        pool_size=max(10, HANDLER_CONCURRENCY),  # uma conexão keep-alive por thread
+        cache=LLMCache.from_env(),
+        breaker=CircuitBreaker.from_env(OLLAMA_BASE_URL),
+        endpoints=EndpointPool.from_env(OLLAMA_BASE_URL),  # aceita várias URLs separadas por vírgula
+        trace=LLMTrace.from_env(),
     )
+    # modelo por tarefa (LLM_MODELS), keep_alive e warm-up antes de consumir
+    router = LLMRouter.from_env(base_llm)
+    llm = router.for_task("extract")
+    router.start(["extract"])
 
     
     k = KafkaJSON(KAFKA_BOOTSTRAP, GROUP_ID)
     k.subscribe(INPUT_TOPIC)
 
-    k.loop(make_handler(k, llm))
+    k.loop(make_handler(k, llm), concurrency=HANDLER_CONCURRENCY, max_pending=MAX_PENDING)
 
 
 if __name__ == "__main__":
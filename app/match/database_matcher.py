@@ -1,5 +1,5 @@
 from typing import Optional, Dict, Any, List
-from core.database import Database
+from core.database import Database, is_transient_error
 
 
 class DatabaseMatcher:
@@ -28,13 +28,14 @@ class DatabaseMatcher:
                 """
                 SELECT id, name, tax_mes, max_amount, type
                 FROM financing_types
-                WHERE LOWER(type) = LOWER(%s)
+                WHERE LOWER(type) = LOWER(%s::text)
                 AND tax_mes < %s
                 AND max_amount >= %s
                 ORDER BY tax_mes ASC
                 LIMIT 1
                 """,
-                (financing_type, current_rate_decimal, remaining_amount)
+                (financing_type, current_rate_decimal, remaining_amount),
+                prepare=True,
             )
 
             print(f"Resultado da query: {result}")
@@ -50,6 +51,8 @@ class DatabaseMatcher:
             return None
 
         except Exception as e:
+            if is_transient_error(e):
+                raise
             print(f"Erro ao buscar melhor oferta: {e}")
             return None
     
@@ -121,25 +124,8 @@ class DatabaseMatcher:
         savings_amount: Optional[float] = None
     ) -> Optional[int]:
         try:
-            existing = self.db.fetchone(
-                """
-                SELECT id, offered FROM bank_financing_offers
-                WHERE bank_id = %s 
-                AND user_id = %s
-                AND installments_count = %s
-                ORDER BY created_at DESC
-                LIMIT 1
-                """,
-                (bank_id, user_id, installments_count)
-            )
-            
-            if not existing:
-                print(f"Nenhuma oferta encontrada para atualizar (bank_id={bank_id}, user_id={user_id})")
-                return None
-            
-            record_id = existing['id'] if isinstance(existing, dict) else existing[0]
-
-            rowcount = self.db.execute(
+            # localiza a oferta mais recente e atualiza no mesmo comando
+            result = self.db.execute_returning(
                 """
                 UPDATE bank_financing_offers 
                 SET asset_value = %s,
@@ -151,22 +137,32 @@ class DatabaseMatcher:
                     offer_id = %s,
                     financed_amount = %s,
                     savings_amount = %s
-                WHERE id = %s
+                WHERE id = (
+                    SELECT id FROM bank_financing_offers
+                    WHERE bank_id = %s
+                    AND user_id = %s
+                    AND installments_count = %s
+                    ORDER BY created_at DESC
+                    LIMIT 1
+                )
+                RETURNING id
                 """,
                 (
                     asset_value, monthly_interest_rate, total_value_with_interest,
                     financing_type, offered,
                     offered_interest_rate, offer_id, financed_amount, savings_amount,
-                    record_id
+                    bank_id, user_id, installments_count
                 )
             )
 
-            if rowcount > 0:
-                print(f"Oferta atualizada: id={record_id}")
-                return record_id
-            else:
+            if not result:
+                print(f"Nenhuma oferta encontrada para atualizar (bank_id={bank_id}, user_id={user_id})")
                 return None
 
+            record_id = result['id'] if isinstance(result, dict) else result[0]
+            print(f"Oferta atualizada: id={record_id}")
+            return record_id
+
         except Exception as e:
             print(f"Erro ao atualizar oferta: {e}")
             return None
@@ -2,10 +2,14 @@ import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from core.kafka import KafkaJSON
+from typing import Optional
+
+from core.kafka import KafkaJSON, RetryPolicy, instance_transactional_id, start_retry_scheduler
 from message_matcher import MessageMatcher
 from database_matcher import DatabaseMatcher
-from core.llm import LLMWrapper
+from core.llm import CircuitBreaker, EndpointPool, LLMCache, LLMTrace, LLMWrapper
+from core.llmrouter import LLMRouter
+from core.ttlcache import TTLCache
 
 
 class MatchWorker:
@@ -16,16 +20,42 @@ class MatchWorker:
         input_topic: str,
         group_id: str,
         database_matcher: DatabaseMatcher,
-        llm: LLMWrapper
+        llm: LLMWrapper,
+        concurrency: int = 1,
+        retry: Optional[RetryPolicy] = None,
+        kafka_client: Optional[KafkaJSON] = None,
+        transactional_id: Optional[str] = None,
+        transaction_max_messages: int = 10,
+        transaction_max_s: float = 15.0,
+        cache_size: int = 10_000,
+        cache_ttl_s: float = 300.0
     ):
-        self.kafka_client = KafkaJSON(broker=kafka_broker, group_id=group_id)
+        self.kafka_client = kafka_client or KafkaJSON(
+            broker=kafka_broker, group_id=group_id, transactional_id=transactional_id,
+            transaction_max_messages=transaction_max_messages, transaction_max_s=transaction_max_s,
+        )
+        self.kafka_broker = kafka_broker
+        self.group_id = group_id
+        self.retry = retry
         self.input_topic = input_topic
         self.database_matcher = database_matcher
+        self.concurrency = concurrency
+        self.cache_size = cache_size
+        self.cache_ttl_s = cache_ttl_s
         self.message_matcher = MessageMatcher(database_matcher, self.kafka_client, llm)
     
     def process_message(self, topic: str, data: dict):
         print(f"Message received from topic '{topic}'")
-        self.message_matcher.process(data)
+        self.message_matcher.process(data, bank_cache=self._bank_cache())
+
+    def _bank_cache(self) -> TTLCache:
+        # nome da empresa (texto livre do OCR) → bank_id: limitado e com validade,
+        # para não crescer sem fim e para enxergar mudanças na tabela de bancos
+        state = self.kafka_client.partition_state()
+        found = state.get("bank_ids")
+        if found is None:
+            found = state.setdefault("bank_ids", TTLCache(self.cache_size, self.cache_ttl_s))
+        return found
     
     def start(self):
         print(f"Starting Match Worker...")
@@ -33,9 +63,11 @@ class MatchWorker:
         print("Press Ctrl+C to stop\n")
         
         self.kafka_client.subscribe(self.input_topic)
+        if self.retry:
+            start_retry_scheduler(self.kafka_broker, self.group_id, self.input_topic, self.retry)
         
         try:
-            self.kafka_client.loop(self.process_message)
+            self.kafka_client.loop(self.process_message, concurrency=self.concurrency, retry=self.retry)
         finally:
             self.database_matcher.close()
             print("Worker stopped")
@@ -45,6 +77,13 @@ def main():
     KAFKA_BROKER = os.getenv("KAFKA_BROKER_URL", "localhost:29092")
     INPUT_TOPIC = os.getenv("INPUT_TOPIC", "btg.enriched")
     GROUP_ID = os.getenv("GROUP_ID", "btg-match-worker-group")
+    HANDLER_CONCURRENCY = int(os.getenv("HANDLER_CONCURRENCY", "1"))
+    # exactly-once: prefixo do transactional.id; o hostname da réplica é anexado
+    TRANSACTIONAL_ID = instance_transactional_id(os.getenv("KAFKA_TRANSACTIONAL_ID"))
+    TRANSACTION_MAX_MESSAGES = int(os.getenv("KAFKA_TRANSACTION_MAX_MESSAGES", "10"))  # cada mensagem chama o LLM: lotes pequenos
+    TRANSACTION_MAX_S = float(os.getenv("KAFKA_TRANSACTION_MAX_S", "15"))
+    CACHE_SIZE = int(os.getenv("MATCH_CACHE_SIZE", "10000"))
+    CACHE_TTL_S = float(os.getenv("MATCH_CACHE_TTL_S", "300"))
 
     DB_CONFIG = {
         'host': os.getenv('PGHOST', 'localhost'),
@@ -62,19 +101,35 @@ def main():
     print("Initializing Match Worker...")
     
     database_matcher = DatabaseMatcher(**DB_CONFIG)
-    llm = LLMWrapper(
+    base_llm = LLMWrapper(
         provider=LLM_PROVIDER,
         model=LLM_MODEL,
         temperature=LLM_TEMPERATURE,
-        ollama_base_url=OLLAMA_BASE_URL
+        ollama_base_url=OLLAMA_BASE_URL,
+        pool_size=max(10, HANDLER_CONCURRENCY),  # uma conexão keep-alive por thread
+        cache=LLMCache.from_env(),
+        breaker=CircuitBreaker.from_env(OLLAMA_BASE_URL),
+        endpoints=EndpointPool.from_env(OLLAMA_BASE_URL),  # aceita várias URLs separadas por vírgula
+        trace=LLMTrace.from_env(),
     )
+    # modelo por tarefa (LLM_MODELS), keep_alive e warm-up antes de consumir
+    router = LLMRouter.from_env(base_llm)
+    llm = router.for_task("bank_match")
+    router.start(["bank_match"])
     
     worker = MatchWorker(
         kafka_broker=KAFKA_BROKER,
         input_topic=INPUT_TOPIC,
         group_id=GROUP_ID,
         database_matcher=database_matcher,
-        llm=llm
+        llm=llm,
+        concurrency=HANDLER_CONCURRENCY,
+        retry=RetryPolicy.from_env(),
+        transactional_id=TRANSACTIONAL_ID,
+        transaction_max_messages=TRANSACTION_MAX_MESSAGES,
+        transaction_max_s=TRANSACTION_MAX_S,
+        cache_size=CACHE_SIZE,
+        cache_ttl_s=CACHE_TTL_S
     )
     
     worker.start()
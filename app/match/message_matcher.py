@@ -1,5 +1,4 @@
 import time
-import json
 from typing import Dict, Any, Optional
 from interest_calculator import InterestCalculator
 from database_matcher import DatabaseMatcher
@@ -9,6 +8,11 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from core.llm import LLMWrapper
 
+BANK_MATCH_SCHEMA = {
+    "type": "object",
+    "properties": {"id": {"type": "integer"}},
+    "required": ["id"],
+}
 
 
 class MessageMatcher:
@@ -123,7 +127,7 @@ class MessageMatcher:
         new_total_from_now = new_pmt * remaining_installments
         return max(0.0, current_total_from_now - new_total_from_now)
     
-    def process(self, message_value: Dict[str, Any]):
+    def process(self, message_value: Dict[str, Any], bank_cache: Optional[Dict[str, int]] = None):
         try:
             if not self.validate_schema(message_value):
                 return
@@ -227,7 +231,8 @@ class MessageMatcher:
                 interest_rate=interest_rate,
                 installment_count=installment_count,
                 has_offer=best_offer is not None,
-                best_offer=best_offer
+                best_offer=best_offer,
+                bank_cache=bank_cache
             )
             
             if not should_send:
@@ -300,11 +305,13 @@ class MessageMatcher:
                 has_offer=best_offer is not None,
                 best_offer=best_offer,
                 remaining_amount=remaining_amount,
-                potential_savings=potential_savings if best_offer else 0
+                potential_savings=potential_savings if best_offer else 0,
+                bank_cache=bank_cache
             )
                 
         except Exception as e:
             print(f"Error processing message: {e}")
+            raise
     
     def should_send_offer(
         self,
@@ -313,7 +320,8 @@ class MessageMatcher:
         interest_rate: float,
         installment_count: int,
         has_offer: bool,
-        best_offer: Optional[Dict]
+        best_offer: Optional[Dict],
+        bank_cache: Optional[Dict[str, int]] = None
     ) -> bool:
         try:
             if not has_offer:
@@ -331,11 +339,7 @@ class MessageMatcher:
             if not user_id:
                 return True
             
-            banks = self.database.get_all_banks()
-            if not banks:
-                return True
-            
-            bank_id = self.check_bank_with_llm(company_name, banks)
+            bank_id = self.resolve_bank_id(company_name, bank_cache)
             if not bank_id:
                 return True
             
@@ -359,6 +363,23 @@ class MessageMatcher:
             print(f"Error checking if should send offer: {e}")
             return True
     
+    def resolve_bank_id(self, company_name: str, bank_cache=None) -> Optional[int]:
+        """
+        Nome da empresa → bank_id, consultando primeiro o cache da partição
+        (mesmo cliente, mesma partição) antes de ir ao banco + LLM.
+        bank_cache: qualquer objeto com get/__setitem__ (o worker usa um TTLCache).
+        """
+        cached = bank_cache.get(company_name) if bank_cache is not None else None
+        if cached is not None:
+            return cached
+        banks = self.database.get_all_banks()
+        if not banks:
+            return None
+        bank_id = self.check_bank_with_llm(company_name, banks)
+        if bank_id and bank_cache is not None:
+            bank_cache[company_name] = bank_id
+        return bank_id
+    
     def check_bank_with_llm(self, company_name: str, banks: list) -> Optional[int]:
         try:
             bank_list = "\n".join([f"- {b['name']} (ID: {b['id']})" for b in banks])
@@ -376,16 +397,17 @@ Available banks in our database:
 Which bank ID matches this company? Return ONLY JSON format:
 {{"id": 123}}"""
             
-            response = self.llm.generate(prompt=prompt, system_prompt=system_prompt)
-            
-            print(f"LLM response for bank matching: {response}")
+            # classificação: temperatura 0 deixa a resposta determinística (e cacheável)
+            result = self.llm.generate_json(
+                prompt=prompt,
+                schema=BANK_MATCH_SCHEMA,
+                system_prompt=system_prompt,
+                temperature=0.0,
+                label="match.bank_match",
+            )
             
-            response_clean = response.strip()
-            if response_clean.startswith("```"):
-                lines = response_clean.split("\n")
-                response_clean = "\n".join([l for l in lines if not l.startswith("```")])
+            print(f"LLM response for bank matching: {result}")
             
-            result = json.loads(response_clean)
             return result.get('id')
             
         except Exception as e:
@@ -404,7 +426,8 @@ Which bank ID matches this company? Return ONLY JSON format:
         has_offer: bool,
         best_offer: Optional[Dict],
         remaining_amount: float,
-        potential_savings: float
+        potential_savings: float,
+        bank_cache: Optional[Dict[str, int]] = None
     ):
         try:
             agent_analysis = message_value.get('agent_analysis', {})
@@ -422,12 +445,7 @@ Which bank ID matches this company? Return ONLY JSON format:
                 print("No user_id found in user_data")
                 return
             
-            banks = self.database.get_all_banks()
-            if not banks:
-                print("No banks in database")
-                return
-            
-            bank_id = self.check_bank_with_llm(company_name, banks)
+            bank_id = self.resolve_bank_id(company_name, bank_cache)
             if not bank_id:
                 print(f"Could not match company '{company_name}' to any bank")
                 return
@@ -7,6 +7,8 @@ import psycopg2
 from psycopg2 import pool
 from psycopg2.extras import RealDictCursor
 
+from core.database import QueryStats
+
 
 Params = Union[Tuple[Any, ...], List[Any], Dict[str, Any], None]
 
@@ -23,6 +25,7 @@ class Database:
         minconn: int = 1,
         maxconn: int = 10,
         use_dict_cursor: bool = True,
+        stats: Optional[QueryStats] = None,
     ):
         self.host = host or os.getenv("PGHOST", "postgres")
         self.port = port or int(os.getenv("PGPORT", "5432"))
@@ -31,6 +34,8 @@ class Database:
         self.password = password or os.getenv("PGPASSWORD", "postgres")
 
         self.use_dict_cursor = use_dict_cursor
+        self.stats = stats or QueryStats.from_env(self.database)
+        self.stats.pool_size(maxconn)
 
         self._pool: pool.ThreadedConnectionPool = psycopg2.pool.ThreadedConnectionPool(
             minconn=minconn,
@@ -48,30 +53,30 @@ class Database:
 
     @contextmanager
     def _get_conn_cursor(self):
-        conn = self._pool.getconn()
-        try:
+        with self.stats.checkout(self._pool) as conn:
             cur = conn.cursor(cursor_factory=self._cursor_factory())
             try:
                 yield conn, cur
             finally:
                 cur.close()
-        finally:
-            self._pool.putconn(conn)
 
     def execute(self, sql: str, params: Params = None) -> int:
         with self._get_conn_cursor() as (conn, cur):
-            cur.execute(sql, params)
+            with self.stats.query(conn, sql, params):
+                cur.execute(sql, params)
             conn.commit()
             return cur.rowcount
 
     def fetchone(self, sql: str, params: Params = None):
-        with self._get_conn_cursor() as (_, cur):
-            cur.execute(sql, params)
+        with self._get_conn_cursor() as (conn, cur):
+            with self.stats.query(conn, sql, params):
+                cur.execute(sql, params)
             return cur.fetchone()
 
     def fetchall(self, sql: str, params: Params = None) -> List[Any]:
-        with self._get_conn_cursor() as (_, cur):
-            cur.execute(sql, params)
+        with self._get_conn_cursor() as (conn, cur):
+            with self.stats.query(conn, sql, params):
+                cur.execute(sql, params)
             return cur.fetchall()
 
     def fetchval(self, sql: str, params: Params = None) -> Any:
@@ -84,8 +89,7 @@ class Database:
 
     @contextmanager
     def transaction(self):
-        conn = self._pool.getconn()
-        try:
+        with self.stats.checkout(self._pool) as conn:
             cur = conn.cursor(cursor_factory=self._cursor_factory())
             try:
                 yield cur
@@ -95,8 +99,6 @@ class Database:
                 raise
             finally:
                 cur.close()
-        finally:
-            self._pool.putconn(conn)
 
     def healthcheck(self) -> bool:
         try:
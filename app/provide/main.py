@@ -1,11 +1,12 @@
 import os
 import sys
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify
 from flask_cors import CORS
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from provide.database import Database
+from core import metrics
 
 app = Flask(__name__)
 CORS(app)
@@ -53,6 +54,11 @@ def get_all_offers():
         }), 500
 
 
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/health", methods=["GET"])
 def health():
     try:
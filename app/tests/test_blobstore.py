@@ -0,0 +1,36 @@
+"""LocalBlobStore: tipo do conteúdo e limpeza por idade."""
+import os
+import time
+
+from core.blobstore import LocalBlobStore, sniff_mime
+
+
+def test_sniff_mime():
+    assert sniff_mime(b"\x89PNG\r\n\x1a\n....") == "image/png"
+    assert sniff_mime(b"\xff\xd8\xff\xe0....") == "image/jpeg"
+    assert sniff_mime(b"%PDF-1.7") == "application/pdf"
+    assert sniff_mime(b"RIFF\x00\x00\x00\x00WEBPVP8 ") == "image/webp"
+    assert sniff_mime(b"texto") == "application/octet-stream"
+
+
+def test_cleanup_removes_only_old_blobs(tmp_path):
+    store = LocalBlobStore(str(tmp_path))
+    old = store.put(b"antigo", mime="image/png")
+    new = store.put(b"novo")
+    past = time.time() - 3600
+    os.utime(store._path(old["sha256"]), (past, past))
+
+    assert store.cleanup(60) == 1
+    assert not store.exists(old)
+    assert store.exists(new)
+
+
+def test_put_again_renews_age(tmp_path):
+    store = LocalBlobStore(str(tmp_path))
+    ref = store.put(b"mesmo")
+    past = time.time() - 3600
+    os.utime(store._path(ref["sha256"]), (past, past))
+    store.put(b"mesmo")
+
+    assert store.cleanup(60) == 0
+    assert store.exists(ref)
@@ -0,0 +1,88 @@
+"""Smoke tests do core.Database contra um pool falso (sem Postgres)."""
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+
+from core import database
+from core.database import Database, QueryStats
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+        self._rows = []
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append((sql, params))
+        if sql.startswith(("PREPARE", "DEALLOCATE")):
+            self._rows = []
+            return
+        self._rows = [dict(r) for r in self.conn.rows]
+        self.rowcount = len(self._rows)
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def close(self):
+        pass
+
+
+class FakeConn:
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+        self.commits = 0
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+
+class FakePool:
+    def __init__(self, minconn, maxconn, **kwargs):
+        self.conn = FakeConn([{"id": 7}])
+        self.out = 0
+
+    def getconn(self):
+        self.out += 1
+        return self.conn
+
+    def putconn(self, conn):
+        self.out -= 1
+
+    def closeall(self):
+        pass
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(database.psycopg2.pool, "ThreadedConnectionPool", FakePool)
+    return Database(stats=QueryStats("test", slow_ms=1e9))
+
+
+def test_fetch_and_execute_go_through_the_pool(db):
+    assert db.fetchval("SELECT id FROM banks WHERE name = %s", ("x",)) == 7
+    assert db.fetchone("SELECT id FROM banks") == {"id": 7}
+    assert db.fetchall("SELECT id FROM banks") == [{"id": 7}]
+    assert db.execute_returning("INSERT INTO banks (name) VALUES (%s) RETURNING id", ("x",)) == {"id": 7}
+    assert db.execute("UPDATE banks SET name = %s", ("y",)) == 1
+    assert db._pool.out == 0
+    assert db._pool.conn.commits == 2
+
+
+def test_prepared_statement_is_reused_per_connection(db):
+    sql = "SELECT id FROM banks WHERE name = %s"
+    db.fetchval(sql, ("a",), prepare=True)
+    db.fetchval(sql, ("b",), prepare=True)
+    executed = [s for s, _ in db._pool.conn.executed]
+    assert sum(s.startswith("PREPARE") for s in executed) == 1
+    assert sum(s.startswith("EXECUTE") for s in executed) == 2
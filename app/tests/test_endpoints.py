@@ -0,0 +1,163 @@
+"""EndpointPool: seleção, health check, hedge e classificação de falhas contra servidores locais."""
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from core.llm import EndpointPool, LLMJSONError, LLMWrapper
+
+
+class Stub:
+    """Ollama falso: reply(path) → (status, corpo, atraso_s); conta as requisições por caminho."""
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.hits = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _serve(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+                stub.hits.append(self.path)
+                status, body, delay = stub.reply(self.path)
+                time.sleep(delay)
+                raw = body if isinstance(body, bytes) else json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+
+            do_GET = do_POST = _serve
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def generate_hits(self):
+        return self.hits.count("/api/generate")
+
+
+def ok(delay=0.0):
+    return lambda path: (200, {"response": "ok"}, delay)
+
+
+@pytest.fixture
+def stubs():
+    started = []
+
+    def start(reply):
+        s = Stub(reply)
+        started.append(s)
+        return s
+
+    yield start
+    for s in started:
+        s.server.shutdown()
+        s.server.server_close()
+
+
+def dead_url():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return f"http://127.0.0.1:{port}"
+
+
+def make_llm(pool):
+    return LLMWrapper(model="m", endpoints=pool, max_retries=0, timeout_s=5)
+
+
+def is_down(pool, url):
+    return pool._down_until[url] > time.monotonic()
+
+
+def test_5xx_takes_host_out_of_selection(stubs):
+    bad = stubs(lambda path: (500, {"error": "boom"}, 0.0))
+    good = stubs(ok())
+    pool = EndpointPool([bad.url, good.url], down_s=30)
+    llm = make_llm(pool)
+
+    assert [llm.generate("p") for _ in range(4)] == ["ok"] * 4
+    # o round-robin tenta o host ruim uma vez; depois do 500 ele fica fora da seleção
+    assert bad.generate_hits() == 1
+    assert good.generate_hits() == 4
+    assert is_down(pool, bad.url)
+
+
+def test_connection_error_takes_host_out_of_selection(stubs):
+    good = stubs(ok())
+    dead = dead_url()
+    pool = EndpointPool([dead, good.url], down_s=30)
+    llm = make_llm(pool)
+
+    assert [llm.generate("p") for _ in range(4)] == ["ok"] * 4
+    assert good.generate_hits() == 4
+    assert is_down(pool, dead)
+    assert pool._outstanding[dead] == 0
+
+
+def test_4xx_does_not_take_host_out(stubs):
+    stub = stubs(lambda path: (400, {"error": "modelo inexistente"}, 0.0))
+    pool = EndpointPool([stub.url])
+    llm = make_llm(pool)
+
+    with pytest.raises(requests.HTTPError):
+        llm.generate("p")
+    assert not is_down(pool, stub.url)
+
+
+def test_undecodable_body_does_not_take_host_out(stubs):
+    stub = stubs(lambda path: (200, b"<html>proxy</html>", 0.0))
+    pool = EndpointPool([stub.url])
+    llm = make_llm(pool)
+
+    with pytest.raises(LLMJSONError):
+        llm.generate("p")
+    assert not is_down(pool, stub.url)
+
+
+def test_health_check_marks_hosts(stubs):
+    sick = stubs(lambda path: (503, {}, 0.0) if path == "/api/tags" else (200, {"response": "ok"}, 0.0))
+    healthy = stubs(ok())
+    pool = EndpointPool([sick.url, healthy.url], health_interval_s=0.05)
+    make_llm(pool)  # sobe a thread de health check
+
+    deadline = time.monotonic() + 3
+    while not is_down(pool, sick.url) and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert is_down(pool, sick.url)
+    assert not is_down(pool, healthy.url)
+    assert {pool.acquire() for _ in range(4)} == {healthy.url}
+
+
+def test_least_outstanding_prefers_idle_host(stubs):
+    a, b = stubs(ok()), stubs(ok())
+    pool = EndpointPool([a.url, b.url])
+    busy = pool.acquire()
+    assert pool.acquire() != busy
+    pool.release(busy, 0.01)
+
+
+def test_hedge_answers_from_the_fast_host(stubs):
+    slow = stubs(ok(delay=1.0))
+    fast = stubs(ok())
+    pool = EndpointPool([slow.url, fast.url], hedge=True, hedge_min_s=0.05)
+    pool._latencies.extend([0.01] * 20)  # amostra para o p95
+    llm = make_llm(pool)
+
+    for _ in range(2):  # o round-robin põe cada host como primário uma vez
+        t0 = time.monotonic()
+        assert llm.generate("p") == "ok"
+        assert time.monotonic() - t0 < 0.8
+    assert fast.generate_hits() == 2
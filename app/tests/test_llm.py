@@ -0,0 +1,122 @@
+"""LLMWrapper e CircuitBreaker, sem Ollama (httpx.MockTransport e chamadas falsas)."""
+import asyncio
+import json
+import time
+
+import pytest
+import requests
+
+httpx = pytest.importorskip("httpx")
+
+from core.llm import CircuitBreaker, EndpointPool, LLMCache, LLMJSONError, LLMWrapper
+
+
+def make_llm(urls, **kwargs):
+    return LLMWrapper(model="m", endpoints=EndpointPool(urls), **kwargs)
+
+
+def mock_client(handler):
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def test_agenerate_caps_concurrency_per_endpoint():
+    llm = make_llm(["http://a", "http://b"], max_concurrency=1)
+    inflight = {"a": 0, "b": 0}
+    peak = {"a": 0, "b": 0}
+
+    async def handler(request):
+        host = request.url.host
+        inflight[host] += 1
+        peak[host] = max(peak[host], inflight[host])
+        await asyncio.sleep(0.02)
+        inflight[host] -= 1
+        prompt = json.loads(request.content)["prompt"]
+        return httpx.Response(200, json={"response": f"{host}:{prompt.strip()}"})
+
+    async def run():
+        client = mock_client(handler)
+        llm._async_client = lambda: client
+        try:
+            return await asyncio.gather(*(llm.agenerate(f"p{i}") for i in range(6)))
+        finally:
+            await client.aclose()
+
+    out = asyncio.run(run())
+    assert sorted(o.split(":")[1] for o in out) == [f"p{i}" for i in range(6)]
+    assert peak == {"a": 1, "b": 1}
+
+
+def test_semaphore_is_keyed_by_endpoint_and_limit():
+    one, other, wider = make_llm("http://a", max_concurrency=1), make_llm("http://a", max_concurrency=1), make_llm("http://a", max_concurrency=8)
+
+    async def run():
+        assert one._semaphore("http://a") is other._semaphore("http://a")
+        assert one._semaphore("http://a") is not wider._semaphore("http://a")
+        assert one._semaphore("http://a") is not one._semaphore("http://b")
+
+    asyncio.run(run())
+
+
+def test_sync_and_async_share_the_cache():
+    llm = make_llm("http://a", cache=LLMCache())
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.path)
+        return httpx.Response(200, json={"message": {"content": " oi "}})
+
+    async def run():
+        client = mock_client(handler)
+        llm._async_client = lambda: client
+        try:
+            return await llm.achat([{"role": "user", "content": "olá"}])
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(run()) == "oi"
+    assert llm.chat([{"role": "user", "content": "olá"}]) == "oi"
+    assert calls == ["/api/chat"]
+
+
+def test_breaker_closed_open_half_open_closed():
+    breaker = CircuitBreaker("t", window_size=4, min_calls=2, failure_rate=0.5, open_s=0.05, max_open_s=1)
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record(True, 0.01)
+    breaker.record(False, 0.01)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()  # uma única vaga de teste
+    breaker.record(False, 0.01)
+    assert breaker.state == CircuitBreaker.OPEN  # falhou no teste: reabre com open_s dobrado
+
+    time.sleep(0.06)
+    assert breaker.state == CircuitBreaker.OPEN
+    time.sleep(0.08)
+    assert breaker.allow()
+    breaker.record(True, 0.01)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_bad_model_output_does_not_trip_the_breaker():
+    breaker = CircuitBreaker("t", window_size=4, min_calls=2, failure_rate=0.5)
+    llm = make_llm("http://a", breaker=breaker)
+
+    def bad_output():
+        raise LLMJSONError("JSON inválido do LLM", "{")
+
+    for _ in range(4):
+        with pytest.raises(LLMJSONError):
+            llm._guard(bad_output)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    def down():
+        raise requests.ConnectionError("recusada")
+
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            llm._guard(down)
+    assert breaker.state == CircuitBreaker.OPEN
@@ -0,0 +1,62 @@
+"""match: cache nome da empresa → bank_id por partição."""
+import importlib.util
+import os
+import sys
+import time
+
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("confluent_kafka")
+
+from core.ttlcache import TTLCache
+
+MATCH_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "match"))
+
+
+def load_match_main():
+    if MATCH_DIR not in sys.path:
+        sys.path.insert(0, MATCH_DIR)
+    spec = importlib.util.spec_from_file_location("test_match_main", os.path.join(MATCH_DIR, "main.py"))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+class FakeKafka:
+    def __init__(self):
+        self.state = {}
+
+    def partition_state(self):
+        return self.state
+
+
+class FakeDatabase:
+    def get_all_banks(self):
+        return [{"id": 3, "name": "Banco X"}]
+
+
+def test_bank_cache_is_bounded_and_expires():
+    match_main = load_match_main()
+    worker = match_main.MatchWorker(
+        kafka_broker="", input_topic="in", group_id="g", database_matcher=FakeDatabase(), llm=None,
+        kafka_client=FakeKafka(), cache_size=1, cache_ttl_s=0.05,
+    )
+    cache = worker._bank_cache()
+    assert isinstance(cache, TTLCache)
+    assert worker._bank_cache() is cache
+
+    matcher = worker.message_matcher
+    calls = []
+    matcher.check_bank_with_llm = lambda name, banks: calls.append(name) or 3
+
+    assert matcher.resolve_bank_id("Banco X", cache) == 3
+    assert matcher.resolve_bank_id("Banco X", cache) == 3
+    assert calls == ["Banco X"]
+
+    matcher.resolve_bank_id("Banco Y", cache)
+    assert len(cache) == 1
+
+    time.sleep(0.06)
+    matcher.resolve_bank_id("Banco Y", cache)
+    assert calls == ["Banco X", "Banco Y", "Banco Y"]
@@ -0,0 +1,219 @@
+"""InMemoryKafka: offsets, retry com atraso e lotes, sem broker."""
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+pytest.importorskip("confluent_kafka")
+
+from confluent_kafka import TopicPartition
+from core.kafka import KafkaMessage, RetryPolicy, _KeyedPool, _OffsetTracker
+from core.memkafka import InMemoryBroker, InMemoryKafka
+
+
+def test_loop_retry_redelivers_after_delay():
+    broker = InMemoryBroker(partitions=2)
+    policy = RetryPolicy((1,))
+    seen = []
+
+    def handler(topic, data):
+        seen.append(time.monotonic())
+        if len(seen) == 1:
+            raise ValueError("falha transitória")
+
+    worker = InMemoryKafka(broker, "g")
+    worker.subscribe("in")
+    scheduler = InMemoryKafka(broker, "g-retry")
+    scheduler.subscribe(policy.retry_topics("in"))
+    threads = [
+        threading.Thread(target=worker.loop, args=(handler, 0.1), kwargs={"retry": policy}, daemon=True),
+        threading.Thread(target=scheduler.loop_retry, args=(0.1,), daemon=True),
+    ]
+    for t in threads:
+        t.start()
+    worker.send("in", {"source_id": 1})
+
+    deadline = time.monotonic() + 5
+    while len(seen) < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    worker.stop()
+    scheduler.stop()
+
+    assert len(seen) == 2
+    assert seen[1] - seen[0] >= 0.9
+    assert broker.lag("g-retry", policy.retry_topic("in", 1)) == 0
+
+
+def test_loop_batch_survives_failed_batch():
+    broker = InMemoryBroker(partitions=1)
+    batches = []
+
+    def handler(msgs):
+        batches.append([m.data["n"] for m in msgs])
+        if len(batches) == 1:
+            raise ValueError("falha transitória")
+
+    k = InMemoryKafka(broker, "g")
+    k.subscribe("in")
+    k.send("in", {"n": 1})
+    k.send("in", {"n": 2})
+    t = threading.Thread(target=k.loop_batch, args=(handler, 10, 0.1), daemon=True)
+    t.start()
+
+    deadline = time.monotonic() + 5
+    while len(batches) < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    k.stop()
+    t.join(timeout=5)
+
+    assert batches == [[1, 2], [1, 2]]
+    assert broker.lag("g", "in") == 0
+
+
+class FailingDelivery(InMemoryKafka):
+    """send() com delivery report de erro enquanto fail=True."""
+
+    fail = True
+
+    def send(self, topic, data, key=None, on_delivery=None, headers=None):
+        if not self.fail:
+            return super().send(topic, data, key, on_delivery, headers)
+        fut = Future()
+        fut.set_exception(RuntimeError("broker fora do ar"))
+        self._track_sent(fut)
+        return fut
+
+
+def test_offset_waits_for_output_delivery():
+    broker = InMemoryBroker(partitions=1)
+    calls = []
+
+    k = FailingDelivery(broker, "g")
+    k.subscribe("in")
+    InMemoryKafka(broker, "p").send("in", {"n": 1})
+
+    def handler(topic, data):
+        calls.append(data["n"])
+        k.send("out", data)
+
+    assert k.poll_once(handler, 0.1)
+    assert broker.committed("g", "in", 0) == 0
+
+    k.fail = False
+    assert k.poll_once(handler, 0.1)
+    assert calls == [1, 1]
+    assert broker.committed("g", "in", 0) == 1
+    assert broker.lag("g", "in") == 0
+
+
+def test_tracker_commits_only_contiguous_offsets():
+    tracker = _OffsetTracker()
+    for offset in (0, 1, 2):
+        tracker.begin("in", 0, offset)
+    assert tracker.complete("in", 0, 2) is None
+    assert tracker.complete("in", 0, 0) == 1
+    assert tracker.complete("in", 0, 1) == 3
+    assert tracker.pending() == 0
+
+
+def test_keyed_pool_keeps_a_key_on_one_lane():
+    seen = []
+    pool = _KeyedPool(lambda m: seen.append((m.key, m.offset, threading.current_thread().name)), 4)
+    for offset in range(20):
+        key = "a" if offset % 2 else "b"
+        pool.submit(key, KafkaMessage("in", 0, offset, key, {}))
+    pool.join()
+    pool.shutdown()
+
+    for key in ("a", "b"):
+        mine = [(offset, lane) for k, offset, lane in seen if k == key]
+        assert len({lane for _, lane in mine}) == 1
+        assert [offset for offset, _ in mine] == sorted(offset for offset, _ in mine)
+
+
+def test_concurrent_loop_does_not_commit_past_unfinished_offset():
+    broker = InMemoryBroker(partitions=1)
+    release = threading.Event()
+    done = []
+    # chaves em lanes diferentes da bloqueada (a lane é hash(chave) % concurrency)
+    others = [n for n in range(2, 100) if hash(str(n)) % 3 != hash("1") % 3][:2]
+
+    def handler(topic, data):
+        if data["source_id"] == 1:
+            release.wait(5)
+        done.append(data["source_id"])
+
+    k = InMemoryKafka(broker, "g")
+    k.subscribe("in")
+    for source_id in [1] + others:
+        k.send("in", {"source_id": source_id})
+    t = threading.Thread(target=k.loop, args=(handler, 0.05), kwargs={"concurrency": 3}, daemon=True)
+    t.start()
+
+    deadline = time.monotonic() + 5
+    while len(done) < 2 and time.monotonic() < deadline:
+        time.sleep(0.02)
+    time.sleep(0.1)
+    assert sorted(done) == others
+    assert broker.committed("g", "in", 0) == 0  # offset 0 ainda em voo segura a partição
+
+    release.set()
+    while broker.committed("g", "in", 0) < 3 and time.monotonic() < deadline:
+        time.sleep(0.02)
+    k.stop()
+    t.join(timeout=5)
+    assert broker.committed("g", "in", 0) == 3
+
+
+class RetryTopicDown(InMemoryKafka):
+    """Tópicos de retry/DLQ fora do ar: send() neles levanta exceção."""
+
+    def send(self, topic, data, key=None, on_delivery=None, headers=None):
+        if ".retry." in topic or topic.endswith(".dlq"):
+            raise RuntimeError(f"{topic} fora do ar")
+        return super().send(topic, data, key, on_delivery, headers)
+
+
+def start_stuck_lane(broker):
+    attempts = []
+
+    def handler(topic, data):
+        attempts.append(time.monotonic())
+        raise ValueError("falha")
+
+    k = RetryTopicDown(broker, "g")
+    k.subscribe("in")
+    k.send("in", {"source_id": 1})
+    t = threading.Thread(
+        target=k.loop, args=(handler, 0.05), kwargs={"concurrency": 2, "retry": RetryPolicy((1,))}, daemon=True,
+    )
+    t.start()
+    deadline = time.monotonic() + 5
+    while not attempts and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return k, t, attempts
+
+
+def test_stuck_lane_gives_up_on_close():
+    broker = InMemoryBroker(partitions=1)
+    k, t, attempts = start_stuck_lane(broker)
+
+    t0 = time.monotonic()
+    k.stop()
+    t.join(timeout=5)
+    assert not t.is_alive()
+    assert time.monotonic() - t0 < 2
+    assert broker.committed("g", "in", 0) == 0
+
+
+def test_stuck_lane_does_not_block_revoke():
+    broker = InMemoryBroker(partitions=1)
+    k, t, attempts = start_stuck_lane(broker)
+
+    t0 = time.monotonic()
+    k._on_revoke(None, [TopicPartition("in", 0)])
+    assert time.monotonic() - t0 < 2
+    assert broker.committed("g", "in", 0) == 0
+    k.stop()
+    t.join(timeout=5)
@@ -0,0 +1,91 @@
+"""Modo exactly-once (_loop_transactional_once) sobre o InMemoryKafka."""
+import time
+
+import pytest
+
+pytest.importorskip("confluent_kafka")
+
+from confluent_kafka import KafkaError, KafkaException
+
+from core.memkafka import InMemoryBroker, InMemoryKafka
+
+
+class AbortOnce(InMemoryKafka):
+    """Primeiro commit falha com erro abortável, como um fencing/timeout do broker."""
+
+    failed = False
+
+    def _commit_transaction(self):
+        if not self.failed:
+            self.failed = True
+            raise KafkaException(KafkaError(KafkaError._STATE, "transação expirou", txn_requires_abort=True))
+        super()._commit_transaction()
+
+
+def produced(broker, topic):
+    return broker.lag("ninguém", topic)
+
+
+def setup(broker, cls=InMemoryKafka, n=5, **kwargs):
+    k = cls(broker, "g", transactional_id="t-1", **kwargs)
+    k.subscribe("in")
+    for i in range(n):
+        k.send("in", {"source_id": i})
+    return k
+
+
+def forward(k, seen=None, delay_s=0.0):
+    def handler(topic, data):
+        if seen is not None:
+            seen.append(data["source_id"])
+        time.sleep(delay_s)
+        k.send("out", data)
+    return handler
+
+
+def test_abort_discards_outputs_and_rewinds():
+    broker = InMemoryBroker(partitions=1)
+    k = setup(broker, AbortOnce)
+    seen = []
+    handler = forward(k, seen)
+
+    k._loop_transactional_once(handler, None, 0.1)
+    assert seen == [0, 1, 2, 3, 4]
+    assert produced(broker, "out") == 0
+    assert broker.committed("g", "in", 0) == 0
+
+    k._loop_transactional_once(handler, None, 0.1)
+    assert seen == [0, 1, 2, 3, 4] * 2
+    assert produced(broker, "out") == 5
+    assert broker.committed("g", "in", 0) == 5
+
+
+def test_transaction_max_messages_limits_the_batch():
+    broker = InMemoryBroker(partitions=1)
+    k = setup(broker, transaction_max_messages=2)
+    handler = forward(k)
+
+    k._loop_transactional_once(handler, None, 0.1)
+    assert broker.committed("g", "in", 0) == 2
+    assert produced(broker, "out") == 2
+    for _ in range(2):
+        k._loop_transactional_once(handler, None, 0.1)
+    assert broker.committed("g", "in", 0) == 5
+    assert produced(broker, "out") == 5
+
+
+def test_deadline_commits_prefix_and_rewinds_the_rest():
+    broker = InMemoryBroker(partitions=1)
+    k = setup(broker, transaction_max_s=0.05)
+    seen = []
+    handler = forward(k, seen, delay_s=0.03)
+
+    k._loop_transactional_once(handler, None, 0.1)
+    first = broker.committed("g", "in", 0)
+    assert 1 <= first < 5
+    assert produced(broker, "out") == first
+
+    while broker.committed("g", "in", 0) < 5:
+        k._loop_transactional_once(handler, None, 0.1)
+    assert seen == [0, 1, 2, 3, 4]  # o resto do lote volta sem reprocessar o prefixo
+    assert produced(broker, "out") == 5
@@ -0,0 +1,21 @@
+"""TTLCache: limite de tamanho e validade das entradas."""
+import time
+
+from core.ttlcache import TTLCache
+
+
+def test_evicts_least_recently_used():
+    c = TTLCache(maxsize=2, ttl_s=60)
+    c["a"], c["b"] = 1, 2
+    assert c.get("a") == 1
+    c["c"] = 3
+    assert c.get("b") is None
+    assert (c.get("a"), c.get("c")) == (1, 3)
+
+
+def test_entries_expire():
+    c = TTLCache(maxsize=10, ttl_s=0.05)
+    c["a"] = 1
+    time.sleep(0.06)
+    assert c.get("a") is None
+    assert len(c) == 0
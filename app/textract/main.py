@@ -6,12 +6,15 @@ import os
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from core.kafka import KafkaJSON
+from core.blobstore import blob_store_from_url
 
 
 KAFKA_BROKER = os.getenv("KAFKA_BROKER", "localhost:29092")
 KAFKA_GROUP_ID = os.getenv("KAFKA_GROUP_ID", "textract-group-1")
 INPUT_TOPIC = os.getenv("INPUT_TOPIC", "btg.raw")
 OUTPUT_TOPIC = os.getenv("OUTPUT_TOPIC", "btg.parsed")
+HANDLER_CONCURRENCY = int(os.getenv("HANDLER_CONCURRENCY", "1"))
+MAX_PENDING = int(os.getenv("MAX_PENDING", "0")) or None
 
 AWS_PROFILE = os.getenv("AWS_PROFILE", "default")
 AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
@@ -19,12 +22,27 @@ AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
 
 client = None
 kafka = None
+blob_store = None
+
+
+def load_attachment(data):
+    """
+    Lê o anexo da mensagem: referência no blob store (claim-check) ou
+    base64 inline (produtores antigos).
+    """
+    ref = data.get("attachment_ref")
+    if ref:
+        if blob_store is None:
+            raise RuntimeError("Mensagem com attachment_ref, mas BLOB_STORE_URL não configurado.")
+        # lido via mmap; o boto3 só aceita bytes, então a única cópia acontece aqui
+        with blob_store.open(ref) as view:
+            return bytes(view)
+    return base64.b64decode(data.get("attachment_data"))
 
 
 def on_msg(topic, data):
     print("Recebido do tópico:", topic, "=>")
-    image64 = data.get("attachment_data")
-    image_bytes = base64.b64decode(image64)
+    image_bytes = load_attachment(data)
 
     results = process_image(client, image_bytes)
 
@@ -40,15 +58,16 @@ def on_msg(topic, data):
 
 
 def main():
-    global client, kafka
+    global client, kafka, blob_store
 
     kafka = KafkaJSON(broker=KAFKA_BROKER, group_id=KAFKA_GROUP_ID)
+    blob_store = blob_store_from_url()
 
     session = boto3.Session(profile_name=AWS_PROFILE)
     client = session.client("textract", region_name=AWS_REGION)
 
     kafka.subscribe(INPUT_TOPIC)
-    kafka.loop(on_msg)
+    kafka.loop(on_msg, concurrency=HANDLER_CONCURRENCY, max_pending=MAX_PENDING)
 
 
 if __name__ == "__main__":
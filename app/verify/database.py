@@ -2,7 +2,7 @@ from typing import Optional, List, Dict, Any
 import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from core.database import Database
+from core.database import Database, is_transient_error
 
 
 class DatabaseManager:
@@ -35,8 +35,11 @@ class DatabaseManager:
             return self.db.fetchval(
                 "SELECT user_id FROM user_source WHERE source_id = %s",
                 (source_id,),
+                prepare=True,
             )
         except Exception as e:
+            if is_transient_error(e):
+                raise
             print(f"Erro ao buscar user_id: {e}")
             return None
 
@@ -51,9 +54,12 @@ class DatabaseManager:
                   AND transaction_type = 'boleto'
                 """,
                 (user_id, installment_amount),
+                prepare=True,
             )
             return bool(cnt and cnt > 0)
         except Exception as e:
+            if is_transient_error(e):
+                raise
             print(f"Erro ao verificar transações: {e}")
             return False
 
@@ -68,21 +74,15 @@ class DatabaseManager:
 
     def add_bank(self, name: str) -> Optional[int]:
         try:
-            rowcount = self.db.execute(
-                "INSERT INTO banks (name) VALUES (%s)",
+            result = self.db.execute_returning(
+                "INSERT INTO banks (name) VALUES (%s) RETURNING id",
                 (name,)
             )
-            
-            if rowcount > 0:
-                result = self.db.fetchone(
-                    "SELECT id FROM banks WHERE name = %s ORDER BY id DESC LIMIT 1",
-                    (name,)
-                )
-                
-                if result:
-                    bank_id = result['id'] if isinstance(result, dict) else result[0]
-                    print(f"Novo banco adicionado: {name} (id={bank_id})")
-                    return bank_id
+
+            if result:
+                bank_id = result['id'] if isinstance(result, dict) else result[0]
+                print(f"Novo banco adicionado: {name} (id={bank_id})")
+                return bank_id
             return None
         except Exception as e:
             print(f"Erro ao adicionar banco: {e}")
@@ -97,44 +97,44 @@ class DatabaseManager:
         installments_count: int,
     ) -> Optional[int]:
         try:
-            existing_id = self.db.fetchval(
-                """
-                SELECT id FROM bank_financing_offers
-                WHERE bank_id = %s
-                  AND user_id = %s
-                  AND month = %s
-                  AND year = %s
-                  AND installments_count = %s
-                LIMIT 1
-                """,
-                (bank_id, user_id, month, year, installments_count),
-            )
-            
-            if existing_id is not None:
-                print(f"Oferta de financiamento já existe: id={existing_id} (não duplicando)")
-                return existing_id
-            
-            self.db.execute(
+            # busca e insert numa ida só: insere apenas se não existir e devolve o id
+            result = self.db.execute_returning(
                 """
-                INSERT INTO bank_financing_offers
-                    (bank_id, user_id, month, year, installments_count)
-                VALUES (%s, %s, %s, %s, %s)
-                """,
-                (bank_id, user_id, month, year, installments_count)
-            )
-            
-            result = self.db.fetchone(
-                """
-                SELECT id FROM bank_financing_offers
-                WHERE bank_id = %s AND user_id = %s AND month = %s AND year = %s AND installments_count = %s
-                ORDER BY id DESC LIMIT 1
+                WITH existing AS (
+                    SELECT id FROM bank_financing_offers
+                    WHERE bank_id = %(bank_id)s
+                      AND user_id = %(user_id)s
+                      AND month = %(month)s
+                      AND year = %(year)s
+                      AND installments_count = %(installments_count)s
+                    LIMIT 1
+                ), inserted AS (
+                    INSERT INTO bank_financing_offers
+                        (bank_id, user_id, month, year, installments_count)
+                    SELECT %(bank_id)s, %(user_id)s, %(month)s, %(year)s, %(installments_count)s
+                    WHERE NOT EXISTS (SELECT 1 FROM existing)
+                    RETURNING id
+                )
+                SELECT id, FALSE AS inserted FROM existing
+                UNION ALL
+                SELECT id, TRUE AS inserted FROM inserted
                 """,
-                (bank_id, user_id, month, year, installments_count)
+                {
+                    "bank_id": bank_id,
+                    "user_id": user_id,
+                    "month": month,
+                    "year": year,
+                    "installments_count": installments_count,
+                },
             )
-            
+
             if result:
                 offer_id = result['id'] if isinstance(result, dict) else result[0]
-                print(f"Oferta de financiamento inserida: id={offer_id}")
+                inserted = result['inserted'] if isinstance(result, dict) else result[1]
+                if inserted:
+                    print(f"Oferta de financiamento inserida: id={offer_id}")
+                else:
+                    print(f"Oferta de financiamento já existe: id={offer_id} (não duplicando)")
                 return offer_id
             return None
         except Exception as e:
@@ -9,7 +9,9 @@ from database import DatabaseManager
 from api_client import APIClient
 from message_processor import MessageProcessor
 from partition_worker import PartitionWorker
-from core.llm import LLMWrapper
+from core.llm import CircuitBreaker, EndpointPool, LLMCache, LLMTrace, LLMWrapper
+from core.llmrouter import LLMRouter
+from core.kafka import RetryPolicy, start_retry_scheduler
 
 
 class WorkerManager:
@@ -22,6 +24,7 @@ class WorkerManager:
         api_client: APIClient,
         llm: LLMWrapper,
         worker_count: int = 1,
+        retry: Optional[RetryPolicy] = None,
     ):
         self.kafka_bootstrap_servers = kafka_bootstrap_servers
         self.kafka_topic = kafka_topic
@@ -31,10 +34,13 @@ class WorkerManager:
         self.workers: List[PartitionWorker] = []
         self.message_processor = MessageProcessor(database_manager, api_client, llm)
         self.worker_count = max(1, int(worker_count))
+        self.retry = retry
 
     def start(self):
         try:
             print(f"[Manager] Iniciando {self.worker_count} worker(s) para o tópico '{self.kafka_topic}'...")
+            if self.retry:
+                start_retry_scheduler(self.kafka_bootstrap_servers, self.kafka_group_id, self.kafka_topic, self.retry)
             for i in range(self.worker_count):
                 w = PartitionWorker(
                     partition=i,
@@ -42,6 +48,7 @@ class WorkerManager:
                     kafka_topic=self.kafka_topic,
                     kafka_group_id=self.kafka_group_id,
                     message_processor=self.message_processor,
+                    retry=self.retry,
                 )
                 w.start()
                 self.workers.append(w)
@@ -99,12 +106,21 @@ def main():
 
     database_manager = DatabaseManager(**DB_CONFIG)
     api_client = APIClient(POST_URL)
-    llm = LLMWrapper(
+    base_llm = LLMWrapper(
         provider=LLM_PROVIDER,
         model=LLM_MODEL,
         temperature=LLM_TEMPERATURE,
         ollama_base_url=OLLAMA_BASE_URL,
+        pool_size=max(10, WORKER_COUNT),  # uma conexão keep-alive por thread
+        cache=LLMCache.from_env(),
+        breaker=CircuitBreaker.from_env(OLLAMA_BASE_URL),
+        endpoints=EndpointPool.from_env(OLLAMA_BASE_URL),  # aceita várias URLs separadas por vírgula
+        trace=LLMTrace.from_env(),
     )
+    # modelo por tarefa (LLM_MODELS), keep_alive e warm-up antes de consumir
+    router = LLMRouter.from_env(base_llm)
+    llm = router.for_task("bank_match")
+    router.start(["bank_match"])
 
     manager = WorkerManager(
         kafka_bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
@@ -114,6 +130,7 @@ def main():
         api_client=api_client,
         llm=llm,
         worker_count=WORKER_COUNT,
+        retry=RetryPolicy.from_env(),
     )
 
     manager.start()
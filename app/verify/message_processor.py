@@ -1,7 +1,6 @@
 import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-import json
 from typing import Dict, Any
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
@@ -9,6 +8,14 @@ from database import DatabaseManager
 from api_client import APIClient
 from core.llm import LLMWrapper
 
+BANK_MATCH_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "new_name": {"type": "boolean"},
+        "id": {"type": ["integer", "null"]},
+    },
+    "required": ["new_name"],
+}
 
 class MessageProcessor:
     
@@ -84,6 +91,7 @@ class MessageProcessor:
                 
         except Exception as e:
             print(f"Error processing message: {e}")
+            raise
     
     def process_bank_and_offer(self, agent_analysis: Dict[str, Any], user_id: int):
         try:
@@ -144,16 +152,16 @@ Return ONLY this JSON format:
 OR
 {{"new_name": true}}  (if it's a new bank)"""
             
-            response = self.llm.generate(prompt=prompt, system_prompt=system_prompt)
-            
-            print(f"LLM response for bank matching: {response}")
-            
-            response_clean = response.strip()
-            if response_clean.startswith("```"):
-                lines = response_clean.split("\n")
-                response_clean = "\n".join([l for l in lines if not l.startswith("```")])
+            # classificação: temperatura 0 deixa a resposta determinística (e cacheável)
+            result = self.llm.generate_json(
+                prompt=prompt,
+                schema=BANK_MATCH_SCHEMA,
+                system_prompt=system_prompt,
+                temperature=0.0,
+                label="verify.bank_match",
+            )
             
-            result = json.loads(response_clean)
+            print(f"LLM response for bank matching: {result}")
             
             if not result.get('new_name', True):
                 return result.get('id')
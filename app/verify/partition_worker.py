@@ -5,7 +5,7 @@ from typing import Callable, Optional
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from core.kafka import KafkaJSON
+from core.kafka import KafkaJSON, RetryPolicy
 from message_processor import MessageProcessor
 
 
@@ -23,13 +23,15 @@ class PartitionWorker:
         kafka_bootstrap_servers: str,
         kafka_topic: str,
         kafka_group_id: str,
-        message_processor: MessageProcessor
+        message_processor: MessageProcessor,
+        retry: Optional[RetryPolicy] = None
     ):
         self.partition = partition
         self.kafka_bootstrap_servers = kafka_bootstrap_servers
         self.kafka_topic = kafka_topic
         self.kafka_group_id = kafka_group_id
         self.message_processor = message_processor
+        self.retry = retry
 
         self._kafka: Optional[KafkaJSON] = None
         self._thread: Optional[threading.Thread] = None
@@ -41,6 +43,7 @@ class PartitionWorker:
             self.message_processor.process(data)
         except Exception as e:
             print(f"[Worker p{self.partition}] erro ao processar: {e}")
+            raise
 
     def run(self):
         print(f"[Worker p{self.partition}] iniciando...")
@@ -49,7 +52,7 @@ class PartitionWorker:
         self._running = True
 
         try:
-            self._kafka.loop(self._on_message)
+            self._kafka.loop(self._on_message, retry=self.retry)
         except KeyboardInterrupt:
             print(f"\n[Worker p{self.partition}] interrompido por KeyboardInterrupt")
         finally: